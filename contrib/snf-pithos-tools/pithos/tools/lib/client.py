@@ -31,7 +31,7 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from httplib import HTTPConnection, HTTPSConnection, HTTP
+from httplib import HTTPConnection, HTTPSConnection, HTTP, HTTPException
 from sys import stdin
 from xml.dom import minidom
 from StringIO import StringIO
@@ -43,6 +43,7 @@ import types
 import socket
 import urllib
 import datetime
+import threading
 
 ERROR_CODES = {304: 'Not Modified',
                400: 'Bad Request',
@@ -69,14 +70,29 @@ class Fault(Exception):
 
 
 class Client(object):
-    def __init__(self, url, token, account, verbose=False, debug=False):
-        """`url` can also include a port, e.g '127.0.0.1:8000'."""
+    def __init__(self, url, token, account, verbose=False, debug=False,
+                 keepalive=False):
+        """`url` can also include a port, e.g '127.0.0.1:8000'.
+
+        With `keepalive`, each thread reuses one connection for its requests.
+        """
 
         self.url = url
         self.account = account
         self.verbose = verbose or debug
         self.debug = debug
         self.token = token
+        self.keepalive = keepalive
+        self._local = threading.local()
+
+    def _connect(self):
+        p = urlparse(self.url)
+        if p.scheme == 'http':
+            return HTTPConnection(p.netloc)
+        elif p.scheme == 'https':
+            return HTTPSConnection(p.netloc)
+        else:
+            raise Exception('Unknown URL scheme')
 
     def _req(self, method, path, body=None, headers=None, format='text',
              params=None):
@@ -84,12 +100,10 @@ class Client(object):
         params = params or {}
 
         p = urlparse(self.url)
-        if p.scheme == 'http':
-            conn = HTTPConnection(p.netloc)
-        elif p.scheme == 'https':
-            conn = HTTPSConnection(p.netloc)
-        else:
-            raise Exception('Unknown URL scheme')
+        conn = getattr(self._local, 'conn', None)
+        reused = conn is not None
+        if not reused:
+            conn = self._connect()
 
         full_path = _prepare_path(p.path + path, format, params)
 
@@ -105,12 +119,26 @@ class Client(object):
 
         #print '#', method, full_path, kwargs
         #t1 = datetime.datetime.utcnow()
-        conn.request(method, full_path, **kwargs)
-
-        resp = conn.getresponse()
+        try:
+            conn.request(method, full_path, **kwargs)
+            resp = conn.getresponse()
+        except (HTTPException, socket.error):
+            if not reused:
+                raise
+            # The server closed the idle connection, retry on a new one.
+            conn.close()
+            conn = self._connect()
+            conn.request(method, full_path, **kwargs)
+            resp = conn.getresponse()
         #t2 = datetime.datetime.utcnow()
         #print 'response time:', str(t2-t1)
-        return _handle_response(resp, self.verbose, self.debug)
+        self._local.conn = None
+        try:
+            return _handle_response(resp, self.verbose, self.debug)
+        finally:
+            # Keep the connection if the response has been read fully.
+            if self.keepalive and not resp.will_close and resp.isclosed():
+                self._local.conn = conn
 
     def _chunked_transfer(self, path, method='PUT', f=stdin, headers=None,
                           blocksize=1024, params=None):
@@ -33,11 +33,14 @@
 
 import hashlib
 import os
+import threading
 
 from binascii import hexlify
 
 from progress.bar import IncrementalBar
 
+from synnefo.lib.merkle import merkle_root
+
 
 def file_read_iterator(fp, size=1024):
     while True:
@@ -47,6 +50,35 @@ def file_read_iterator(fp, size=1024):
         yield data
 
 
+class ThreadFiles(object):
+    """File objects of a path, one for each thread that asks for it.
+
+    Worker threads of a pool get their own file object, so that they can
+    seek independently; close() closes all of them, once the pool is done.
+    """
+
+    def __init__(self, path, mode='rb'):
+        self.path = path
+        self.mode = mode
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.files = []
+
+    def get(self):
+        fp = getattr(self.local, 'fp', None)
+        if fp is None:
+            fp = self.local.fp = open(self.path, self.mode)
+            with self.lock:
+                self.files.append(fp)
+        return fp
+
+    def close(self):
+        with self.lock:
+            files, self.files = self.files, []
+        for fp in files:
+            fp.close()
+
+
 class HashMap(list):
 
     def __init__(self, blocksize, blockhash):
@@ -62,30 +94,44 @@ class HashMap(list):
     def _hash_block(self, v):
         return self._hash_raw(v.rstrip('\x00'))
 
-    def hash(self):
-        if len(self) == 0:
-            return self._hash_raw('')
-        if len(self) == 1:
-            return self.__getitem__(0)
-
-        h = list(self)
-        s = 2
-        while s < len(h):
-            s = s * 2
-        h += [('\x00' * len(h[0]))] * (s - len(h))
-        while len(h) > 1:
-            h = [self._hash_raw(h[x] + h[x + 1]) for x in range(0, len(h), 2)]
-        return h[0]
-
-    def load(self, fp):
+    def hash(self, pool=None):
+        return merkle_root(''.join(self), self.blockhash, pool=pool)
+
+    def load(self, fp, pool=None):
+        """Hash the blocks of fp.
+
+        With a pool (e.g. a multiprocessing.pool.ThreadPool), the blocks are
+        read and hashed by the pool workers, each using its own file object.
+        """
+
         self.size = 0
         file_size = os.fstat(fp.fileno()).st_size
         nblocks = 1 + (file_size - 1) // self.blocksize
         bar = IncrementalBar('Computing', max=nblocks)
         bar.suffix = '%(percent).1f%% - %(eta)ds'
-        for block in bar.iter(file_read_iterator(fp, self.blocksize)):
-            self.append(self._hash_block(block))
-            self.size += len(block)
+        if pool is None:
+            for block in bar.iter(file_read_iterator(fp, self.blocksize)):
+                self.append(self._hash_block(block))
+                self.size += len(block)
+            return
+
+        files = ThreadFiles(fp.name)
+        blocksize = self.blocksize
+
+        def hash_block_at(offset):
+            f = files.get()
+            f.seek(offset)
+            block = f.read(blocksize)
+            return self._hash_block(block), len(block)
+
+        offsets = xrange(0, file_size, blocksize)
+        try:
+            for digest, length in bar.iter(pool.imap(hash_block_at,
+                                                     offsets)):
+                self.append(digest)
+                self.size += length
+        finally:
+            files.close()
 
 
 def merkle(path, blocksize=4194304, blockhash='sha256'):
@@ -35,86 +35,204 @@ import os
 import types
 import json
 
-from hashmap import HashMap
-from binascii import hexlify, unhexlify
+from hashmap import HashMap, ThreadFiles
+from binascii import hexlify
 from cStringIO import StringIO
 from client import Fault
+from multiprocessing.pool import ThreadPool
+from time import time
 
 from progress.bar import IncrementalBar
 
-
-def upload(client, path, container, prefix, name=None, mimetype=None):
-
-    meta = client.retrieve_container_metadata(container)
-    blocksize = int(meta['x-container-block-size'])
-    blockhash = meta['x-container-block-hash']
-
-    size = os.path.getsize(path)
-    hashes = HashMap(blocksize, blockhash)
-    hashes.load(open(path))
-    map = {'bytes': size, 'hashes': [hexlify(x) for x in hashes]}
-
-    objectname = name if name else os.path.split(path)[-1]
-    object = prefix + objectname
-    kwargs = {'mimetype': mimetype} if mimetype else {}
-    v = None
-    try:
-        v = client.create_object_by_hashmap(container, object, map, **kwargs)
-    except Fault, fault:
-        if fault.status != 409:
-            raise
-    else:
-        return v
-
-    if isinstance(fault.data, types.StringType):
-        missing = json.loads(fault.data)
-    elif isinstance(fault.data, types.ListType):
-        missing = fault.data
-
-    if '' in missing:
-        del missing[missing.index(''):]
-
-    bar = IncrementalBar('Uploading', max=len(missing))
-    bar.suffix = '%(percent).1f%% - %(eta)ds'
-    with open(path) as fp:
-        for hash in missing:
-            offset = hashes.index(unhexlify(hash)) * blocksize
-            fp.seek(offset)
+# Number of blocks hashed and transferred at the same time.
+DEFAULT_WORKERS = 4
+
+
+class TransferBar(IncrementalBar):
+    """Progress bar that also reports the transfer throughput."""
+
+    suffix = '%(percent).1f%% - %(eta)ds'
+
+    def __init__(self, *args, **kwargs):
+        super(TransferBar, self).__init__(*args, **kwargs)
+        self.start_time = time()
+        self.bytes = 0
+        self.template = self.suffix
+
+    def transferred(self, n):
+        self.bytes += n
+        elapsed = max(time() - self.start_time, 1e-6)
+        rate = self.bytes / elapsed / (1024 * 1024)
+        self.suffix = '%s - %.1f MB/s' % (self.template, rate)
+        self.next()
+
+
+class Transfer(object):
+    """Upload and download objects block by block, with a pool of workers.
+
+    Files are hashed by the workers, only the blocks missing from the
+    server are uploaded and only the blocks that differ from the local
+    file are downloaded, several at a time. Each worker keeps its own
+    connection to the server and its own file object.
+    """
+
+    def __init__(self, client, workers=DEFAULT_WORKERS):
+        self.client = client.__class__(client.url, client.token,
+                                       client.account, client.verbose,
+                                       client.debug, keepalive=True)
+        self.workers = max(workers, 1)
+
+    def _run(self, func, args):
+        """Yield the results of func applied to args, in order."""
+
+        if self.workers == 1:
+            return (func(a) for a in args)
+        pool = ThreadPool(self.workers)
+        results = pool.imap(func, args)
+
+        def results_iterator():
+            try:
+                for r in results:
+                    yield r
+            finally:
+                pool.terminate()
+                pool.join()
+        return results_iterator()
+
+    def _hashes(self, path, blocksize, blockhash):
+        hashes = HashMap(blocksize, blockhash)
+        with open(path, 'rb') as fp:
+            if self.workers == 1:
+                hashes.load(fp)
+            else:
+                pool = ThreadPool(self.workers)
+                try:
+                    hashes.load(fp, pool)
+                finally:
+                    pool.terminate()
+                    pool.join()
+        return hashes
+
+    def upload(self, path, container, prefix, name=None, mimetype=None):
+        client = self.client
+        meta = client.retrieve_container_metadata(container)
+        blocksize = int(meta['x-container-block-size'])
+        blockhash = meta['x-container-block-hash']
+
+        size = os.path.getsize(path)
+        hashes = self._hashes(path, blocksize, blockhash)
+        map = {'bytes': size, 'hashes': [hexlify(x) for x in hashes]}
+
+        objectname = name if name else os.path.split(path)[-1]
+        object = prefix + objectname
+        kwargs = {'mimetype': mimetype} if mimetype else {}
+        v = None
+        try:
+            v = client.create_object_by_hashmap(container, object, map,
+                                                **kwargs)
+        except Fault, fault:
+            if fault.status != 409:
+                raise
+        else:
+            return v
+
+        if isinstance(fault.data, types.StringType):
+            missing = json.loads(fault.data)
+        elif isinstance(fault.data, types.ListType):
+            missing = fault.data
+
+        if '' in missing:
+            del missing[missing.index(''):]
+
+        offsets = {}
+        for i, h in enumerate(hashes):
+            offsets.setdefault(hexlify(h), i * blocksize)
+        missing = sorted(set(missing), key=lambda h: offsets[h])
+
+        files = ThreadFiles(path)
+
+        def upload_block(hash):
+            fp = files.get()
+            fp.seek(offsets[hash])
             block = fp.read(blocksize)
             client.update_container_data(container, StringIO(block))
-            bar.next()
-    bar.finish()
-
-    return client.create_object_by_hashmap(container, object, map, **kwargs)
-
-
-def download(client, container, object, path):
-
-    res = client.retrieve_object_hashmap(container, object)
-    blocksize = int(res['block_size'])
-    blockhash = res['block_hash']
-    bytes = res['bytes']
-    map = res['hashes']
-
-    if os.path.exists(path):
-        h = HashMap(blocksize, blockhash)
-        h.load(open(path))
-        hashes = [hexlify(x) for x in h]
-    else:
-        open(path, 'w').close()     # Create an empty file
-        hashes = []
-
-    with open(path, 'a+') as fp:
+            return len(block)
+
+        bar = TransferBar('Uploading', max=len(missing))
+        results = self._run(upload_block, missing)
+        try:
+            for n in results:
+                bar.transferred(n)
+        finally:
+            # Stop the workers before closing their files.
+            results.close()
+            files.close()
+        bar.finish()
+
+        return client.create_object_by_hashmap(container, object, map,
+                                               **kwargs)
+
+    def download(self, container, object, path):
+        client = self.client
+        res = client.retrieve_object_hashmap(container, object)
+        blocksize = int(res['block_size'])
+        blockhash = res['block_hash']
+        bytes = res['bytes']
+        map = res['hashes']
+
+        if os.path.exists(path):
+            hashes = [hexlify(x)
+                      for x in self._hashes(path, blocksize, blockhash)]
+        else:
+            open(path, 'w').close()     # Create an empty file
+            hashes = []
+
+        # Preallocate the file, so that blocks can be written in any order.
+        with open(path, 'r+b') as fp:
+            fp.truncate(bytes)
+
+        blocks = []
         if bytes != 0:
-            for i, h in enumerate(map):
-                if i < len(hashes) and h == hashes[i]:
-                    continue
-                start = i * blocksize
-                end = '' if i == len(map) - 1 else ((i + 1) * blocksize) - 1
-                data = client.retrieve_object(
-                    container, object, range='bytes=%s-%s' % (start, end))
-                if i != len(map) - 1:
-                    data += (blocksize - len(data)) * '\x00'
-                fp.seek(start)
-                fp.write(data)
-        fp.truncate(bytes)
+            blocks = [i for i, h in enumerate(map)
+                      if i >= len(hashes) or h != hashes[i]]
+        last = len(map) - 1
+
+        files = ThreadFiles(path, 'r+b')
+
+        def download_block(i):
+            start = i * blocksize
+            end = '' if i == last else ((i + 1) * blocksize) - 1
+            data = client.retrieve_object(
+                container, object, range='bytes=%s-%s' % (start, end))
+            if i != last:
+                data += (blocksize - len(data)) * '\x00'
+            fp = files.get()
+            fp.seek(start)
+            fp.write(data)
+            fp.flush()
+            return len(data)
+
+        bar = TransferBar('Downloading', max=len(blocks))
+        results = self._run(download_block, blocks)
+        try:
+            for n in results:
+                bar.transferred(n)
+        finally:
+            # Stop the workers before closing their files.
+            results.close()
+            files.close()
+        bar.finish()
+
+        with open(path, 'r+b') as fp:
+            fp.truncate(bytes)
+
+
+def upload(client, path, container, prefix, name=None, mimetype=None,
+           workers=DEFAULT_WORKERS):
+    transfer = Transfer(client, workers)
+    return transfer.upload(path, container, prefix, name, mimetype)
+
+
+def download(client, container, object, path, workers=DEFAULT_WORKERS):
+    transfer = Transfer(client, workers)
+    transfer.download(container, object, path)
@@ -43,7 +43,7 @@ from django.core.validators import email_re
 
 from pithos.tools.lib.client import Pithos_Client, Fault
 from pithos.tools.lib.util import get_user, get_auth, get_url
-from pithos.tools.lib.transfer import upload, download
+from pithos.tools.lib.transfer import upload, download, DEFAULT_WORKERS
 
 import json
 import logging
@@ -781,9 +781,14 @@ class Send(Command):
     syntax = '<file> <container>[/<prefix>]'
     description = 'upload file to container (using prefix)'
 
+    def add_options(self, parser):
+        parser.add_option('-w', action='store', type='int', dest='workers',
+                          default=DEFAULT_WORKERS,
+                          help='number of blocks to transfer in parallel')
+
     def execute(self, file, path):
         container, sep, prefix = path.partition('/')
-        upload(self.client, file, container, prefix)
+        upload(self.client, file, container, prefix, workers=self.workers)
 
 
 @cli_command('receive')
@@ -791,9 +796,14 @@ class Receive(Command):
     syntax = '<container>/<object> <file>'
     description = 'download object to file'
 
+    def add_options(self, parser):
+        parser.add_option('-w', action='store', type='int', dest='workers',
+                          default=DEFAULT_WORKERS,
+                          help='number of blocks to transfer in parallel')
+
     def execute(self, path, file):
         container, sep, object = path.partition('/')
-        download(self.client, container, object, file)
+        download(self.client, container, object, file, workers=self.workers)
 
 
 def print_usage():
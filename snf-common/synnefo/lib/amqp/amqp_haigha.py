@@ -198,6 +198,18 @@ class AMQPHaighaClient():
 
         logger.debug('Published message %s with id %s', body, mid)
 
+    @reconnect_decorator
+    def basic_publish_multi(self, exchange, routing_key, bodies):
+        for body in bodies:
+            msg = Message(body, delivery_mode=2)
+            mid = self.channel.basic.publish(msg, exchange, routing_key)
+            if self.confirms:
+                self.unacked[mid] = (exchange, routing_key, body)
+            logger.debug('Published message %s with id %s', body, mid)
+
+        if self.confirms:
+            self.get_confirms()
+
     @reconnect_decorator
     def get_confirms(self):
         self.connection.read_frames()
@@ -0,0 +1,214 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+"""Merkle tree hashing over contiguous buffers of digests.
+
+Pithos hashes an object as the root of a binary Merkle tree, whose leaves
+are the hashes of the object blocks, padded with zero digests up to the
+next power of two. The functions here compute that root without building
+a list of strings for every level: the digests are hashed pairwise in
+place inside a single bytearray, and the padding is never materialized;
+at each level it is replaced by the hash of the padding of the level
+below.
+
+"""
+
+import hashlib
+
+# Leaves per subtree handed to each worker of a pool.
+SUBTREE = 65536
+
+
+def _depth(count):
+    """Return the number of levels above count leaves."""
+
+    depth = 0
+    while (1 << depth) < count:
+        depth += 1
+    return depth
+
+
+def _padding(blockhash, hashlen, depth):
+    """Return the padding digest of each level of a tree of depth."""
+
+    pads = ['\x00' * hashlen]
+    for i in xrange(depth):
+        pads.append(hashlib.new(blockhash, pads[-1] * 2).digest())
+    return pads
+
+
+def _reduce(buf, count, hashlen, blockhash, pads, start, levels):
+    """Hash the count digests at the start of buf pairwise, in place, for
+    levels levels, the first being level start. Return the count left.
+    """
+
+    base = hashlib.new(blockhash)
+    step = hashlen * 2
+    for level in xrange(start, start + levels):
+        half = count // 2
+        for i in xrange(half):
+            h = base.copy()
+            h.update(buffer(buf, i * step, step))
+            buf[i * hashlen:(i + 1) * hashlen] = h.digest()
+        if count % 2:
+            h = base.copy()
+            h.update(buffer(buf, (count - 1) * hashlen, hashlen))
+            h.update(pads[level])
+            buf[half * hashlen:(half + 1) * hashlen] = h.digest()
+            half += 1
+        count = half
+    return count
+
+
+def _subtree_root(args):
+    digests, blockhash, hashlen, levels = args
+    buf = bytearray(digests)
+    pads = _padding(blockhash, hashlen, levels)
+    _reduce(buf, len(buf) // hashlen, hashlen, blockhash, pads, 0, levels)
+    return str(buf[:hashlen])
+
+
+def merkle_root(digests, blockhash='sha256', hashlen=None, pool=None,
+                subtree=SUBTREE):
+    """Return the Merkle root of the concatenated binary digests given.
+
+    digests may be a string or any object that can be sliced into strings
+    (e.g. a memory map). If a pool (e.g. a multiprocessing.Pool) is given
+    and there are more than subtree digests, the roots of the subtrees of
+    subtree leaves are computed in the pool, with pool.map(). subtree must
+    be a power of two.
+
+    """
+
+    if hashlen is None:
+        hashlen = hashlib.new(blockhash).digest_size
+    count = len(digests) // hashlen
+    if count == 0:
+        return hashlib.new(blockhash).digest()
+    if count == 1:
+        return digests[:hashlen]
+
+    depth = _depth(count)
+    pads = _padding(blockhash, hashlen, depth)
+    start = 0
+    if pool is not None and count > subtree:
+        if subtree & (subtree - 1):
+            raise ValueError('Subtree size is not a power of two')
+        start = _depth(subtree)
+        size = subtree * hashlen
+        roots = pool.map(_subtree_root,
+                         [(digests[i:i + size], blockhash, hashlen, start)
+                          for i in xrange(0, count * hashlen, size)])
+        count = len(roots)
+        buf = bytearray(''.join(roots))
+    else:
+        buf = bytearray(digests[:count * hashlen])
+    _reduce(buf, count, hashlen, blockhash, pads, start, depth - start)
+    return str(buf[:hashlen])
+
+
+class MerkleTree(object):
+    """A Merkle tree that keeps all of its levels.
+
+    When some of the leaves change, update() rehashes only the nodes on
+    their paths to the root, instead of the whole tree.
+
+    """
+
+    def __init__(self, digests='', blockhash='sha256', hashlen=None):
+        if hashlen is None:
+            hashlen = hashlib.new(blockhash).digest_size
+        self.blockhash = blockhash
+        self.hashlen = hashlen
+        leaves = bytearray(digests[:])
+        if len(leaves) % hashlen:
+            raise ValueError('Digests length is not a multiple of %d' % (
+                hashlen,))
+        self.count = len(leaves) // hashlen
+        self.depth = _depth(self.count)
+        self.pads = _padding(blockhash, hashlen, self.depth)
+        self.levels = [leaves]
+        count = self.count
+        for level in xrange(self.depth):
+            count = (count + 1) // 2
+            parents = bytearray(count * hashlen)
+            self.levels.append(parents)
+            for i in xrange(count):
+                self._rehash(level, i)
+
+    def __len__(self):
+        return self.count
+
+    def _rehash(self, level, i):
+        """Recompute node i of the level above level."""
+
+        l = self.hashlen
+        children = self.levels[level]
+        h = hashlib.new(self.blockhash)
+        if (2 * i + 2) * l <= len(children):
+            h.update(buffer(children, 2 * i * l, 2 * l))
+        else:
+            h.update(buffer(children, 2 * i * l, l))
+            h.update(self.pads[level])
+        self.levels[level + 1][i * l:(i + 1) * l] = h.digest()
+
+    def root(self):
+        """Return the root of the tree."""
+
+        if self.count == 0:
+            return hashlib.new(self.blockhash).digest()
+        return str(self.levels[-1][:self.hashlen])
+
+    def update(self, changes):
+        """Replace leaves and update the tree.
+
+        changes maps leaf indexes to their new binary digests. Indexes
+        must refer to existing leaves.
+
+        """
+
+        l = self.hashlen
+        leaves = self.levels[0]
+        dirty = set()
+        for i, digest in changes.iteritems():
+            if i < 0 or i >= self.count:
+                raise IndexError('Leaf index out of range')
+            if len(digest) != l:
+                raise ValueError('Invalid hash length')
+            leaves[i * l:(i + 1) * l] = digest
+            dirty.add(i // 2)
+        for level in xrange(self.depth):
+            for i in dirty:
+                self._rehash(level, i)
+            dirty = set(i // 2 for i in dirty)
+        return self.root()
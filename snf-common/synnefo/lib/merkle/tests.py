@@ -0,0 +1,126 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+#
+#
+
+"""Unit Tests for synnefo.lib.merkle
+
+Checks the Merkle roots computed over buffers of digests against a
+straightforward computation over lists of padded levels.
+
+"""
+
+import hashlib
+import os
+import random
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from synnefo.lib.merkle import merkle_root, MerkleTree
+
+
+def reference_root(hashes, blockhash='sha256'):
+    def hash_raw(v):
+        return hashlib.new(blockhash, v).digest()
+
+    if len(hashes) == 0:
+        return hash_raw('')
+    if len(hashes) == 1:
+        return hashes[0]
+    h = list(hashes)
+    s = 2
+    while s < len(h):
+        s = s * 2
+    h += [('\x00' * len(h[0]))] * (s - len(h))
+    while len(h) > 1:
+        h = [hash_raw(h[x] + h[x + 1]) for x in range(0, len(h), 2)]
+    return h[0]
+
+
+def random_hashes(count, hashlen=32):
+    return [os.urandom(hashlen) for i in xrange(count)]
+
+
+class MerkleRootTestCase(unittest.TestCase):
+    def test_sizes(self):
+        for count in range(0, 40) + [255, 256, 257]:
+            hashes = random_hashes(count)
+            self.assertEqual(merkle_root(''.join(hashes)),
+                             reference_root(hashes))
+
+    def test_blockhash(self):
+        hashes = random_hashes(13, 16)
+        self.assertEqual(merkle_root(''.join(hashes), 'md5'),
+                         reference_root(hashes, 'md5'))
+
+    def test_pool(self):
+        pool = ThreadPool(2)
+        try:
+            for count in (9, 16, 17, 100):
+                hashes = random_hashes(count)
+                self.assertEqual(
+                    merkle_root(''.join(hashes), pool=pool, subtree=8),
+                    reference_root(hashes))
+            self.assertRaises(ValueError, merkle_root,
+                              ''.join(random_hashes(9)), pool=pool,
+                              subtree=6)
+        finally:
+            pool.close()
+
+
+class MerkleTreeTestCase(unittest.TestCase):
+    def test_root(self):
+        for count in (0, 1, 2, 5, 64, 65):
+            hashes = random_hashes(count)
+            tree = MerkleTree(''.join(hashes))
+            self.assertEqual(len(tree), count)
+            self.assertEqual(tree.root(), reference_root(hashes))
+
+    def test_update(self):
+        hashes = random_hashes(37)
+        tree = MerkleTree(''.join(hashes))
+        for i in xrange(10):
+            changes = dict((random.randrange(len(hashes)), os.urandom(32))
+                           for j in xrange(3))
+            for k, v in changes.iteritems():
+                hashes[k] = v
+            self.assertEqual(tree.update(changes), reference_root(hashes))
+
+    def test_update_out_of_range(self):
+        tree = MerkleTree(''.join(random_hashes(3)))
+        self.assertRaises(IndexError, tree.update, {3: os.urandom(32)})
+        self.assertRaises(ValueError, tree.update, {0: 'short'})
+
+
+if __name__ == '__main__':
+    unittest.main()
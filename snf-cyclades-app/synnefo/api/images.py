@@ -32,7 +32,6 @@
 # or implied, of GRNET S.A.
 
 from logging import getLogger
-from itertools import ifilter
 
 from dateutil.parser import parse as date_parse
 
@@ -47,7 +46,7 @@ from django.utils import simplejson as json
 
 from snf_django.lib import api
 from snf_django.lib.api import faults, utils
-from synnefo.api import util
+from synnefo.api import listing, util
 from synnefo.plankton.utils import image_backend
 
 
@@ -133,7 +132,7 @@ def list_images(request, detail=False):
         images = backend.list_images()
         if since:
             updated_since = lambda img: date_parse(img["updated_at"]) >= since
-            images = ifilter(updated_since, images)
+            images = filter(updated_since, images)
             if not images:
                 return HttpResponse(status=304)
 
@@ -146,7 +145,10 @@ def list_images(request, detail=False):
     else:
         data = json.dumps(dict(images=reply))
 
-    return HttpResponse(data, status=200)
+    # Images are not kept in the database, so the ETag can only be derived
+    # from the listing itself. This still spares unchanged listings from
+    # being transferred to polling clients.
+    return listing.conditional_response(request, data)
 
 
 @api.api_method('POST', user_required=True, logger=log)
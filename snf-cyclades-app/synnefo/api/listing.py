@@ -0,0 +1,174 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+"""Conditional and cached responses for the API list endpoints.
+
+Every listing is tagged with an ETag derived from a cheap watermark of the
+rows it depends on (their latest 'updated' timestamp and their number) and
+from a per-user generation token, which the dispatcher callbacks renew
+whenever they update a VM or a network. Clients presenting an up to date ETag
+get a 304 and otherwise the pre-serialized listing is served from the cache.
+
+The generation tokens only work if the cache is shared by the API servers and
+the dispatcher, so listings are neither tagged nor cached with a local cache.
+
+"""
+
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signals
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count, Max
+from django.http import HttpResponse
+
+CACHE_BACKEND = getattr(settings, "API_LIST_CACHE_BACKEND",
+                        settings.CACHE_BACKEND)
+CACHE_TIMEOUT = getattr(settings, "API_LIST_CACHE_TIMEOUT", 300)
+CACHE_KEY_PREFIX = "api_list"
+
+backend = get_cache(CACHE_BACKEND)
+
+# Per-process caches can not see the generations renewed by the dispatcher
+CACHE_ENABLED = not isinstance(backend, (LocMemCache, DummyCache))
+
+# Some caches -- python-memcached in particular -- need to do a cleanup at the
+# end of a request cycle. If the cache provides a close() method, wire it up
+# here.
+if hasattr(backend, 'close'):
+    signals.request_finished.connect(backend.close)
+
+
+def get_key(*args):
+    # User ids may contain characters that are not valid in memcached keys
+    args = [md5(unicode(arg).encode("utf-8")).hexdigest() for arg in args]
+    args.insert(0, CACHE_KEY_PREFIX)
+    return "_".join(args)
+
+
+def get_generation(kind, userid=None):
+    """Return the generation token of a listing.
+
+    A userid of None refers to the listing of the public resources, which is
+    shared by all users.
+
+    """
+    key = get_key("generation", kind, userid)
+    generation = backend.get(key)
+    if generation is None:
+        backend.add(key, uuid4().hex, CACHE_TIMEOUT)
+        generation = backend.get(key) or uuid4().hex
+    return generation
+
+
+def invalidate(kind, userid=None):
+    """Renew the generation token of a listing, invalidating its cache."""
+    backend.set(get_key("generation", kind, userid), uuid4().hex,
+                CACHE_TIMEOUT)
+
+
+def vm_changed(vm):
+    """Invalidate the listings affected by a change of a VM.
+
+    The network listings are included since they report the NICs of the user.
+
+    """
+    invalidate("servers", vm.userid)
+    invalidate("networks", vm.userid)
+
+
+def network_changed(network):
+    invalidate("networks", None if network.public else network.userid)
+
+
+def get_etag(*args):
+    return '"%s"' % md5(repr(args)).hexdigest()
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if not if_none_match:
+        return False
+    etags = [e.strip() for e in if_none_match.split(",")]
+    return etag in etags or "*" in etags
+
+
+def conditional_response(request, data, etag=None):
+    """Return the data, or a 304 if the client already has them."""
+    if etag is None:
+        etag = get_etag(data)
+    if etag_matches(request, etag):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(data, status=200)
+    response["ETag"] = etag
+    return response
+
+
+def cached_response(request, kind, querysets, render, public=False,
+                    variant=()):
+    """Serve a listing through the listing cache.
+
+    'querysets' select all the rows that may affect the listing, including
+    deleted ones, and are only used to compute the watermark. 'render' is
+    called to serialize the listing when it is not cached. 'public' also
+    ties the listing to the generation of the public resources and 'variant'
+    distinguishes different representations of the same listing.
+
+    """
+    if not CACHE_ENABLED:
+        return HttpResponse(render(), status=200)
+
+    userid = request.user_uniq
+    watermark = [queryset.aggregate(updated=Max("updated"), count=Count("id"))
+                 for queryset in querysets]
+    generations = [get_generation(kind, userid)]
+    if public:
+        generations.append(get_generation(kind))
+    etag = get_etag(kind, userid, variant, request.serialization,
+                    [(w["updated"], w["count"]) for w in watermark],
+                    generations)
+
+    if etag_matches(request, etag):
+        return conditional_response(request, None, etag)
+
+    key = get_key("data", userid, etag)
+    data = backend.get(key) if CACHE_TIMEOUT else None
+    if data is None:
+        data = render()
+        if CACHE_TIMEOUT:
+            backend.set(key, data, CACHE_TIMEOUT)
+    return conditional_response(request, data, etag)
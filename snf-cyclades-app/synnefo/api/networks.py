@@ -46,10 +46,10 @@ from django.utils import simplejson as json
 
 from snf_django.lib import api
 from snf_django.lib.api import faults, utils
-from synnefo.api import util
+from synnefo.api import listing, util
 from synnefo.api.actions import network_actions
 from synnefo import quotas
-from synnefo.db.models import Network
+from synnefo.db.models import Network, NetworkInterface
 from synnefo.db.utils import validate_mac
 from synnefo.db.pools import EmptyPool
 from synnefo.logic import backend
@@ -134,24 +134,31 @@ def list_networks(request, detail=False):
     user_networks = Network.objects.filter(Q(userid=request.user_uniq) |
                                            Q(public=True))
 
+    def render(networks):
+        networks = [network_to_dict(network, request.user_uniq, detail)
+                    for network in networks]
+        if request.serialization == 'xml':
+            return render_to_string('list_networks.xml', {
+                'networks': networks,
+                'detail': detail})
+        else:
+            return json.dumps({'networks': networks})
+
     if since:
-        user_networks = user_networks.filter(updated__gte=since)
+        user_networks = list(user_networks.filter(updated__gte=since)
+                                          .order_by('id'))
         if not user_networks:
             return HttpResponse(status=304)
-    else:
-        user_networks = user_networks.filter(deleted=False)
-
-    networks = [network_to_dict(network, request.user_uniq, detail)
-                for network in user_networks.order_by('id')]
-
-    if request.serialization == 'xml':
-        data = render_to_string('list_networks.xml', {
-            'networks': networks,
-            'detail': detail})
-    else:
-        data = json.dumps({'networks': networks})
-
-    return HttpResponse(data, status=200)
+        return HttpResponse(render(user_networks), status=200)
+
+    # The attachments of the networks are the NICs of the user
+    user_nics = NetworkInterface.objects.filter(
+        machine__userid=request.user_uniq)
+    active_networks = user_networks.filter(deleted=False).order_by('id')
+    return listing.cached_response(request, "networks",
+                                   [user_networks, user_nics],
+                                   lambda: render(active_networks),
+                                   public=True, variant=(detail,))
 
 
 @api.api_method(http_method='POST', user_required=True, logger=log)
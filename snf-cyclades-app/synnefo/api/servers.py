@@ -40,16 +40,17 @@ except ImportError:  # Django==1.2
     from django.conf.urls.defaults import patterns
 
 from django.db import transaction
+from django.db.models import Max
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 from django.utils import simplejson as json
 
 from snf_django.lib import api
 from snf_django.lib.api import faults, utils
-from synnefo.api import util
+from synnefo.api import listing, util
 from synnefo.api.actions import server_actions
 from synnefo.db.models import (VirtualMachine, VirtualMachineMetadata,
-                               NetworkInterface)
+                               VirtualMachineDiagnostic, NetworkInterface)
 from synnefo.logic.backend import (create_instance, delete_instance,
                                    process_op_status, job_is_still_running,
                                    vm_exists_in_backend)
@@ -120,7 +121,7 @@ def metadata_item_demux(request, server_id, key):
 
 def nic_to_dict(nic):
     d = {'id': util.construct_nic_id(nic),
-         'network_id': str(nic.network.id),
+         'network_id': str(nic.network_id),
          'mac_address': nic.mac,
          'ipv4': nic.ipv4 if nic.ipv4 else None,
          'ipv6': nic.ipv6 if nic.ipv6 else None}
@@ -141,11 +142,62 @@ def nics_to_addresses(nics):
             net_nics.append({"version": 6,
                              "addr": nic.ipv6,
                              "OS-EXT-IPS:type": "fixed"})
-        addresses[nic.network.id] = net_nics
+        addresses[nic.network_id] = net_nics
     return addresses
 
 
 def vm_to_dict(vm, detail=False):
+    if not detail:
+        return _vm_to_dict(vm)
+    metadata = vm.metadata.all()
+    nics = vm.nics.filter(state="ACTIVE").order_by("index")
+    # include the latest vm diagnostic, if set
+    diagnostic = vm.get_last_diagnostic()
+    return _vm_to_dict(vm, detail, metadata, nics, diagnostic)
+
+
+def vms_to_dicts(vms, detail=False):
+    """Serialize a list of VMs using a constant number of queries.
+
+    Metadata, active NICs and the latest diagnostic of all VMs are loaded in
+    bulk and indexed by VM id, instead of querying them once per VM.
+
+    """
+    vms = list(vms)
+    if not detail:
+        return [_vm_to_dict(vm) for vm in vms]
+    if not vms:
+        return []
+
+    vm_ids = [vm.id for vm in vms]
+
+    metadata = dict((vm_id, []) for vm_id in vm_ids)
+    for meta in VirtualMachineMetadata.objects.filter(vm__in=vm_ids):
+        metadata[meta.vm_id].append(meta)
+
+    nics = dict((vm_id, []) for vm_id in vm_ids)
+    active_nics = NetworkInterface.objects.filter(machine__in=vm_ids,
+                                                  state="ACTIVE")
+    for nic in active_nics.order_by("machine", "index"):
+        nics[nic.machine_id].append(nic)
+
+    last_ids = VirtualMachineDiagnostic.objects.filter(machine__in=vm_ids)\
+                                               .values("machine")\
+                                               .order_by()\
+                                               .annotate(last=Max("id"))
+    last_ids = [entry["last"] for entry in last_ids]
+    diagnostics = {}
+    if last_ids:
+        in_bulk = VirtualMachineDiagnostic.objects.in_bulk(last_ids)
+        for diagnostic in in_bulk.values():
+            diagnostics[diagnostic.machine_id] = diagnostic
+
+    return [_vm_to_dict(vm, detail, metadata[vm.id], nics[vm.id],
+                        diagnostics.get(vm.id))
+            for vm in vms]
+
+
+def _vm_to_dict(vm, detail=False, metadata=None, nics=None, diagnostic=None):
     d = dict(id=vm.id, name=vm.name)
     d['links'] = util.vm_to_links(vm.id)
     if detail:
@@ -157,22 +209,18 @@ def vm_to_dict(vm, detail=False):
         d['hostId'] = vm.hostid
         d['updated'] = utils.isoformat(vm.updated)
         d['created'] = utils.isoformat(vm.created)
-        d['flavor'] = {"id": vm.flavor.id,
-                       "links": util.flavor_to_links(vm.flavor.id)}
+        d['flavor'] = {"id": vm.flavor_id,
+                       "links": util.flavor_to_links(vm.flavor_id)}
         d['image'] = {"id": vm.imageid,
                       "links": util.image_to_links(vm.imageid)}
         d['suspended'] = vm.suspended
 
-        metadata = dict((m.meta_key, m.meta_value) for m in vm.metadata.all())
-        d['metadata'] = metadata
+        d['metadata'] = dict((m.meta_key, m.meta_value) for m in metadata)
 
-        vm_nics = vm.nics.filter(state="ACTIVE").order_by("index")
-        attachments = map(nic_to_dict, vm_nics)
-        d['attachments'] = attachments
-        d['addresses'] = nics_to_addresses(vm_nics)
+        nics = list(nics)
+        d['attachments'] = map(nic_to_dict, nics)
+        d['addresses'] = nics_to_addresses(nics)
 
-        # include the latest vm diagnostic, if set
-        diagnostic = vm.get_last_diagnostic()
         if diagnostic:
             d['diagnostics'] = diagnostics_to_dict([diagnostic])
         else:
@@ -255,26 +303,27 @@ def list_servers(request, detail=False):
     log.debug('list_servers detail=%s', detail)
     user_vms = VirtualMachine.objects.filter(userid=request.user_uniq)
 
+    def render(vms):
+        servers = vms_to_dicts(vms, detail)
+        if request.serialization == 'xml':
+            return render_to_string('list_servers.xml', {
+                'servers': servers,
+                'detail': detail})
+        else:
+            return json.dumps({'servers': servers})
+
     since = utils.isoparse(request.GET.get('changes-since'))
 
     if since:
-        user_vms = user_vms.filter(updated__gte=since)
+        user_vms = list(user_vms.filter(updated__gte=since).order_by('id'))
         if not user_vms:
             return HttpResponse(status=304)
-    else:
-        user_vms = user_vms.filter(deleted=False)
-
-    servers = [vm_to_dict(server, detail)
-               for server in user_vms.order_by('id')]
-
-    if request.serialization == 'xml':
-        data = render_to_string('list_servers.xml', {
-            'servers': servers,
-            'detail': detail})
-    else:
-        data = json.dumps({'servers': servers})
+        return HttpResponse(render(user_vms), status=200)
 
-    return HttpResponse(data, status=200)
+    active_vms = user_vms.filter(deleted=False).order_by('id')
+    return listing.cached_response(request, "servers", [user_vms],
+                                   lambda: render(active_vms),
+                                   variant=(detail,))
 
 
 @api.api_method(http_method='POST', user_required=True, logger=log)
@@ -239,6 +239,31 @@ class NetworkAPITest(ComputeAPITest):
             self.assertNetworksEqual(Network.objects.get(id=net_id), api_net,
                                      detail=True)
 
+    @patch("synnefo.api.listing.CACHE_ENABLED", True)
+    def test_list_networks_etag(self, mrapi):
+        """Test that the attachments of the user change the ETag."""
+        response = self.myget('networks/detail', self.user)
+        self.assertSuccess(response)
+        etag = response['ETag']
+        response = self.myget('networks/detail', self.user,
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # A new attachment of the user
+        mfactory.NetworkInterfaceFactory(network=self.net2, machine=self.vm1)
+        response = self.myget('networks/detail', self.user,
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertSuccess(response)
+        etag = response['ETag']
+        api_nets = json.loads(response.content)["networks"]
+        for api_net in api_nets:
+            self.assertNetworksEqual(Network.objects.get(id=api_net['id']),
+                                     api_net, detail=True)
+        # A removed attachment of the user
+        self.nic1.delete()
+        response = self.myget('networks/detail', self.user,
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertSuccess(response)
+
     def test_get_network_building_nics(self, mrapi):
         net = mfactory.NetworkFactory()
         machine = mfactory.VirtualMachineFactory(userid=net.userid)
@@ -33,9 +33,12 @@
 
 import json
 
+from django.db import connection
 from snf_django.utils.testing import BaseAPITest, mocked_quotaholder
-from synnefo.db.models import VirtualMachine, VirtualMachineMetadata
+from synnefo.db.models import (VirtualMachine, VirtualMachineMetadata,
+                               VirtualMachineDiagnostic)
 from synnefo.db import models_factory as mfactory
+from synnefo.api import listing
 from synnefo.logic.utils import get_rsapi_state
 from synnefo.cyclades_settings import cyclades_services
 from synnefo.lib.services import get_service_path
@@ -114,6 +117,86 @@ class ServerAPITest(ComputeAPITest):
             self.assertEqual(api_vm['status'], get_rsapi_state(db_vm))
             self.assertSuccess(response)
 
+    def test_server_list_no_shared_cache(self):
+        """Test that local caches do not tag the servers list."""
+        with patch("synnefo.api.listing.CACHE_ENABLED", False):
+            response = self.myget('servers/detail', self.user1)
+        self.assertSuccess(response)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(len(json.loads(response.content)['servers']), 1)
+
+    @patch("synnefo.api.listing.CACHE_ENABLED", True)
+    def test_server_list_etag(self):
+        """Test conditional requests on the servers list."""
+        user = self.user1
+        response = self.myget('servers/detail', user)
+        self.assertSuccess(response)
+        etag = response['ETag']
+        response = self.myget('servers/detail', user,
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # The simple listing is tagged differently
+        response = self.myget('servers', user, HTTP_IF_NONE_MATCH=etag)
+        self.assertSuccess(response)
+        # A new server changes the watermark
+        mfactory.VirtualMachineFactory(userid=user)
+        response = self.myget('servers/detail', user,
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertSuccess(response)
+        self.assertEqual(len(json.loads(response.content)['servers']), 2)
+        etag = response['ETag']
+        # Invalidation by the dispatcher
+        listing.vm_changed(self.vm1)
+        response = self.myget('servers/detail', user,
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertSuccess(response)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def _count_list_detail_queries(self, user):
+        old_debug = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            response = self.myget('servers/detail', user)
+            self.assertSuccess(response)
+            return len(connection.queries) - start, response
+        finally:
+            connection.use_debug_cursor = old_debug
+
+    def _create_detailed_vm(self, user):
+        vm = mfactory.VirtualMachineFactory(userid=user)
+        mfactory.VirtualMachineMetadataFactory(vm=vm)
+        mfactory.NetworkInterfaceFactory(machine=vm, index=0)
+        mfactory.NetworkInterfaceFactory(machine=vm, index=1)
+        VirtualMachineDiagnostic.objects.create_debug(vm, message="old")
+        VirtualMachineDiagnostic.objects.create_debug(vm, message="last")
+        return vm
+
+    def test_server_list_detail_queries(self):
+        """Test that the number of queries does not depend on the servers."""
+        user = 'query_user'
+        self._create_detailed_vm(user)
+        one_count, _ = self._count_list_detail_queries(user)
+        for i in range(4):
+            self._create_detailed_vm(user)
+        many_count, response = self._count_list_detail_queries(user)
+        self.assertEqual(one_count, many_count)
+
+        servers = json.loads(response.content)['servers']
+        self.assertEqual(len(servers), 5)
+        for api_vm in servers:
+            db_vm = VirtualMachine.objects.get(id=api_vm['id'])
+            self.assertEqual(api_vm['flavor']['id'], db_vm.flavor_id)
+            self.assertEqual(api_vm['metadata'],
+                             dict((m.meta_key, m.meta_value)
+                                  for m in db_vm.metadata.all()))
+            nics = db_vm.nics.order_by('index')
+            self.assertEqual([a['mac_address'] for a in api_vm['attachments']],
+                             [nic.mac for nic in nics])
+            self.assertEqual(len(api_vm['addresses']), 2)
+            self.assertEqual(len(api_vm['diagnostics']), 1)
+            self.assertEqual(api_vm['diagnostics'][0]['message'], 'last')
+
     def test_server_detail(self):
         """Test if a server details are returned."""
         db_vm = self.vm2
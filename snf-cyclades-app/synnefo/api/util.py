@@ -385,7 +385,7 @@ def render_meta(request, meta, status=200):
 
 
 def construct_nic_id(nic):
-    return "-".join(["nic", unicode(nic.machine.id), unicode(nic.index)])
+    return "-".join(["nic", unicode(nic.machine_id), unicode(nic.index)])
 
 
 def verify_personality(personality):
@@ -41,3 +41,8 @@ GANETI_USE_OPPORTUNISTIC_LOCKING = True
 BACKEND_ALLOCATOR_MODULE = "synnefo.logic.allocators.default_allocator"
 # Refresh backend statistics timeout, in minutes, used in backend allocation
 BACKEND_REFRESH_MIN = 15
+
+# Minimum increase of the build percentage of a VM, for a build progress
+# message to be stored. Smaller increases are dropped, apart from reaching
+# 100%.
+BUILD_PROGRESS_MIN_DELTA = 5
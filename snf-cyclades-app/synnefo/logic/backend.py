@@ -31,7 +31,7 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 from django.conf import settings
-from django.db import transaction
+from snf_django.lib.db.transaction import commit_on_success_unless_managed
 from datetime import datetime
 
 from synnefo.db.models import (Backend, VirtualMachine, Network,
@@ -55,7 +55,7 @@ _firewall_tags = {
 _reverse_tags = dict((v.split(':')[3], k) for k, v in _firewall_tags.items())
 
 
-@transaction.commit_on_success
+@commit_on_success_unless_managed()
 def process_op_status(vm, etime, jobid, opcode, status, logmsg, nics=None):
     """Process a job progress notification from the backend
 
@@ -114,7 +114,7 @@ def process_op_status(vm, etime, jobid, opcode, status, logmsg, nics=None):
     vm.save()
 
 
-@transaction.commit_on_success
+@commit_on_success_unless_managed()
 def process_net_status(vm, etime, nics):
     """Wrap _process_net_status inside transaction."""
     _process_net_status(vm, etime, nics)
@@ -217,7 +217,7 @@ def release_instance_nics(vm):
         net.save()
 
 
-@transaction.commit_on_success
+@commit_on_success_unless_managed()
 def process_network_status(back_network, etime, jobid, opcode, status, logmsg):
     if status not in [x[0] for x in BACKEND_STATUSES]:
         raise Network.InvalidBackendMsgError(opcode, status)
@@ -312,7 +312,7 @@ def update_network_state(network):
     network.save()
 
 
-@transaction.commit_on_success
+@commit_on_success_unless_managed()
 def process_network_modify(back_network, etime, jobid, opcode, status,
                            add_reserved_ips, remove_reserved_ips):
     assert (opcode == "OP_NETWORK_SET_PARAMS")
@@ -339,7 +339,7 @@ def process_network_modify(back_network, etime, jobid, opcode, status,
     back_network.save()
 
 
-@transaction.commit_on_success
+@commit_on_success_unless_managed()
 def process_create_progress(vm, etime, progress):
 
     percentage = int(progress)
@@ -365,12 +365,17 @@ def process_create_progress(vm, etime, progress):
     #if not vm.operstate == 'BUILD':
     #    raise VirtualMachine.IllegalState("VM is not in building state")
 
+    # Skip writing small increases of the build percentage
+    if (percentage < 100 and
+       percentage - vm.buildpercentage < settings.BUILD_PROGRESS_MIN_DELTA):
+        return
+
     vm.buildpercentage = percentage
     vm.backendtime = etime
     vm.save()
 
 
-@transaction.commit_on_success
+@commit_on_success_unless_managed()
 def create_instance_diagnostic(vm, message, source, level="DEBUG", etime=None,
                                details=None):
     """
@@ -34,11 +34,15 @@ import logging
 import json
 from functools import wraps
 
+from django.db import transaction
+
 from synnefo.db.models import (Backend, VirtualMachine, Network,
                                BackendNetwork, pooled_rapi_client)
 from synnefo.logic import utils, backend, rapi
+from synnefo.api import listing
 
 from synnefo.lib.utils import merge_time
+from synnefo.lib.ordereddict import OrderedDict
 
 log = logging.getLogger(__name__)
 
@@ -81,20 +85,34 @@ def instance_from_msg(func):
     @handle_message_delivery
     @wraps(func)
     def wrapper(msg):
-        try:
-            vm_id = utils.id_from_instance_name(msg["instance"])
-            vm = VirtualMachine.objects.select_for_update().get(id=vm_id)
-            func(vm, msg)
-        except VirtualMachine.InvalidBackendIdError:
-            log.debug("Ignoring msg for unknown instance %s.", msg['instance'])
-        except VirtualMachine.DoesNotExist:
-            log.error("VM for instance %s with id %d not found in DB.",
-                      msg['instance'], vm_id)
-        except (Network.InvalidBackendIdError, Network.DoesNotExist) as e:
-            log.error("Invalid message, can not find network. msg: %s", msg)
+        process_msgs("instance", [(func, msg)])
+    wrapper.batch_target = ("instance", func)
     return wrapper
 
 
+def process_instance_msgs(entries):
+    """Apply (func, msg) entries that refer to the same instance, in order.
+
+    The VirtualMachine is locked and fetched once for all entries. Returns
+    the VirtualMachine, or None if the msgs were ignored.
+
+    """
+    msg = entries[0][1]
+    try:
+        vm_id = utils.id_from_instance_name(msg["instance"])
+        vm = VirtualMachine.objects.select_for_update().get(id=vm_id)
+        for func, msg in entries:
+            func(vm, msg)
+        return vm
+    except VirtualMachine.InvalidBackendIdError:
+        log.debug("Ignoring msg for unknown instance %s.", msg['instance'])
+    except VirtualMachine.DoesNotExist:
+        log.error("VM for instance %s with id %d not found in DB.",
+                  msg['instance'], vm_id)
+    except (Network.InvalidBackendIdError, Network.DoesNotExist) as e:
+        log.error("Invalid message, can not find network. msg: %s", msg)
+
+
 def network_from_msg(func):
     """ Decorator for getting the BackendNetwork object of the msg.
 
@@ -102,27 +120,137 @@ def network_from_msg(func):
     @handle_message_delivery
     @wraps(func)
     def wrapper(msg):
-        try:
-            network_id = utils.id_from_network_name(msg["network"])
-            network = Network.objects.select_for_update().get(id=network_id)
-            backend = Backend.objects.get(clustername=msg['cluster'])
-            bnet, new = BackendNetwork.objects.get_or_create(network=network,
-                                                             backend=backend)
-            if new:
-                log.info("Created missing BackendNetwork %s", bnet)
-            func(bnet, msg)
-        except Network.InvalidBackendIdError:
-            log.debug("Ignoring msg for unknown network %s.", msg['network'])
-        except Network.DoesNotExist:
-            log.error("Network %s not found in DB.", msg['network'])
-        except Backend.DoesNotExist:
-            log.error("Backend %s not found in DB.", msg['cluster'])
-        except BackendNetwork.DoesNotExist:
-            log.error("Network %s on backend %s not found in DB.",
-                      msg['network'], msg['cluster'])
+        process_msgs("network", [(func, msg)])
+    wrapper.batch_target = ("network", func)
     return wrapper
 
 
+def process_network_msgs(entries):
+    """Apply (func, msg) entries that refer to the same BackendNetwork.
+
+    The Network is locked and fetched once for all entries. Returns the
+    Network, or None if the msgs were ignored.
+
+    """
+    msg = entries[0][1]
+    try:
+        network_id = utils.id_from_network_name(msg["network"])
+        network = Network.objects.select_for_update().get(id=network_id)
+        backend = Backend.objects.get(clustername=msg['cluster'])
+        bnet, new = BackendNetwork.objects.get_or_create(network=network,
+                                                         backend=backend)
+        if new:
+            log.info("Created missing BackendNetwork %s", bnet)
+        for func, msg in entries:
+            func(bnet, msg)
+        return network
+    except Network.InvalidBackendIdError:
+        log.debug("Ignoring msg for unknown network %s.", msg['network'])
+    except Network.DoesNotExist:
+        log.error("Network %s not found in DB.", msg['network'])
+    except Backend.DoesNotExist:
+        log.error("Backend %s not found in DB.", msg['cluster'])
+    except BackendNetwork.DoesNotExist:
+        log.error("Network %s on backend %s not found in DB.",
+                  msg['network'], msg['cluster'])
+
+
+BATCH_TARGETS = {
+    "instance": (lambda msg: msg["instance"], process_instance_msgs,
+                 listing.vm_changed),
+    "network": (lambda msg: (msg["network"], msg["cluster"]),
+                process_network_msgs, listing.network_changed),
+}
+
+
+def process_msgs(target, entries):
+    """Apply the (func, msg) entries to their target in one transaction.
+
+    The backend functions join this transaction instead of committing on
+    their own. The cached listings of the target are invalidated after the
+    transaction commits, so that the API can not cache them again as they
+    were before.
+
+    """
+    _, process, changed = BATCH_TARGETS[target]
+    with transaction.commit_on_success():
+        obj = process(entries)
+    if obj is not None:
+        changed(obj)
+
+
+def process_batch(client, deliveries):
+    """Process a batch of (callback, message) deliveries.
+
+    Messages are grouped by the VM or network they refer to, and each group
+    is applied in event time order in a single transaction, so the target is
+    locked and fetched once per group. 'if_update_required' still checks each
+    message against the target as updated by the previous ones. The messages
+    of a group are acked together after the transaction commits. Build
+    progress messages superseded by a newer one in the same group are acked
+    without being applied. A group that fails unexpectedly is rolled back and
+    its messages are processed one by one by their callbacks, which also
+    handle malformed messages. A message that commits on its own, like the
+    quota commission of a removed VM, commits the messages before it as
+    well; those are skipped by 'if_update_required' when processed again.
+
+    """
+    groups = OrderedDict()
+    single = []
+    for callback, message in deliveries:
+        try:
+            target, func = callback.batch_target
+            key_func = BATCH_TARGETS[target][0]
+            msg = json.loads(message['body'])
+            key = (target, key_func(msg))
+            event_time = merge_time(msg['event_time'])
+        except Exception:
+            single.append((callback, message))
+            continue
+        groups.setdefault(key, []).append((event_time, func, msg, callback,
+                                           message))
+
+    for (target, _), entries in groups.items():
+        entries.sort(key=lambda entry: entry[0])
+        entries, superseded = coalesce_progress(entries)
+        try:
+            process_msgs(target, [entry[1:3] for entry in entries])
+        except Exception as e:
+            log.exception("Failed to process %d messages as a batch: %s."
+                          " Processing them one by one.", len(entries), e)
+            single.extend((callback, message)
+                          for _, _, _, callback, message in entries)
+        else:
+            for _, _, _, _, message in entries:
+                client.basic_ack(message)
+        # The newest progress message is either applied or handed to its
+        # callback, so the ones it supersedes are never needed
+        for _, _, _, _, message in superseded:
+            client.basic_ack(message)
+
+    for callback, message in single:
+        callback(client, message)
+
+
+def coalesce_progress(entries):
+    """Drop the build progress messages that a newer one supersedes.
+
+    'entries' are the time ordered entries of a batch group. Only the newest
+    'image-copy-progress' message of the group is kept, since each one
+    overwrites the build percentage of the VM. Returns the entries to apply
+    and the superseded ones, which only need to be acked.
+
+    """
+    progress = [entry for entry in entries
+                if entry[2].get("type") == "image-copy-progress"]
+    if len(progress) < 2:
+        return entries, []
+    superseded = progress[:-1]
+    superseded_ids = set(map(id, superseded))
+    entries = [entry for entry in entries if id(entry) not in superseded_ids]
+    return entries, superseded
+
+
 def if_update_required(func):
     """
     Decorator for checking if an incoming message needs to update the db.
@@ -48,6 +48,8 @@ setup_environ(settings)
 
 from django.db import close_connection
 
+import json
+import signal
 import time
 
 import daemon
@@ -73,13 +75,49 @@ log_logic = logging.getLogger("synnefo.logic")
 LOGGERS = [log, log_amqp, log_logic]
 
 
+# Seconds to wait for more messages before processing a partial batch
+BATCH_DELAY = 0.1
+# Number of routed messages after which the router waits for their publisher
+# confirms and acks them
+ROUTE_CONFIRM_BATCH = 50
+# Seconds between checks of the router for dead workers
+WORKER_CHECK_INTERVAL = 5
+
+
 class Dispatcher:
+    """Consume messages from the queues and dispatch them to the callbacks.
+
+    With 'shards' set, the dispatcher runs as a router, which spawns one
+    worker per shard and routes each message to the shard queue of the object
+    that it refers to. A worker is a dispatcher with 'shard' set, consuming
+    only from the queues of its shard.
+
+    The shard of an object depends on the number of shards. Lowering it
+    strands the messages left in the queues of the shards that are gone,
+    since nothing consumes them any more: stop snf-ganeti-eventd and let
+    the dispatcher empty the shard queues before restarting it with fewer
+    shards.
+
+    """
     debug = False
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, batch_size=1, shards=0, shard=None):
         self.debug = debug
+        self.batch_size = batch_size
+        self.batch = []
+        self.shards = shards
+        self.shard = shard
+        self.routed = []
+        self.workers = {}
+        if self.is_router:
+            for shard in range(shards):
+                self.spawn_worker(shard)
         self._init()
 
+    @property
+    def is_router(self):
+        return self.shards > 0 and self.shard is None
+
     def wait(self):
         log.info("Waiting for messages..")
         timeout = 600
@@ -91,7 +129,12 @@ class Dispatcher:
                 # the dispatcher to recover from broken connections
                 # gracefully.
                 close_connection()
-                msg = self.client.basic_wait(timeout=timeout)
+                if self.is_router:
+                    msg = self.wait_route(timeout=timeout)
+                elif self.batch_size > 1:
+                    msg = self.wait_batch(timeout=timeout)
+                else:
+                    msg = self.client.basic_wait(timeout=timeout)
                 if not msg:
                     log.warning("Idle connection for %d seconds. Will connect"
                                 " to a different host. Verify that"
@@ -103,8 +146,164 @@ class Dispatcher:
                 log.exception("Caught unexpected exception: %s", e)
 
         self.client.basic_cancel()
+        if self.is_router:
+            self.ack_routed()
+            self.stop_workers()
         self.client.close()
 
+    def wait_batch(self, timeout):
+        """Collect up to batch_size messages and process them together.
+
+        Messages are only buffered by the consumer callbacks. After the first
+        message arrives, the batch is filled with any messages that follow
+        within BATCH_DELAY seconds and is then handed to
+        callbacks.process_batch.
+
+        """
+        msg = self.client.basic_wait(timeout=timeout)
+        while msg and len(self.batch) < self.batch_size:
+            if not self.client.basic_wait(timeout=BATCH_DELAY):
+                break
+        if self.batch:
+            batch, self.batch = self.batch, []
+            log.debug("Processing batch of %d messages", len(batch))
+            callbacks.process_batch(self.client, batch)
+        return msg
+
+    def buffer_callback(self, callback):
+        def buffer_message(client, message):
+            self.batch.append((callback, message))
+        return buffer_message
+
+    def wait_route(self, timeout):
+        """Route incoming messages to the shard queues.
+
+        Routed messages are acked in groups, once the broker has confirmed
+        their publication to the shard queues. The workers are checked every
+        WORKER_CHECK_INTERVAL seconds while waiting.
+
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.check_workers()
+            if self.routed:
+                wait = BATCH_DELAY
+            else:
+                wait = min(WORKER_CHECK_INTERVAL,
+                           max(deadline - time.time(), 0))
+            msg = self.client.basic_wait(timeout=wait)
+            if msg:
+                return msg
+            if self.routed:
+                self.ack_routed()
+                return True
+            if time.time() >= deadline:
+                return None
+
+    def route_callback(self, queue, exchange, routing_key):
+        field = queues.SHARD_FIELDS[queue]
+
+        def route_message(client, message):
+            try:
+                name = json.loads(message['body'])[field]
+            except Exception:
+                # Leave it to the worker to reject the message
+                name = ""
+            shard = queues.get_shard(name, self.shards)
+            shard_key = queues.convert_key_to_shard(routing_key, shard)
+            client.basic_publish(exchange, shard_key, message['body'])
+            self.routed.append(message)
+            if len(self.routed) >= ROUTE_CONFIRM_BATCH:
+                self.ack_routed()
+        return route_message
+
+    def ack_routed(self):
+        if not self.routed:
+            return
+        self.client.get_confirms()
+        for message in self.routed:
+            self.client.basic_ack(message)
+        self.routed = []
+
+    def spawn_worker(self, shard):
+        # Do not share the DB connection with the worker
+        close_connection()
+        pid = os.fork()
+        if pid:
+            log.info("Spawned worker %d for shard %d", pid, shard)
+            self.workers[pid] = shard
+            return
+
+        # Never return to the caller in the worker process
+        status = 1
+        try:
+            setproctitle.setproctitle("%s [shard %d]" % (sys.argv[0], shard))
+            disp = Dispatcher(debug=self.debug, batch_size=self.batch_size,
+                              shards=self.shards, shard=shard)
+            disp.wait()
+            status = 0
+        except Exception:
+            log.exception("Worker for shard %d failed", shard)
+        finally:
+            os._exit(status)
+
+    def check_workers(self):
+        """Respawn the workers that have died.
+
+        The router closes its AMQP connection before forking, so that the
+        new workers do not inherit its socket, and connects again after.
+        Messages delivered to it but not routed yet are requeued.
+
+        """
+        dead = []
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            shard = self.workers.pop(pid, None)
+            if shard is None:
+                continue
+            log.error("Worker %d for shard %d exited with status %d."
+                      " Respawning it.", pid, shard, status)
+            dead.append(shard)
+        if not dead:
+            return
+        self.ack_routed()
+        self.client.close()
+        for shard in dead:
+            self.spawn_worker(shard)
+        self._init()
+
+    def stop_workers(self):
+        for pid, shard in self.workers.items():
+            log.info("Stopping worker %d for shard %d", pid, shard)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+
+    def _declare_shard(self, queue, exchange, routing_key, shard):
+        """Declare the queue of a shard and bind it to its routing key."""
+        exchange_dl = queues.convert_exchange_to_dead(exchange)
+        queue_shard = queues.convert_queue_to_shard(queue, shard)
+        key_shard = queues.convert_key_to_shard(routing_key, shard)
+        self.client.queue_declare(queue=queue_shard, mirrored=True,
+                                  dead_letter_exchange=exchange_dl)
+        self.client.queue_bind(queue=queue_shard, exchange=exchange,
+                               routing_key=key_shard)
+        # Rejected messages of the shard end up in the dead-letter queue of
+        # the original queue
+        self.client.queue_bind(queue=queues.convert_queue_to_dead(queue),
+                               exchange=exchange_dl,
+                               routing_key=key_shard)
+        return queue_shard
+
     def _init(self):
         log.info("Initializing")
 
@@ -142,9 +341,29 @@ class Dispatcher:
             self.client.queue_bind(queue=queue, exchange=exchange,
                                    routing_key=routing_key)
 
-            self.client.basic_consume(queue=binding[0],
+            consume_queue = queue
+            prefetch_count = max(5, self.batch_size)
+            if queue in queues.SHARD_FIELDS:
+                if self.is_router:
+                    for shard in range(self.shards):
+                        self._declare_shard(queue, exchange, routing_key,
+                                            shard)
+                    callback = self.route_callback(queue, exchange,
+                                                   routing_key)
+                    prefetch_count = ROUTE_CONFIRM_BATCH
+                elif self.shard is not None:
+                    consume_queue = self._declare_shard(queue, exchange,
+                                                        routing_key,
+                                                        self.shard)
+            elif self.shard is not None:
+                # Queues that are not sharded are consumed by the router
+                continue
+
+            if self.batch_size > 1 and not self.is_router:
+                callback = self.buffer_callback(callback)
+            self.client.basic_consume(queue=consume_queue,
                                       callback=callback,
-                                      prefetch_count=5)
+                                      prefetch_count=prefetch_count)
 
             queue_dl = queues.convert_queue_to_dead(queue)
             exchange_dl = queues.convert_exchange_to_dead(exchange)
@@ -154,7 +373,7 @@ class Dispatcher:
                                    routing_key=routing_key)
 
             log.debug("Binding %s(%s) to queue %s with handler %s",
-                      exchange, routing_key, queue, binding[3])
+                      exchange, routing_key, consume_queue, binding[3])
 
 
 def parse_arguments(args):
@@ -165,8 +384,19 @@ def parse_arguments(args):
     parser = OptionParser()
     parser.add_option("-d", "--debug", action="store_true", default=False,
                       dest="debug", help="Enable debug mode")
-    parser.add_option("-w", "--workers", default=2, dest="workers",
-                      help="Number of workers to spawn", type="int")
+    parser.add_option("-b", "--batch-size", default=1, dest="batch_size",
+                      help="Process up to this many messages in a batch,"
+                           " in event time order and in one transaction per"
+                           " VM or network",
+                      type="int")
+    parser.add_option("-s", "--shards", default=0, dest="shards",
+                      help="Number of worker processes to fork. Each message"
+                           " is routed to a worker by the instance or network"
+                           " it refers to. With 0 (the default), messages"
+                           " are processed in a single process. Empty the"
+                           " shard queues before lowering it, or their"
+                           " messages are stranded",
+                      type="int")
     parser.add_option("-p", "--pid-file", dest="pid_file",
                       default=default_pid_file,
                       help="Save PID to file (default: %s)" % default_pid_file)
@@ -264,13 +494,15 @@ def get_user_confirmation():
     return True
 
 
-def debug_mode():
-    disp = Dispatcher(debug=True)
+def debug_mode(opts):
+    disp = Dispatcher(debug=True, batch_size=opts.batch_size,
+                      shards=opts.shards)
     disp.wait()
 
 
 def daemon_mode(opts):
-    disp = Dispatcher(debug=False)
+    disp = Dispatcher(debug=False, batch_size=opts.batch_size,
+                      shards=opts.shards)
     disp.wait()
 
 
@@ -318,7 +550,7 @@ def main():
 
     # Debug mode, process messages without daemonizing
     if opts.debug:
-        debug_mode()
+        debug_mode(opts)
         return
 
     # Create pidfile,
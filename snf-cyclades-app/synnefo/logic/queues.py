@@ -28,6 +28,8 @@
 # policies, either expressed or implied, of GRNET S.A.
 
 
+from zlib import crc32
+
 from synnefo.settings import BACKEND_PREFIX_ID, DEBUG, EXCHANGE_GANETI
 
 try:
@@ -65,6 +67,16 @@ BINDINGS = (
     (QUEUE_PROGRESS,  EXCHANGE_GANETI,  KEY_PROGRESS, 'update_build_progress'),
 )
 
+# SHARDS:
+# In sharded mode, messages are routed to one of the shards of their queue by
+# the name of the instance or network that they refer to, so that each object
+# is always handled by the same worker.
+SHARD_FIELDS = {
+    QUEUE_OP: "instance",
+    QUEUE_NETWORK: "network",
+    QUEUE_PROGRESS: "instance",
+}
+
 
 ## Extra for DEBUG:
 if DEBUG is True:
@@ -82,3 +94,18 @@ def convert_queue_to_dead(queue):
 def convert_exchange_to_dead(exchange):
     """Convert the name of an exchange to the corresponding dead-letter one"""
     return exchange + "-dl"
+
+
+def convert_queue_to_shard(queue, shard):
+    """Convert the name of a queue to the one of its shard"""
+    return "%s-shard-%d" % (queue, shard)
+
+
+def convert_key_to_shard(routing_key, shard):
+    """Convert a routing key to the one of the corresponding shard"""
+    return "%s.shard.%d" % (routing_key, shard)
+
+
+def get_shard(name, shards):
+    """Map the name of an instance or network to a shard"""
+    return (crc32(name.encode("utf-8")) & 0xffffffff) % shards
@@ -32,22 +32,24 @@
 
 from random import randint
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 from synnefo.db.models import *
 from synnefo.db import models_factory as mfactory
-from synnefo.logic import reconciliation
+from synnefo.logic import reconciliation, queues
 from synnefo.lib.utils import split_time
 from datetime import datetime
-from mock import patch
+from mock import patch, Mock
 from synnefo.api.util import allocate_resource
 from synnefo.logic.callbacks import (update_db, update_network,
-                                     update_build_progress)
-from snf_django.utils.testing import mocked_quotaholder
+                                     update_build_progress, process_batch)
+from snf_django.utils.testing import mocked_quotaholder, override_settings
+from django.conf import settings
 from synnefo.logic.rapi import GanetiApiError
 
 now = datetime.now
 from time import time
+from contextlib import contextmanager
 import json
 
 ## Test Callbacks
@@ -583,6 +585,15 @@ class UpdateBuildProgressTest(TestCase):
         vm = self.get_db_vm()
         self.assertEqual(vm.buildpercentage, rprogress)
 
+    def test_min_delta(self, client):
+        with override_settings(settings, BUILD_PROGRESS_MIN_DELTA=10):
+            for rprogress, expected in [(5, 0), (20, 20), (25, 20),
+                                        (100, 100)]:
+                msg = self.create_msg(progress=rprogress,
+                                      instance=self.vm.backend_vm_id)
+                update_build_progress(client, msg)
+                self.assertEqual(self.get_db_vm().buildpercentage, expected)
+
     def test_invalid_value(self, client):
         old = self.vm.buildpercentage
         for rprogress in [0, -1, 'a']:
@@ -594,6 +605,285 @@ class UpdateBuildProgressTest(TestCase):
             self.assertEqual(vm.buildpercentage, old)
 
 
+@patch('synnefo.lib.amqp.AMQPClient')
+class ProcessBatchTest(TestCase):
+    def create_msg(self, event_time, **kwargs):
+        """Create snf-ganeti-eventd message"""
+        msg = {'event_time': split_time(event_time)}
+        msg['type'] = 'ganeti-op-status'
+        msg['status'] = 'success'
+        msg['jobId'] = 1
+        msg['logmsg'] = 'Dummy Log'
+        for key, val in kwargs.items():
+            msg[key] = val
+        message = {'body': json.dumps(msg)}
+        return message
+
+    def test_event_time_order(self, client):
+        vm = mfactory.VirtualMachineFactory()
+        now = time()
+        stop = self.create_msg(now, operation='OP_INSTANCE_SHUTDOWN',
+                               instance=vm.backend_vm_id)
+        start = self.create_msg(now - 1, operation='OP_INSTANCE_STARTUP',
+                                instance=vm.backend_vm_id)
+        process_batch(client, [(update_db, stop), (update_db, start)])
+        self.assertEqual(client.basic_ack.call_count, 2)
+        db_vm = VirtualMachine.objects.get(id=vm.id)
+        self.assertEqual(db_vm.operstate, 'STOPPED')
+
+    def test_groups(self, client):
+        vm1 = mfactory.VirtualMachineFactory()
+        vm2 = mfactory.VirtualMachineFactory()
+        now = time()
+        deliveries = [
+            (update_db, self.create_msg(now, operation='OP_INSTANCE_STARTUP',
+                                        instance=vm1.backend_vm_id)),
+            (update_db, self.create_msg(now, operation='OP_INSTANCE_SHUTDOWN',
+                                        instance=vm2.backend_vm_id)),
+            (update_build_progress,
+             {'body': json.dumps({'type': 'image-copy-progress',
+                                  'progress': 50,
+                                  'instance': vm2.backend_vm_id,
+                                  'event_time': split_time(now + 1)})}),
+            # Missing instance
+            (update_db, {'body': json.dumps({'type': 'ganeti-op-status'})})]
+        process_batch(client, deliveries)
+        self.assertEqual(client.basic_ack.call_count, 3)
+        self.assertEqual(client.basic_nack.call_count, 1)
+        self.assertEqual(VirtualMachine.objects.get(id=vm1.id).operstate,
+                         'STARTED')
+        db_vm2 = VirtualMachine.objects.get(id=vm2.id)
+        self.assertEqual(db_vm2.operstate, 'STOPPED')
+        self.assertEqual(db_vm2.buildpercentage, 50)
+
+    def test_group_transaction(self, client):
+        vm = mfactory.VirtualMachineFactory()
+        now = time()
+        deliveries = [
+            (update_db, self.create_msg(now, operation='OP_INSTANCE_STARTUP',
+                                        instance=vm.backend_vm_id)),
+            (update_db, self.create_msg(now + 1,
+                                        operation='OP_INSTANCE_SHUTDOWN',
+                                        instance=vm.backend_vm_id))]
+        from synnefo.logic.backend import process_op_status
+        events = []
+
+        def record_op(*args, **kwargs):
+            events.append(args[3])
+            return process_op_status(*args, **kwargs)
+
+        @contextmanager
+        def commit_on_success():
+            events.append("begin")
+            yield
+            events.append("commit")
+
+        client.basic_ack.side_effect = lambda message: events.append("ack")
+        with patch("synnefo.logic.backend.process_op_status") as p:
+            p.side_effect = record_op
+            with patch("synnefo.logic.callbacks.transaction."
+                       "commit_on_success", commit_on_success):
+                process_batch(client, deliveries)
+        # Both messages are applied in one transaction and acked after it
+        self.assertEqual(events, ["begin", 'OP_INSTANCE_STARTUP',
+                                  'OP_INSTANCE_SHUTDOWN', "commit", "ack",
+                                  "ack"])
+        db_vm = VirtualMachine.objects.get(id=vm.id)
+        self.assertEqual(db_vm.operstate, 'STOPPED')
+
+    def test_coalesce_progress(self, client):
+        vm = mfactory.VirtualMachineFactory()
+        now = time()
+        deliveries = []
+        for i, progress in enumerate([10, 30, 60]):
+            msg = {'type': 'image-copy-progress',
+                   'progress': progress,
+                   'instance': vm.backend_vm_id,
+                   'event_time': split_time(now + i)}
+            deliveries.append((update_build_progress,
+                               {'body': json.dumps(msg)}))
+        with patch("synnefo.logic.backend.process_create_progress") as p:
+            process_batch(client, deliveries)
+            self.assertEqual(p.call_count, 1)
+            self.assertEqual(p.call_args[0][2], 60)
+        self.assertEqual(client.basic_ack.call_count, 3)
+
+
+    def test_coalesce_progress_failure(self, client):
+        vm = mfactory.VirtualMachineFactory()
+        now = time()
+        deliveries = []
+        for i, progress in enumerate([10, 30, 60]):
+            msg = {'type': 'image-copy-progress',
+                   'progress': progress,
+                   'instance': vm.backend_vm_id,
+                   'event_time': split_time(now + i)}
+            deliveries.append((update_build_progress,
+                               {'body': json.dumps(msg)}))
+        with patch("synnefo.logic.backend.process_create_progress") as p:
+            p.side_effect = Exception("Failure")
+            process_batch(client, deliveries)
+            # Applied once in the batch and once by the callback
+            self.assertEqual(p.call_count, 2)
+            self.assertEqual(p.call_args[0][2], 60)
+        # The superseded messages are acked and the failed one is rejected
+        self.assertEqual(client.basic_ack.call_count, 2)
+        self.assertEqual(client.basic_reject.call_count, 1)
+        acked = [c[0][0] for c in client.basic_ack.call_args_list]
+        self.assertEqual(acked, [m for _, m in deliveries[:2]])
+
+
+@patch('synnefo.lib.amqp.AMQPClient')
+class ProcessBatchRollbackTest(TransactionTestCase):
+    create_msg = ProcessBatchTest.create_msg.im_func
+
+    def test_failure(self, client):
+        vm = mfactory.VirtualMachineFactory()
+        now = time()
+        deliveries = [
+            (update_db, self.create_msg(now, operation='OP_INSTANCE_STARTUP',
+                                        instance=vm.backend_vm_id)),
+            (update_db, self.create_msg(now + 1,
+                                        operation='OP_INSTANCE_SHUTDOWN',
+                                        instance=vm.backend_vm_id)),
+            (update_db, self.create_msg(now + 2,
+                                        operation='OP_INSTANCE_STARTUP',
+                                        instance=vm.backend_vm_id))]
+        from synnefo.logic.backend import process_op_status
+        calls = []
+
+        def fail_second(*args, **kwargs):
+            calls.append(args[3])
+            if len(calls) == 2:
+                raise Exception("Failure")
+            return process_op_status(*args, **kwargs)
+
+        with patch("synnefo.logic.backend.process_op_status") as p:
+            p.side_effect = fail_second
+            process_batch(client, deliveries)
+        # The group is rolled back and all its messages are processed again
+        # by their callbacks, the first one included
+        self.assertEqual(calls, ['OP_INSTANCE_STARTUP', 'OP_INSTANCE_SHUTDOWN',
+                                 'OP_INSTANCE_STARTUP', 'OP_INSTANCE_SHUTDOWN',
+                                 'OP_INSTANCE_STARTUP'])
+        self.assertEqual(client.basic_ack.call_count, 3)
+        self.assertEqual(client.basic_reject.call_count, 0)
+        db_vm = VirtualMachine.objects.get(id=vm.id)
+        self.assertEqual(db_vm.operstate, 'STARTED')
+
+
+class ShardTest(TestCase):
+    def test_get_shard(self):
+        names = ["snf-%d" % i for i in range(100)]
+        shards = [queues.get_shard(name, 4) for name in names]
+        self.assertEqual(set(shards), set(range(4)))
+        self.assertEqual(shards, [queues.get_shard(unicode(name), 4)
+                                  for name in names])
+        self.assertEqual(queues.get_shard("snf-42", 1), 0)
+
+    def test_convert(self):
+        self.assertEqual(queues.convert_queue_to_shard("snf-events-op", 3),
+                         "snf-events-op-shard-3")
+        self.assertEqual(queues.convert_key_to_shard("ganeti.snf.event.op",
+                                                     3),
+                         "ganeti.snf.event.op.shard.3")
+
+
+class RouterTest(TestCase):
+    def setUp(self):
+        from synnefo.logic import dispatcher
+        self.dispatcher = dispatcher
+        with patch.object(dispatcher.Dispatcher, "_init"):
+            self.router = dispatcher.Dispatcher()
+        self.router.shards = 4
+        self.router.client = self.client = Mock()
+
+    def message(self, name, i=0):
+        body = json.dumps({"instance": name, "i": i})
+        return {"body": body}
+
+    def test_route(self):
+        route = self.router.route_callback(queues.QUEUE_OP, "ganeti",
+                                           "ganeti.snf.event.op")
+        names = ["snf-%d" % i for i in range(20)]
+        messages = [self.message(name, i) for i, name in enumerate(names)]
+        for message in messages:
+            route(self.client, message)
+        published = self.client.basic_publish.call_args_list
+        self.assertEqual(len(published), len(names))
+        for name, message, call in zip(names, messages, published):
+            shard = queues.get_shard(name, 4)
+            self.assertEqual(call[0], ("ganeti",
+                                       "ganeti.snf.event.op.shard.%d" % shard,
+                                       message["body"]))
+        # Nothing is acked before the publications are confirmed
+        self.assertEqual(self.client.basic_ack.call_count, 0)
+        self.assertEqual(self.router.routed, messages)
+
+        self.router.ack_routed()
+        self.assertEqual(self.client.get_confirms.call_count, 1)
+        self.assertEqual([c[0][0] for c in
+                          self.client.basic_ack.call_args_list], messages)
+        self.assertEqual(self.router.routed, [])
+        self.router.ack_routed()
+        self.assertEqual(self.client.get_confirms.call_count, 1)
+
+    def test_route_invalid(self):
+        route = self.router.route_callback(queues.QUEUE_NETWORK, "ganeti",
+                                           "ganeti.snf.event.network")
+        message = {"body": "not json"}
+        route(self.client, message)
+        shard = queues.get_shard("", 4)
+        self.client.basic_publish.assert_called_with(
+            "ganeti", "ganeti.snf.event.network.shard.%d" % shard,
+            "not json")
+
+    def test_ack_batch(self):
+        route = self.router.route_callback(queues.QUEUE_OP, "ganeti",
+                                           "ganeti.snf.event.op")
+        batch = self.dispatcher.ROUTE_CONFIRM_BATCH
+        for i in range(batch + 1):
+            route(self.client, self.message("snf-%d" % i))
+        self.assertEqual(self.client.get_confirms.call_count, 1)
+        self.assertEqual(self.client.basic_ack.call_count, batch)
+        self.assertEqual(len(self.router.routed), 1)
+
+    @patch("os.waitpid")
+    def test_respawn(self, waitpid):
+        self.router.workers = {10: 0, 11: 1}
+        self.router.routed = [self.message("snf-1")]
+        waitpid.side_effect = [(11, 256), (0, 0)]
+        calls = []
+        self.client.close.side_effect = lambda: calls.append("close")
+        with patch.object(self.router, "spawn_worker") as spawn:
+            spawn.side_effect = lambda shard: calls.append(shard)
+            with patch.object(self.router, "_init") as init:
+                init.side_effect = lambda: calls.append("init")
+                self.router.check_workers()
+        # The worker is forked while the router is disconnected
+        self.assertEqual(calls, ["close", 1, "init"])
+        self.assertEqual(self.client.basic_ack.call_count, 1)
+        self.assertEqual(self.router.workers, {10: 0})
+
+    @patch("os.waitpid")
+    def test_no_respawn(self, waitpid):
+        self.router.workers = {10: 0}
+        waitpid.return_value = (0, 0)
+        with patch.object(self.router, "_init") as init:
+            self.router.check_workers()
+        self.assertEqual(init.call_count, 0)
+        self.assertEqual(self.client.close.call_count, 0)
+
+    def test_arguments(self):
+        opts, args = self.dispatcher.parse_arguments([])
+        self.assertEqual(opts.shards, 0)
+        opts, args = self.dispatcher.parse_arguments(["-s", "4", "-b", "8"])
+        self.assertEqual((opts.shards, opts.batch_size), (4, 8))
+        with patch("sys.stderr"):
+            self.assertRaises(SystemExit, self.dispatcher.parse_arguments,
+                              ["--workers", "2"])
+
+
 #class ReconciliationTest(TestCase):
 #    SERVERS = 1000
 #    fixtures = ['db_test_data']
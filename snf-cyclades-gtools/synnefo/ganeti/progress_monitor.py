@@ -89,10 +89,7 @@ def main():
     amqp_client.connect()
     amqp_client.exchange_declare(settings.EXCHANGE_GANETI, "topic")
 
-    for msg in jsonstream(sys.stdin):
-        msg['event_time'] = split_time(time.time())
-        msg['instance'] = instance_name
-
+    def send(msg):
         # log to stderr
         sys.stderr.write("[MONITOR] %s\n" % json.dumps(msg))
 
@@ -101,6 +98,30 @@ def main():
                                   routing_key=routekey,
                                   body=json.dumps(msg))
 
+    # Progress messages are rate-limited to one per
+    # PROGRESS_MONITOR_INTERVAL. The latest dropped one is kept and sent
+    # before any other message, or at the end, so the final progress and the
+    # order of messages are preserved.
+    last_progress = 0
+    pending = None
+    for msg in jsonstream(sys.stdin):
+        now = time.time()
+        msg['event_time'] = split_time(now)
+        msg['instance'] = instance_name
+
+        if msg.get('type') == 'image-copy-progress':
+            if now - last_progress < settings.PROGRESS_MONITOR_INTERVAL:
+                pending = msg
+                continue
+            last_progress = now
+        elif pending is not None:
+            send(pending)
+        pending = None
+        send(msg)
+
+    if pending is not None:
+        send(pending)
+
     amqp_client.close()
     return 0
 
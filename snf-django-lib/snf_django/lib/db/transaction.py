@@ -50,3 +50,17 @@ def commit_on_success_strict(**kwargs):
                 raise
         return inner
     return wrap
+
+
+def commit_on_success_unless_managed(using=None):
+    """Like transaction.commit_on_success, but join the transaction of
+    the caller, instead of committing it, if one is already managed."""
+    def wrap(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if transaction.is_managed(using=using):
+                return func(*args, **kwargs)
+            with transaction.commit_on_success(using=using):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
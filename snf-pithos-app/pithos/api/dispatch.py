@@ -1,5 +1,5 @@
 #from pithos.backends import connect_backend
-from pithos.api.util import hashmap_md5, get_backend
+from pithos.api.util import hashmap_md5, get_backend, close_hashmaps
 
 from django.core.mail import send_mail
 
@@ -25,7 +25,10 @@ def update_md5(m):
         if meta['checksum'] == '':
             size, hashmap = backend.get_object_hashmap(
                 account, account, container, name, version)
-            checksum = hashmap_md5(backend, hashmap, size)
+            try:
+                checksum = hashmap_md5(backend, hashmap, size)
+            finally:
+                close_hashmaps([hashmap])
             backend.update_object_checksum(
                 account, account, container, name, version, checksum)
             print 'INFO: Updated checksum for path "%s"' % (path,)
@@ -31,8 +31,6 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from xml.dom import minidom
-
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 from django.utils import simplejson as json
@@ -46,22 +44,28 @@ from snf_django.lib import api
 from snf_django.lib.api import faults
 
 from pithos.api.util import (
-    json_encode_decimal, rename_meta_key, format_header_key,
-    printable_header_dict, get_account_headers, put_account_headers,
-    get_container_headers, put_container_headers, get_object_headers,
-    put_object_headers, update_manifest_meta, update_sharing_meta,
-    update_public_meta, validate_modification_preconditions,
+    json_encode_decimal, json_encode_hashmap, rename_meta_key,
+    format_header_key, printable_header_dict, get_account_headers,
+    put_account_headers, get_container_headers, put_container_headers,
+    get_object_headers, put_object_headers, update_manifest_meta,
+    update_sharing_meta, update_public_meta,
+    validate_modification_preconditions,
     validate_matching_preconditions, split_container_object_string,
     copy_or_move_object, get_int_parameter, get_content_length,
     get_content_range, socket_read_iterator, SaveToBackendHandler,
-    object_data_response, put_object_block, hashmap_md5, simple_list_response,
+    BlockUploader, read_json_hashmap, read_xml_hashmap,
+    object_data_response, put_object_block, hashmap_md5, update_object_md5,
+    simple_list_response, listing_pages, json_object_list, xml_object_list,
+    close_hashmaps,
     api_method, is_uuid,
     retrieve_uuid, retrieve_uuids, retrieve_displaynames,
     get_pithos_usage
 )
 
 from pithos.api.settings import (UPDATE_MD5, TRANSLATE_UUIDS,
-                                 SERVICE_TOKEN, ASTAKOS_BASE_URL)
+                                 SERVICE_TOKEN, ASTAKOS_BASE_URL,
+                                 UPLOAD_THREADS, CHECKSUM_THREADS,
+                                 LISTING_PAGE_SIZE)
 
 from pithos.backends.base import (
     NotAllowedError, QuotaError, ContainerNotEmpty, ItemNotExists,
@@ -662,13 +666,22 @@ def object_list(request, v_account, v_container):
     public_requested = 'public' in request.GET
     public_granted = public_requested and request.user_uniq == v_account
 
+    # Listings are streamed in pages of LISTING_PAGE_SIZE, if set.
+    page_size = limit
+    if LISTING_PAGE_SIZE > 0:
+        limit = min(limit, 10000)
+        page_size = min(limit, LISTING_PAGE_SIZE)
+
     if request.serialization == 'text':
-        try:
-            objects = request.backend.list_objects(
+        def list_page(backend, marker, limit):
+            return backend.list_objects(
                 request.user_uniq, v_account,
                 v_container, prefix, delimiter, marker,
                 limit, virtual, 'pithos', keys, shared,
                 until, None, public_granted)
+
+        try:
+            objects = list_page(request.backend, marker, page_size)
         except NotAllowedError:
             raise faults.Forbidden('Not allowed')
         except ItemNotExists:
@@ -679,30 +692,39 @@ def object_list(request, v_account, v_container):
             response.status_code = 204
             return response
         response.status_code = 200
-        response.content = '\n'.join([x[0] for x in objects]) + '\n'
+        if page_size == limit:
+            response.content = '\n'.join([x[0] for x in objects]) + '\n'
+            return response
+        pages = listing_pages(list_page, objects, lambda x: x[0], limit,
+                              page_size)
+        response.content = ('\n'.join([x[0] for x in page]) + '\n'
+                            for page in pages)
         return response
 
-    try:
-        objects = request.backend.list_object_meta(
+    def list_page(backend, marker, limit):
+        return backend.list_object_meta(
             request.user_uniq, v_account,
             v_container, prefix, delimiter, marker,
-            limit, virtual, 'pithos', keys, shared, until, None, public_granted)
+            limit, virtual, 'pithos', keys, shared, until, None,
+            public_granted)
+
+    try:
+        objects = list_page(request.backend, marker, page_size)
         object_permissions = {}
         object_public = {}
         if until is None:
             name = '/'.join((v_account, v_container, ''))
             name_idx = len(name)
-            for x in request.backend.list_object_permissions(
-                    request.user_uniq, v_account, v_container, prefix):
-
-                # filter out objects which are not under the container
-                if name != x[:name_idx]:
-                    continue
-
-                object = x[name_idx:]
-                object_permissions[object] = \
-                    request.backend.get_object_permissions(
-                        request.user_uniq, v_account, v_container, object)
+            # filter out objects which are not under the container
+            permission_objects = [
+                x[name_idx:] for x in request.backend.list_object_permissions(
+                    request.user_uniq, v_account, v_container, prefix)
+                if name == x[:name_idx]]
+            if permission_objects:
+                object_permissions = \
+                    request.backend.get_object_permissions_bulk(
+                        request.user_uniq, v_account, v_container,
+                        permission_objects)
 
             if request.user_uniq == v_account:
                 # Bring public information only if the request user
@@ -716,8 +738,7 @@ def object_list(request, v_account, v_container):
     except ItemNotExists:
         raise faults.ItemNotFound('Container does not exist')
 
-    object_meta = []
-    for meta in objects:
+    def format_meta(meta):
         if TRANSLATE_UUIDS:
             modified_by = meta.get('modified_by')
             if modified_by:
@@ -728,39 +749,50 @@ def object_list(request, v_account, v_container):
 
         if len(meta) == 1:
             # Virtual objects/directories.
-            object_meta.append(meta)
+            return meta
+        rename_meta_key(
+            meta, 'hash', 'x_object_hash')  # Will be replaced by checksum.
+        rename_meta_key(meta, 'checksum', 'hash')
+        rename_meta_key(meta, 'type', 'content_type')
+        rename_meta_key(meta, 'uuid', 'x_object_uuid')
+        if until is not None and 'modified' in meta:
+            del(meta['modified'])
         else:
-            rename_meta_key(
-                meta, 'hash', 'x_object_hash')  # Will be replaced by checksum.
-            rename_meta_key(meta, 'checksum', 'hash')
-            rename_meta_key(meta, 'type', 'content_type')
-            rename_meta_key(meta, 'uuid', 'x_object_uuid')
-            if until is not None and 'modified' in meta:
-                del(meta['modified'])
-            else:
-                rename_meta_key(meta, 'modified', 'last_modified')
-            rename_meta_key(meta, 'modified_by', 'x_object_modified_by')
-            rename_meta_key(meta, 'version', 'x_object_version')
-            rename_meta_key(
-                meta, 'version_timestamp', 'x_object_version_timestamp')
-            permissions = object_permissions.get(meta['name'], None)
-            if permissions:
-                update_sharing_meta(request, permissions, v_account,
-                                    v_container, meta['name'], meta)
-            public_url = object_public.get(meta['name'], None)
-            if request.user_uniq == v_account:
-                # Return public information only if the request user
-                # is the object owner
-                update_public_meta(public_url, meta)
-            object_meta.append(printable_header_dict(meta))
+            rename_meta_key(meta, 'modified', 'last_modified')
+        rename_meta_key(meta, 'modified_by', 'x_object_modified_by')
+        rename_meta_key(meta, 'version', 'x_object_version')
+        rename_meta_key(
+            meta, 'version_timestamp', 'x_object_version_timestamp')
+        permissions = object_permissions.get(meta['name'], None)
+        if permissions:
+            update_sharing_meta(request, permissions, v_account,
+                                v_container, meta['name'], meta)
+        public_url = object_public.get(meta['name'], None)
+        if request.user_uniq == v_account:
+            # Return public information only if the request user
+            # is the object owner
+            update_public_meta(public_url, meta)
+        return printable_header_dict(meta)
+
+    response.status_code = 200
+    if page_size == limit:
+        object_meta = [format_meta(obj) for obj in objects]
+        if request.serialization == 'xml':
+            data = render_to_string(
+                'objects.xml',
+                {'container': v_container, 'objects': object_meta})
+        elif request.serialization == 'json':
+            data = json.dumps(object_meta, default=json_encode_decimal)
+        response.content = data
+        return response
 
+    pages = listing_pages(list_page, objects,
+                          lambda x: x.get('name', x.get('subdir')), limit,
+                          page_size)
     if request.serialization == 'xml':
-        data = render_to_string(
-            'objects.xml', {'container': v_container, 'objects': object_meta})
+        response.content = xml_object_list(v_container, pages, format_meta)
     elif request.serialization == 'json':
-        data = json.dumps(object_meta, default=json_encode_decimal)
-    response.status_code = 200
-    response.content = data
+        response.content = json_object_list(pages, format_meta)
     return response
 
 
@@ -919,10 +951,13 @@ def _object_read(request, v_account, v_container, v_object):
                 sizes.append(s)
                 hashmaps.append(h)
         except NotAllowedError:
+            close_hashmaps(hashmaps)
             raise faults.Forbidden('Not allowed')
         except ItemNotExists:
+            close_hashmaps(hashmaps)
             raise faults.ItemNotFound('Object does not exist')
         except VersionNotExists:
+            close_hashmaps(hashmaps)
             raise faults.ItemNotFound('Version does not exist')
     else:
         try:
@@ -940,18 +975,22 @@ def _object_read(request, v_account, v_container, v_object):
 
     # Reply with the hashmap.
     if hashmap_reply:
-        size = sum(sizes)
-        hashmap = sum(hashmaps, [])
+        # Manifests are not expanded when replying with the hashmap.
+        size = sizes[0]
+        hashmap = hashmaps[0]
         d = {
             'block_size': request.backend.block_size,
             'block_hash': request.backend.hash_algorithm,
             'bytes': size,
             'hashes': hashmap}
-        if request.serialization == 'xml':
-            d['object'] = v_object
-            data = render_to_string('hashes.xml', d)
-        elif request.serialization == 'json':
-            data = json.dumps(d)
+        try:
+            if request.serialization == 'xml':
+                d['object'] = v_object
+                data = render_to_string('hashes.xml', d)
+            elif request.serialization == 'json':
+                data = json.dumps(d, default=json_encode_hashmap)
+        finally:
+            close_hashmaps(hashmaps)
 
         response = HttpResponse(data, status=200)
         put_object_headers(
@@ -1042,34 +1081,34 @@ def object_write(request, v_account, v_container, v_object):
         if request.serialization not in ('json', 'xml'):
             raise faults.BadRequest('Invalid hashmap format')
 
-        data = ''
-        for block in socket_read_iterator(request, content_length,
-                                          request.backend.block_size):
-            data = '%s%s' % (data, block)
-
+        chunks = socket_read_iterator(request, content_length,
+                                      request.backend.block_size)
+        hashlen = hashlib.new(request.backend.hash_algorithm).digest_size
         if request.serialization == 'json':
-            d = json.loads(data)
-            if not hasattr(d, '__getitem__'):
-                raise faults.BadRequest('Invalid data formating')
-            try:
-                hashmap = d['hashes']
-                size = int(d['bytes'])
-            except:
-                raise faults.BadRequest('Invalid data formatting')
-        elif request.serialization == 'xml':
-            try:
-                xml = minidom.parseString(data)
-                obj = xml.getElementsByTagName('object')[0]
-                size = int(obj.attributes['bytes'].value)
-
-                hashes = xml.getElementsByTagName('hash')
-                hashmap = []
-                for hash in hashes:
-                    hashmap.append(hash.firstChild.data)
-            except:
-                raise faults.BadRequest('Invalid data formatting')
+            read_hashmap = read_json_hashmap
+        else:
+            read_hashmap = read_xml_hashmap
+        try:
+            size, hashmap = read_hashmap(chunks, hashlen)
+        except faults.Fault:
+            raise
+        except:
+            raise faults.BadRequest('Invalid data formatting')
 
         checksum = ''  # Do not set to None (will copy previous value).
+    elif UPLOAD_THREADS > 0:
+        uploader = BlockUploader(request.backend)
+        try:
+            for data in socket_read_iterator(request, content_length,
+                                             request.backend.block_size):
+                uploader.put(data)
+            size, hashmap, checksum = uploader.finish()
+        finally:
+            uploader.close()
+
+        etag = request.META.get('HTTP_ETAG')
+        if etag and parse_etags(etag)[0].lower() != checksum:
+            raise faults.UnprocessableEntity('Object ETag does not match')
     else:
         md5 = hashlib.md5()
         size = 0
@@ -1109,7 +1148,10 @@ def object_write(request, v_account, v_container, v_object):
         raise faults.BadRequest('Invalid sharing header')
     except QuotaError, e:
         raise faults.RequestEntityTooLarge('Quota error: %s' % e)
-    if not checksum and UPDATE_MD5:
+    if not checksum and UPDATE_MD5 and CHECKSUM_THREADS > 0:
+        update_object_md5(request.user_uniq, v_account, v_container, v_object,
+                          version_id, size, hashmap)
+    elif not checksum and UPDATE_MD5:
         # Update the MD5 after the hashmap, as there may be missing hashes.
         checksum = hashmap_md5(request.backend, hashmap, size)
         try:
@@ -1340,9 +1382,11 @@ def object_update(request, v_account, v_container, v_object):
         raise faults.RangeNotSatisfiable('Invalid Content-Range header')
 
     try:
-        size, hashmap = \
+        size, hashes = \
             request.backend.get_object_hashmap(request.user_uniq,
                                                v_account, v_container, v_object)
+        hashmap = list(hashes)  # Updated in place below.
+        close_hashmaps([hashes])
     except NotAllowedError:
         raise faults.Forbidden('Not allowed')
     except ItemNotExists:
@@ -1361,9 +1405,11 @@ def object_update(request, v_account, v_container, v_object):
         src_container, src_name = split_container_object_string(src_object)
         src_version = request.META.get('HTTP_X_SOURCE_VERSION')
         try:
-            src_size, src_hashmap = request.backend.get_object_hashmap(
+            src_size, hashes = request.backend.get_object_hashmap(
                 request.user_uniq,
                 src_account, src_container, src_name, src_version)
+            src_hashmap = hashes[:]  # A copy, not held in a memory map.
+            close_hashmaps([hashes])
         except NotAllowedError:
             raise faults.Forbidden('Not allowed')
         except ItemNotExists:
@@ -1451,8 +1497,9 @@ def object_update(request, v_account, v_container, v_object):
     if dest_bytes is not None and dest_bytes < size:
         size = dest_bytes
         hashmap = hashmap[:(int((size - 1) / request.backend.block_size) + 1)]
-    checksum = hashmap_md5(
-        request.backend, hashmap, size) if UPDATE_MD5 else ''
+    checksum = ''
+    if UPDATE_MD5 and CHECKSUM_THREADS <= 0:
+        checksum = hashmap_md5(request.backend, hashmap, size)
     try:
         version_id = \
             request.backend.update_object_hashmap(request.user_uniq,
@@ -1469,6 +1516,9 @@ def object_update(request, v_account, v_container, v_object):
         raise faults.BadRequest('Invalid sharing header')
     except QuotaError, e:
         raise faults.RequestEntityTooLarge('Quota error: %s' % e)
+    if not checksum and UPDATE_MD5:
+        update_object_md5(request.user_uniq, v_account, v_container, v_object,
+                          version_id, size, hashmap)
     if public is not None:
         try:
             request.backend.update_object_public(request.user_uniq, v_account,
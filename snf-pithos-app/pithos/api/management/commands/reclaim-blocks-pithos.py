@@ -0,0 +1,140 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from django.core.management.base import NoArgsCommand, CommandError
+from optparse import make_option
+
+from binascii import hexlify, unhexlify
+from hashlib import new as newhasher
+
+from pithos.api.util import get_backend
+from pithos.backends.lib.hashfiler.collector import (BlockCollector,
+                                                     GRACE, RUN_SIZE)
+
+# Number of version hashes read from the database at a time.
+HASHES_LIMIT = 10000
+
+
+def list_map_hashes(node):
+    after = ''
+    while True:
+        hashes = node.version_list_hashes(after, HASHES_LIMIT)
+        for h in hashes:
+            yield unhexlify(h)
+        if len(hashes) < HASHES_LIMIT:
+            return
+        after = hashes[-1]
+
+
+class Command(NoArgsCommand):
+    help = """Reclaim the maps and blocks not referenced by any version.
+
+    Report the number and size of the maps and blocks in storage that
+    no version references anymore and remove them if specified so.
+    Files modified recently are spared, as they may belong to uploads
+    in progress.
+
+    """
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--fix',
+                    dest='fix',
+                    action="store_true",
+                    default=False,
+                    help="Remove the unreferenced maps and blocks"),
+        make_option('--grace',
+                    dest='grace',
+                    type='int',
+                    default=GRACE,
+                    help="Spare files modified during the last that many "
+                         "seconds (default: %d)" % GRACE),
+        make_option('--run-size',
+                    dest='run_size',
+                    type='int',
+                    default=RUN_SIZE,
+                    help="Number of hashes to sort in memory before "
+                         "writing them to a temporary file "
+                         "(default: %d)" % RUN_SIZE),
+        make_option('--tmpdir',
+                    dest='tmpdir',
+                    default=None,
+                    help="Directory for the temporary files"),
+    )
+
+    def handle_noargs(self, **options):
+        if options['grace'] < 0:
+            raise CommandError("Grace period must not be negative")
+        if options['run_size'] <= 0:
+            raise CommandError("Run size must be positive")
+
+        b = get_backend()
+        try:
+            node = b.node
+
+            def recent_map_hashes(since):
+                hashes = node.version_list_hashes_since(since)
+                return [unhexlify(h) for h in hashes]
+
+            def map_referenced(h):
+                return node.version_lookup_hash(hexlify(h)) is not None
+
+            hashlen = newhasher(b.hash_algorithm).digest_size
+            collector = BlockCollector(b.store, hashlen,
+                                       run_size=options['run_size'],
+                                       tmpdir=options['tmpdir'],
+                                       grace=options['grace'])
+            report = collector.collect(list_map_hashes(node),
+                                       recent_map_hashes,
+                                       map_referenced,
+                                       dry_run=not options['fix'])
+        finally:
+            b.close()
+
+        if report['dry_run']:
+            action = "Reclaimable"
+        else:
+            action = "Reclaimed"
+        for kind in ('maps', 'blocks'):
+            self.stdout.write(
+                "%s: %d referenced, %d stored, %d unreferenced, "
+                "%d spared\n" % (kind.capitalize(),
+                                 report['%s_referenced' % kind],
+                                 report['%s_stored' % kind],
+                                 report['%s_unreferenced' % kind],
+                                 report['%s_spared' % kind]))
+            self.stdout.write(
+                "%s %s: %d (%d bytes)\n" % (
+                    action, kind, report['%s_reclaimed' % kind],
+                    report['%s_reclaimed_bytes' % kind]))
+        if report['maps_missing']:
+            self.stdout.write("Missing maps: %d\n" % report['maps_missing'])
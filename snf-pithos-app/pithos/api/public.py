@@ -41,7 +41,7 @@ from pithos.api.util import (put_object_headers, update_manifest_meta,
                              validate_modification_preconditions,
                              validate_matching_preconditions,
                              object_data_response, api_method,
-                             split_container_object_string)
+                             split_container_object_string, close_hashmaps)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -145,6 +145,7 @@ def public_read(request, v_public):
                 sizes.append(s)
                 hashmaps.append(h)
         except:
+            close_hashmaps(hashmaps)
             raise faults.ItemNotFound('Object does not exist')
     else:
         try:
@@ -35,11 +35,33 @@ import unittest
 import random
 import string
 import datetime
+import hashlib
+import os
+import shutil
+import tempfile
 import time as _time
+import threading
+from xml.dom import minidom
 
 import pithos.api.settings as settings
 
+from django.http import HttpResponse
+from django.utils import simplejson as json
+from django.template.loader import render_to_string
+from django.test.client import RequestFactory
+from mock import patch
+from objpool import PoolLimitError
+
 from pithos.api.manage_accounts import ManageAccounts
+from pithos.api.util import (api_method, hashmap_md5, read_json_hashmap,
+                             read_xml_hashmap, BlockUploader,
+                             ObjectFileWrapper, ObjectWrapper,
+                             BlockPrefetcher, range_blocks,
+                             ranges_block_hashes,
+                             close_hashmaps, listing_pages,
+                             json_object_list, xml_object_list,
+                             json_encode_decimal)
+from pithos.backends.modular import ModularBackend
 
 def get_random_data(length=500):
     char_set = string.ascii_uppercase + string.digits
@@ -278,5 +300,596 @@ class TestPublic(unittest.TestCase):
             public
         )
 
+
+class BackendTestCase(unittest.TestCase):
+    """Run against a private backend on a temporary directory."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = ModularBackend(
+            db_connection='sqlite:///%s/db.sqlite' % self.path,
+            block_path='%s/blocks' % self.path)
+        self.backend.put_account('account', 'account')
+        self.backend.put_container('account', 'account', 'container')
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.path)
+
+    def put_data(self, data):
+        bs = self.backend.block_size
+        return [self.backend.put_block(data[i:i + bs])
+                for i in xrange(0, len(data), bs)]
+
+
+class TestHashmapMD5(BackendTestCase):
+    def assert_md5(self, data):
+        hashmap = self.put_data(data)
+        self.assertEqual(hashmap_md5(self.backend, hashmap, len(data)),
+                         hashlib.md5(data).hexdigest())
+
+    def test_partial_last_block(self):
+        self.assert_md5(get_random_data(self.backend.block_size + 10))
+
+    def test_full_last_block(self):
+        self.assert_md5(get_random_data(2 * self.backend.block_size))
+
+    def test_single_block(self):
+        self.assert_md5(get_random_data(10))
+
+    def test_empty(self):
+        hashmap = [self.backend.put_block('')]
+        self.assertEqual(hashmap_md5(self.backend, hashmap, 0),
+                         hashlib.md5().hexdigest())
+
+    def test_known_checksum(self):
+        data = get_random_data(10)
+        hashmap = self.put_data(data)
+        self.backend.update_object_hashmap(
+            'account', 'account', 'container', 'object', len(data),
+            'application/octet-stream', hashmap, 'known', 'pithos')
+        self.assertEqual(hashmap_md5(self.backend, hashmap, len(data)),
+                         'known')
+        # Another size of the same data is not known
+        self.assertEqual(hashmap_md5(self.backend, hashmap, 5),
+                         hashlib.md5(data[:5]).hexdigest())
+
+    def test_known_empty_checksum(self):
+        self.backend.update_object_hashmap(
+            'account', 'account', 'container', 'object', 0,
+            'application/octet-stream', [], 'known', 'pithos')
+        self.assertEqual(self.backend.get_hashmap_checksum(0, []), 'known')
+
+
+
+def split_chunks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+class TestReadHashmap(unittest.TestCase):
+    hashlen = 32
+
+    def setUp(self):
+        self.hashes = [hashlib.sha256(str(i)).hexdigest() for i in range(5)]
+
+    def assert_hashmap(self, read, data, size, hashes):
+        # Every possible split of tokens across chunks
+        for chunk_size in range(1, len(data) + 1):
+            chunks = split_chunks(data, chunk_size)
+            rsize, rhashes = read(chunks, self.hashlen)
+            self.assertEqual(rsize, size)
+            self.assertEqual(list(rhashes), hashes)
+
+    def assert_invalid(self, read, data):
+        for chunk_size in range(1, len(data) + 1):
+            chunks = split_chunks(data, chunk_size)
+            self.assertRaises(Exception, read, chunks, self.hashlen)
+
+    def test_json(self):
+        data = '{"block_hash": "sha256", "hashes": [%s], "bytes": 12345}' % (
+            ', '.join('"%s"' % h for h in self.hashes))
+        self.assert_hashmap(read_json_hashmap, data, 12345, self.hashes)
+
+    def test_json_whitespace(self):
+        data = '\n {\t"bytes" :\r\n 7 ,\n "hashes" :[ \n%s\n ] } \n' % (
+            ' ,\n'.join('"%s"' % h for h in self.hashes))
+        self.assert_hashmap(read_json_hashmap, data, 7, self.hashes)
+
+    def test_json_escapes(self):
+        first = ''.join('\\u%04x' % ord(c) for c in self.hashes[0])
+        data = ('{"ha\\u0073hes": ["%s", "%s"], "name": "a \\"b\\" ]}",'
+                ' "bytes": 1}' % (first, self.hashes[1]))
+        self.assert_hashmap(read_json_hashmap, data, 1, self.hashes[:2])
+
+    def test_json_other_values(self):
+        data = ('{"extra": {"hashes": ["00"], "list": [1, 2.5e3, null]},'
+                ' "bytes": 3, "hashes": ["%s"], "flag": true}' %
+                self.hashes[0].upper())
+        self.assert_hashmap(read_json_hashmap, data, 3, self.hashes[:1])
+
+    def test_json_empty(self):
+        self.assert_hashmap(read_json_hashmap, '{"bytes": 0, "hashes": []}',
+                            0, [])
+
+    def test_json_malformed(self):
+        h = self.hashes[0]
+        for data in ['',
+                     '[]',
+                     '{}',
+                     '{"bytes": 1}',
+                     '{"hashes": ["%s"]}' % h,
+                     '{"bytes": 1, "hashes": ["%s"]' % h,
+                     '{"bytes": 1, "hashes": ["%s"' % h,
+                     '{"bytes": 1, "hashes": ["%s"]} {}' % h,
+                     '{"bytes": 1, "hashes": ["%s",]}' % h,
+                     '{"bytes": 1 "hashes": ["%s"]}' % h,
+                     '{"bytes": 1, "hashes": ["%s"]}' % h[:-2],
+                     '{"bytes": 1, "hashes": ["%sx"]}' % h[:-1],
+                     '{"bytes": 1, "hashes": [%s]}' % h,
+                     '{"bytes": "x", "hashes": []}']:
+            self.assert_invalid(read_json_hashmap, data)
+
+    def test_xml(self):
+        data = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<object name="o" bytes="12345" block_size="4194304"'
+                ' block_hash="sha256">\n%s</object>\n' %
+                ''.join('  <hash>%s</hash>\n' % h for h in self.hashes))
+        self.assert_hashmap(read_xml_hashmap, data, 12345, self.hashes)
+
+    def test_xml_whitespace(self):
+        data = '<object bytes="7"><hash>\n  %s\n</hash></object>' % (
+            self.hashes[0])
+        self.assert_hashmap(read_xml_hashmap, data, 7, self.hashes[:1])
+
+    def test_xml_empty(self):
+        self.assert_hashmap(read_xml_hashmap, '<object bytes="0"></object>',
+                            0, [])
+
+    def test_xml_malformed(self):
+        h = self.hashes[0]
+        for data in ['',
+                     '<object></object>',
+                     '<other bytes="1"><hash>%s</hash></other>' % h,
+                     '<object bytes="1"><hash>%s</hash>' % h,
+                     '<object bytes="1"><hash>%s</hash></object>' % h[:-2],
+                     '<object bytes="1"><hash>%sx</hash></object>' % h[:-1],
+                     '<object bytes="x"></object>']:
+            self.assert_invalid(read_xml_hashmap, data)
+
+
+class TestBackendPoolLimit(unittest.TestCase):
+    def test_service_unavailable(self):
+        @api_method('GET', token_required=False, user_required=False)
+        def view(request):
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        with patch('pithos.api.util._pithos_backend_pool') as pool:
+            pool.pool_get.side_effect = PoolLimitError()
+            response = view(request)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(pool.pool_get.call_count, 1)
+
+        with patch('pithos.api.util._pithos_backend_pool') as pool:
+            response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(pool.pool_get.return_value.close.call_count, 1)
+
+
+class TestObjectFileWrapper(BackendTestCase):
+    def setUp(self):
+        super(TestObjectFileWrapper, self).setUp()
+        self.backend.block_size = 16
+        self.files = [os.urandom(40), os.urandom(32), os.urandom(5)]
+        self.data = ''.join(self.files)
+        self.sizes = [len(f) for f in self.files]
+        self.hashmaps = [self.put_data(f) for f in self.files]
+
+    def wrapper(self, offset, length):
+        return ObjectFileWrapper(self.backend, offset, length, self.sizes,
+                                 self.hashmaps)
+
+    def test_ranges(self):
+        size = len(self.data)
+        for offset in xrange(size):
+            for length in xrange(1, size - offset + 1):
+                wrapper = self.wrapper(offset, length)
+                self.assertEqual(''.join(wrapper),
+                                 self.data[offset:offset + length])
+
+    def test_chunks(self):
+        chunks = list(self.wrapper(0, len(self.data)))
+        self.assertEqual([len(c) for c in chunks], [16, 16, 8, 16, 16, 5])
+
+    def test_read(self):
+        wrapper = self.wrapper(10, 50)
+        self.assertEqual(wrapper.read(3), self.data[10:13])
+        self.assertEqual(wrapper.read(), self.data[13:16])
+        self.assertEqual(wrapper.read(100), self.data[16:32])
+        data = ''.join(iter(lambda: wrapper.read(7), ''))
+        self.assertEqual(data, self.data[32:60])
+        self.assertEqual(wrapper.read(), '')
+        self.assertTrue(wrapper.file is None)
+
+    def test_close(self):
+        wrapper = self.wrapper(0, len(self.data))
+        wrapper.read(1)
+        f = wrapper.file
+        wrapper.close()
+        self.assertTrue(f.closed)
+        self.assertEqual(wrapper.read(), '')
+
+    def test_empty_block(self):
+        empty = hashlib.new(self.backend.hash_algorithm).hexdigest()
+        wrapper = ObjectFileWrapper(self.backend, 2, 10, [12], [[empty]])
+        self.assertEqual(''.join(wrapper), '\x00' * 10)
+
+
+class TestCloseHashmaps(BackendTestCase):
+    def setUp(self):
+        super(TestCloseHashmaps, self).setUp()
+        self.backend.block_size = 16
+        self.data = os.urandom(40)
+        self.backend.update_object_hashmap(
+            'account', 'account', 'container', 'object', len(self.data),
+            'application/octet-stream', self.put_data(self.data), '',
+            'pithos')
+
+    def get_hashmap(self):
+        return self.backend.get_object_hashmap(
+            'account', 'account', 'container', 'object')
+
+    def assert_closed(self, hashmap):
+        self.assertRaises(ValueError, list, hashmap)
+
+    def test_close(self):
+        size, hashmap = self.get_hashmap()
+        hashes = list(hashmap)
+        close_hashmaps([hashes, hashmap])
+        self.assert_closed(hashmap)
+        self.assertEqual(len(hashes), 3)
+
+    def test_object_wrapper(self):
+        size, hashmap = self.get_hashmap()
+        wrapper = ObjectWrapper(self.backend, [(5, 30)], [size], [hashmap],
+                                '')
+        self.assertEqual(''.join(wrapper), self.data[5:35])
+        wrapper.close()
+        self.assert_closed(hashmap)
+
+    def test_object_file_wrapper(self):
+        size, hashmap = self.get_hashmap()
+        wrapper = ObjectFileWrapper(self.backend, 5, 30, [size], [hashmap])
+        self.assertEqual(wrapper.read(10), self.data[5:15])
+        wrapper.close()
+        self.assert_closed(hashmap)
+
+
+class TestBlockUploader(BackendTestCase):
+    def setUp(self):
+        super(TestBlockUploader, self).setUp()
+        self.backend.block_size = 16
+        self.data = os.urandom(16 * 20 + 3)
+
+    def upload(self, threads):
+        with patch('pithos.api.util.UPLOAD_THREADS', threads):
+            with patch('pithos.api.util._thread_pools', {}):
+                uploader = BlockUploader(self.backend)
+                try:
+                    for i in xrange(0, len(self.data), 16):
+                        uploader.put(self.data[i:i + 16])
+                        self.assertTrue(len(uploader.pending) < threads)
+                    return uploader.finish()
+                finally:
+                    uploader.close()
+
+    def test_upload(self):
+        for threads in (1, 2, 4):
+            size, hashmap, checksum = self.upload(threads)
+            self.assertEqual(size, len(self.data))
+            self.assertEqual(hashmap, self.put_data(self.data))
+            self.assertEqual(checksum, hashlib.md5(self.data).hexdigest())
+
+    def test_shared_pool(self):
+        with patch('pithos.api.util.UPLOAD_THREADS', 2):
+            with patch('pithos.api.util._thread_pools', {}):
+                pool = BlockUploader(self.backend).pool
+                self.assertTrue(BlockUploader(self.backend).pool is pool)
+
+    def test_close(self):
+        with patch('pithos.api.util.UPLOAD_THREADS', 4):
+            with patch('pithos.api.util._thread_pools', {}):
+                uploader = BlockUploader(self.backend)
+                with patch.object(self.backend, 'put_block') as put_block:
+                    put_block.side_effect = ValueError
+                    uploader.put('data')
+                    uploader.put('more data')
+                    uploader.close()
+                self.assertEqual(put_block.call_count, 2)
+                self.assertEqual(len(uploader.pending), 0)
+
+
+
+class TestRangeBlocks(unittest.TestCase):
+    def setUp(self):
+        self.block_size = 4
+        self.sizes = [10, 3, 0, 8, 4]
+        self.hashmaps = [['a0', 'a1', 'a2'], ['b0'], [], ['c0', 'c1'],
+                         ['d0']]
+        # The block and offset in the block of each byte of the object.
+        self.bytes = []
+        for size, hashmap in zip(self.sizes, self.hashmaps):
+            self.bytes.extend((hashmap[i / self.block_size],
+                               i % self.block_size) for i in xrange(size))
+
+    def range_blocks(self, offset, length):
+        return list(range_blocks(self.block_size, offset, length,
+                                 self.sizes, self.hashmaps))
+
+    def test_ranges(self):
+        size = sum(self.sizes)
+        for offset in xrange(size):
+            for length in xrange(size - offset + 1):
+                parts = self.range_blocks(offset, length)
+                self.assertEqual(
+                    [(h, bo + i) for h, bo, bl in parts for i in xrange(bl)],
+                    self.bytes[offset:offset + length])
+                for h, bo, bl in parts:
+                    self.assertTrue(bl > 0)
+                    self.assertTrue(bo + bl <= self.block_size)
+                # Parts only break at block and file boundaries.
+                for (h, bo, bl), (n, no, nl) in zip(parts, parts[1:]):
+                    self.assertTrue(h != n or no != bo + bl)
+
+    def test_boundaries(self):
+        self.assertEqual(self.range_blocks(2, 4),
+                         [('a0', 2, 2), ('a1', 0, 2)])
+        self.assertEqual(self.range_blocks(8, 6),
+                         [('a2', 0, 2), ('b0', 0, 3), ('c0', 0, 1)])
+        self.assertEqual(self.range_blocks(13, 12),
+                         [('c0', 0, 4), ('c1', 0, 4), ('d0', 0, 4)])
+        self.assertEqual(self.range_blocks(24, 1), [('d0', 3, 1)])
+        self.assertEqual(self.range_blocks(0, 0), [])
+
+    def test_block_hashes(self):
+        hashes = ranges_block_hashes(self.block_size,
+                                     [(2, 4), (5, 11), (24, 1), (0, 1)],
+                                     self.sizes, self.hashmaps)
+        self.assertEqual(list(hashes),
+                         ['a0', 'a1', 'a2', 'b0', 'c0', 'd0', 'a0'])
+
+
+class FakeBlockBackend(object):
+    block_size = 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.requested = []
+        self.done = []
+
+    def get_block(self, hash):
+        with self.lock:
+            self.requested.append(hash)
+        self.gate.wait()
+        with self.lock:
+            self.done.append(hash)
+        return 'block ' + hash
+
+
+class TestBlockPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeBlockBackend()
+        self.hashes = ['h%d' % i for i in xrange(10)]
+        patcher = patch('pithos.api.util._thread_pools', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prefetcher(self, depth, max_bytes=1000):
+        return BlockPrefetcher(self.backend, self.hashes, depth, max_bytes)
+
+    def test_order(self):
+        for depth in (1, 2, 3, 20):
+            self.backend.requested = []
+            prefetcher = self.prefetcher(depth)
+            for i, h in enumerate(self.hashes):
+                self.assertEqual(prefetcher.get_block(h), 'block ' + h)
+                self.assertTrue(len(prefetcher.pending) <= depth)
+                self.assertTrue(prefetcher.index <= i + 1 + depth)
+            self.assertEqual(sorted(self.backend.requested),
+                             sorted(self.hashes))
+            self.assertEqual(len(prefetcher.pending), 0)
+
+    def test_lazy_hashes(self):
+        consumed = []
+
+        def hashes():
+            for h in self.hashes:
+                consumed.append(h)
+                yield h
+
+        prefetcher = BlockPrefetcher(self.backend, hashes(), 2, 1000)
+        self.assertEqual(consumed, [])
+        self.assertEqual(prefetcher.get_block('h0'), 'block h0')
+        self.assertEqual(consumed, ['h0', 'h1', 'h2'])
+        prefetcher.close()
+        self.assertEqual(consumed, ['h0', 'h1', 'h2'])
+
+    def test_depth(self):
+        self.assertEqual(self.prefetcher(5).depth, 5)
+        self.assertEqual(self.prefetcher(5, 8).depth, 2)
+        self.assertEqual(self.prefetcher(5, 3).depth, 1)
+        self.assertEqual(self.prefetcher(0).depth, 1)
+
+    def test_out_of_sequence(self):
+        prefetcher = self.prefetcher(3)
+        self.assertEqual(prefetcher.get_block('h0'), 'block h0')
+        self.assertEqual(prefetcher.get_block('h5'), 'block h5')
+        self.assertEqual(prefetcher.get_block('h6'), 'block h6')
+        self.assertEqual(len(prefetcher.pending), 0)
+        # h0 to h3 were read ahead, the rest directly.
+        self.assertEqual(sorted(self.backend.requested),
+                         ['h0', 'h1', 'h2', 'h3', 'h5', 'h6'])
+
+    def test_close_waits(self):
+        prefetcher = self.prefetcher(3)
+        self.backend.gate.clear()
+        prefetcher._fill()  # h0 to h2 are in flight.
+        closer = threading.Thread(target=prefetcher.close)
+        closer.start()
+        closer.join(0.2)
+        self.assertTrue(closer.is_alive())
+        self.assertEqual(self.backend.done, [])
+        self.backend.gate.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        self.assertEqual(sorted(self.backend.done), ['h0', 'h1', 'h2'])
+        self.assertEqual(len(prefetcher.pending), 0)
+        # Nothing is read ahead after closing.
+        self.assertEqual(prefetcher.get_block('h3'), 'block h3')
+        self.assertEqual(len(self.backend.requested), 4)
+
+
+class TestObjectWrapperPrefetch(BackendTestCase):
+    def setUp(self):
+        super(TestObjectWrapperPrefetch, self).setUp()
+        self.backend.block_size = 16
+        self.files = [os.urandom(40), os.urandom(16), os.urandom(7)]
+        self.data = ''.join(self.files)
+        self.sizes = [len(f) for f in self.files]
+        self.hashmaps = [self.put_data(f) for f in self.files]
+
+    def read(self, ranges, depth):
+        with patch('pithos.api.util.PREFETCH_DEPTH', depth):
+            with patch('pithos.api.util._thread_pools', {}):
+                wrapper = ObjectWrapper(self.backend, ranges, self.sizes,
+                                        self.hashmaps, 'boundary')
+                try:
+                    return ''.join(wrapper)
+                finally:
+                    wrapper.close()
+
+    def test_ranges(self):
+        size = len(self.data)
+        for ranges in ([(0, size)], [(15, 2)], [(10, 40)], [(39, 20)],
+                       [(0, 5), (30, 20)], [(20, 10), (5, 10), (50, 13)]):
+            data = self.read(ranges, 0)
+            if len(ranges) == 1:
+                offset, length = ranges[0]
+                self.assertEqual(data, self.data[offset:offset + length])
+            for depth in (1, 2, 8):
+                self.assertEqual(self.read(ranges, depth), data)
+
+
+class TestListingPages(BackendTestCase):
+    def setUp(self):
+        super(TestListingPages, self).setUp()
+        self.names = ['a', 'b/1', 'b/2', 'b/3', 'c', 'd/x/1', 'd/x/2',
+                      'd/y', 'e', 'f/1', 'g', 'h', 'i/1', 'i/2', 'j']
+        for name in self.names:
+            self.backend.update_object_hashmap(
+                'account', 'account', 'container', name, 0,
+                'application/octet-stream', [], '', 'pithos')
+
+    def list_page(self, delimiter):
+        def list_page(backend, marker, limit):
+            self.requested.append(limit)
+            return self.backend.list_object_meta(
+                'account', 'account', 'container', '', delimiter, marker,
+                limit)
+        return list_page
+
+    def marker_of(self, meta):
+        return meta.get('name', meta.get('subdir'))
+
+    def listing(self, delimiter, limit):
+        return self.backend.list_object_meta(
+            'account', 'account', 'container', '', delimiter, None, limit)
+
+    def pages(self, delimiter, limit, page_size):
+        self.requested = []
+        list_page = self.list_page(delimiter)
+        first = list_page(self.backend, None, min(limit, page_size))
+        with patch('pithos.api.util.get_backend') as get_backend:
+            pages = list(listing_pages(list_page, first, self.marker_of,
+                                       limit, page_size))
+        self.assertEqual(get_backend.call_count,
+                         1 if len(self.requested) > 1 else 0)
+        self.assertEqual(get_backend.return_value.close.call_count,
+                         get_backend.call_count)
+        return pages
+
+    def test_pages(self):
+        for delimiter in (None, '/'):
+            for limit in xrange(1, len(self.names) + 2):
+                for page_size in xrange(1, limit + 1):
+                    pages = self.pages(delimiter, limit, page_size)
+                    listing = self.listing(delimiter, limit)
+                    self.assertEqual(sum(pages, []), listing)
+                    for page in pages[:-1]:
+                        self.assertEqual(len(page), page_size)
+                    self.assertTrue(max(self.requested) <= page_size)
+
+    def test_page_over_limit(self):
+        listing = self.listing(None, 100)
+
+        def list_page(backend, marker, limit):
+            # Return more entries than requested.
+            names = [m['name'] for m in listing]
+            start = names.index(marker) + 1 if marker else 0
+            return listing[start:start + limit + 2]
+
+        for limit in xrange(1, len(listing) + 1):
+            with patch('pithos.api.util.get_backend'):
+                pages = list(listing_pages(list_page,
+                                           list_page(None, None, 3),
+                                           self.marker_of, limit, 3))
+            self.assertEqual(sum(pages, []), listing[:limit])
+
+    def test_empty(self):
+        self.assertEqual(list(listing_pages(None, [], self.marker_of, 10,
+                                            3)), [])
+
+    def test_json(self):
+        for delimiter in (None, '/'):
+            for limit in (1, 4, 7, 100):
+                listing = self.listing(delimiter, limit)
+                for page_size in (1, 3, 5):
+                    pages = self.pages(delimiter, limit, page_size)
+                    data = ''.join(json_object_list(pages, dict))
+                    expected = json.dumps(listing,
+                                          default=json_encode_decimal)
+                    self.assertEqual(json.loads(data), json.loads(expected))
+        self.assertEqual(''.join(json_object_list([], dict)), '[]')
+
+    def xml_children(self, data):
+        def elements(node):
+            return [n for n in node.childNodes
+                    if n.nodeType == n.ELEMENT_NODE]
+
+        container = minidom.parseString(data).documentElement
+        self.assertEqual(container.getAttribute('name'), 'container')
+        # The order of the fields of an object is that of a dict.
+        return [(e.tagName, e.getAttribute('name'),
+                 sorted(c.toxml() for c in elements(e)))
+                for e in elements(container)]
+
+    def test_xml(self):
+        for delimiter in (None, '/'):
+            for limit in (1, 4, 7, 100):
+                listing = self.listing(delimiter, limit)
+                data = render_to_string('objects.xml',
+                                        {'container': 'container',
+                                         'objects': listing})
+                expected = self.xml_children(data)
+                self.assertEqual(len(expected), len(listing))
+                for page_size in (1, 3, 5):
+                    pages = self.pages(delimiter, limit, page_size)
+                    data = ''.join(xml_object_list('container', pages, dict))
+                    self.assertEqual(self.xml_children(data), expected)
+        data = ''.join(xml_object_list('container', [], dict))
+        self.assertEqual(self.xml_children(data), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -34,6 +34,11 @@
 from functools import wraps
 from datetime import datetime
 from urllib import quote, unquote
+from collections import deque
+from itertools import chain, islice
+from threading import Event, Lock
+from multiprocessing.pool import ThreadPool
+from xml.parsers import expat
 
 from django.http import (HttpResponse, HttpResponseRedirect, Http404,
                          HttpResponseForbidden)
@@ -52,22 +57,33 @@ from snf_django.lib.api import faults, utils
 from pithos.api.settings import (BACKEND_DB_MODULE, BACKEND_DB_CONNECTION,
                                  BACKEND_BLOCK_MODULE, BACKEND_BLOCK_PATH,
                                  BACKEND_BLOCK_UMASK,
+                                 BACKEND_BLOCK_CACHE_SIZE,
+                                 BACKEND_BLOCK_PING_THREADS,
                                  BACKEND_QUEUE_MODULE, BACKEND_QUEUE_HOSTS,
                                  BACKEND_QUEUE_EXCHANGE,
+                                 BACKEND_QUEUE_BACKLOG,
                                  ASTAKOSCLIENT_POOLSIZE,
                                  SERVICE_TOKEN,
                                  ASTAKOS_BASE_URL,
                                  BACKEND_ACCOUNT_QUOTA, BACKEND_CONTAINER_QUOTA,
                                  BACKEND_VERSIONING,
                                  BACKEND_FREE_VERSIONING, BACKEND_POOL_SIZE,
+                                 BACKEND_POOL_TIMEOUT, BACKEND_POOL_WARMUP,
+                                 BACKEND_POOL_HEALTH_INTERVAL,
                                  RADOS_STORAGE, RADOS_POOL_BLOCKS,
                                  RADOS_POOL_MAPS, TRANSLATE_UUIDS,
+                                 DIRECT_BLOCK_READS, PREFETCH_DEPTH,
+                                 PREFETCH_MAX_BYTES, PREFETCH_THREADS,
+                                 UPLOAD_THREADS, CHECKSUM_THREADS,
                                  PUBLIC_URL_SECURITY,
                                  PUBLIC_URL_ALPHABET,
                                  COOKIE_NAME, BASE_HOST, LOGIN_URL)
 from pithos.api.resources import resources
 from pithos.backends.base import (NotAllowedError, QuotaError, ItemNotExists,
                                   VersionNotExists)
+from pithos.backends.hashlist import HashList, HexHashList
+
+from objpool import PoolLimitError
 
 from synnefo.lib import join_urls
 
@@ -77,6 +93,7 @@ from astakosclient.errors import NoUserName, NoUUID
 import logging
 import re
 import hashlib
+import binascii
 import uuid
 import decimal
 
@@ -89,6 +106,12 @@ def json_encode_decimal(obj):
     raise TypeError(repr(obj) + " is not JSON serializable")
 
 
+def json_encode_hashmap(obj):
+    if isinstance(obj, HexHashList):
+        return list(obj)
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
 def rename_meta_key(d, old, new):
     if old not in d:
         return
@@ -762,6 +785,229 @@ def socket_read_iterator(request, length=0, blocksize=4096):
             yield data
 
 
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+_json_hex_string = re.compile(r'"([0-9a-fA-F]*)"')
+
+
+class _JSONHashmapReader(object):
+    """Incrementally parse a JSON hashmap read in chunks.
+
+    Only the values of the top level object other than 'hashes' are
+    decoded as a whole. The hashes are converted to digests as they
+    are read, so that neither the body nor its parse tree are kept.
+    """
+
+    def __init__(self, chunks, hashlen):
+        self.chunks = iter(chunks)
+        self.hashlen = hashlen
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        try:
+            chunk = self.chunks.next()
+        except StopIteration:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        # Skip whitespace and return the next character ('' at the end).
+        while True:
+            self.pos = _json_whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ''
+
+    def _next(self, expected):
+        c = self._peek()
+        if c not in expected:
+            raise ValueError('Unexpected character')
+        self.pos += 1
+        return c
+
+    def _complete(self, end):
+        # A value is complete only if followed by something, since
+        # numbers may continue in the next chunk.
+        return end < len(self.buf) or self.eof
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            if self._complete(end) or not self._more():
+                self.pos = end
+                return value
+
+    def _hash(self):
+        self._peek()
+        while True:
+            m = _json_hex_string.match(self.buf, self.pos)
+            if m is not None and self._complete(m.end()):
+                self.pos = m.end()
+                value = m.group(1)
+                break
+            if ((m is None and len(self.buf) - self.pos > 2 * self.hashlen + 2)
+                    or not self._more()):
+                # Not a plain hex string.
+                value = self._value()
+                break
+        digest = binascii.unhexlify(value)
+        if len(digest) != self.hashlen:
+            raise ValueError('Invalid hash length')
+        return digest
+
+    def read(self):
+        size = None
+        hashes = None
+        self._next('{')
+        if self._peek() != '}':
+            while True:
+                key = self._value()
+                self._next(':')
+                if key == 'hashes':
+                    hashes = bytearray()
+                    self._next('[')
+                    if self._peek() == ']':
+                        self.pos += 1
+                    else:
+                        while True:
+                            hashes.extend(self._hash())
+                            if self._next(',]') == ']':
+                                break
+                else:
+                    value = self._value()
+                    if key == 'bytes':
+                        size = int(value)
+                if self._next(',}') == '}':
+                    break
+        else:
+            self.pos += 1
+        if self._peek() != '' or size is None or hashes is None:
+            raise ValueError('Invalid hashmap')
+        return size, HashList(str(hashes), self.hashlen).hex()
+
+
+def read_json_hashmap(chunks, hashlen):
+    """Parse a JSON hashmap from the given data chunks.
+
+    Return the size and the hashes of the object.
+    """
+    return _JSONHashmapReader(chunks, hashlen).read()
+
+
+def read_xml_hashmap(chunks, hashlen):
+    """Parse an XML hashmap from the given data chunks.
+
+    Return the size and the hashes of the object.
+    """
+    state = {'size': None, 'hash': None}
+    hashes = bytearray()
+
+    def start_element(name, attrs):
+        if name == 'object' and state['size'] is None:
+            state['size'] = int(attrs['bytes'])
+        elif name == 'hash':
+            state['hash'] = []
+
+    def end_element(name):
+        if name == 'hash':
+            digest = binascii.unhexlify(''.join(state['hash']).strip())
+            if len(digest) != hashlen:
+                raise ValueError('Invalid hash length')
+            hashes.extend(digest)
+            state['hash'] = None
+
+    def char_data(data):
+        if state['hash'] is not None:
+            state['hash'].append(data)
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = char_data
+    for chunk in chunks:
+        parser.Parse(chunk, False)
+    parser.Parse('', True)
+    if state['size'] is None:
+        raise ValueError('Invalid hashmap')
+    return state['size'], HashList(str(hashes), hashlen).hex()
+
+
+class BlockUploader(object):
+    """Store the blocks of an upload while the next ones are being read.
+
+    Blocks are hashed and stored on a thread pool shared by the process,
+    keeping at most UPLOAD_THREADS blocks in flight. The MD5 of the data
+    is updated on the same pool, each update waiting for the one of the
+    previous block, and the hashmap preserves the order of the blocks.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pool = get_thread_pool('upload', UPLOAD_THREADS)
+        self.depth = UPLOAD_THREADS
+        self.pending = deque()
+        self.hashmap = []
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.md5_done = None
+
+    def _update_md5(self, previous, done, data):
+        # The pool runs tasks in the order they are queued, so the previous
+        # update has already been picked up by another thread. Results of
+        # the pool only wake up a single waiter, hence the events.
+        try:
+            if previous is not None:
+                previous.wait()
+            self.md5.update(data)
+        finally:
+            done.set()
+
+    def _wait(self):
+        block, md5 = self.pending.popleft()
+        md5.get()
+        self.hashmap.append(block.get())
+
+    def put(self, data):
+        self.size += len(data)
+        block = self.pool.apply_async(self.backend.put_block, (data,))
+        done = Event()
+        md5 = self.pool.apply_async(self._update_md5,
+                                    (self.md5_done, done, data))
+        self.md5_done = done
+        self.pending.append((block, md5))
+        while len(self.pending) >= self.depth:
+            self._wait()
+
+    def close(self):
+        """Wait for the blocks in flight, so that the backend is no longer
+        used when it is closed."""
+        while self.pending:
+            block, md5 = self.pending.popleft()
+            block.wait()
+            md5.wait()
+
+    def finish(self):
+        """Wait for all blocks to be stored.
+
+        Return the size, the hashmap and the MD5 checksum of the data.
+        """
+        while self.pending:
+            self._wait()
+        return self.size, self.hashmap, self.md5.hexdigest().lower()
+
+
 class SaveToBackendHandler(FileUploadHandler):
     """Handle a file from an HTML form the django way."""
 
@@ -799,6 +1045,110 @@ class SaveToBackendHandler(FileUploadHandler):
         return self.file
 
 
+def close_hashmaps(hashmaps):
+    """Release the memory maps holding the hashmaps read from the backend."""
+
+    for hashmap in hashmaps:
+        close = getattr(hashmap, 'close', None)
+        if close is not None:
+            close()
+
+
+def range_blocks(block_size, offset, length, sizes, hashmaps):
+    """Split a range of the object's data in (block hash, offset in block,
+    length) parts, for the object made of the given files.
+
+    The parts are generated as they are needed, so that the walk over a
+    large object does not hold all of them in memory.
+    """
+
+    file_index = 0
+    while length > 0:
+        file_size = sizes[file_index]
+        if offset >= file_size:
+            offset -= file_size
+            file_index += 1
+            continue
+        bo = offset % block_size
+        bl = min(length, block_size - bo, file_size - offset)
+        yield hashmaps[file_index][offset / block_size], bo, bl
+        offset += bl
+        length -= bl
+
+
+def ranges_block_hashes(block_size, ranges, sizes, hashmaps):
+    """Generate the hashes of the blocks read for the given ranges of the
+    object, in order, skipping the repeats of the same block."""
+
+    last = None
+    for offset, length in ranges:
+        for h, bo, bl in range_blocks(block_size, offset, length, sizes,
+                                      hashmaps):
+            if h != last:
+                yield h
+                last = h
+
+
+_thread_pools = {}
+_thread_pools_lock = Lock()
+
+
+def get_thread_pool(name, size):
+    """Return the named thread pool of the process.
+
+    Pools are created lazily, so that they are not inherited across
+    forks of the worker processes.
+    """
+    with _thread_pools_lock:
+        pool = _thread_pools.get(name)
+        if pool is None:
+            pool = _thread_pools[name] = ThreadPool(size)
+        return pool
+
+
+class BlockPrefetcher(object):
+    """Read the blocks of an object ahead of time.
+
+    Given the block hashes that will be requested, as an iterable that is
+    consumed only as far as reading ahead requires, keep up to depth
+    upcoming blocks (and at most max_bytes of data) in flight on a thread
+    pool shared by the process, and return them in order.
+    """
+
+    def __init__(self, backend, hashes, depth, max_bytes):
+        self.backend = backend
+        self.hashes = iter(hashes)
+        self.depth = max(1, min(depth, max_bytes / backend.block_size))
+        self.index = 0
+        self.pending = deque()
+
+    def _fill(self):
+        pool = get_thread_pool('prefetch', PREFETCH_THREADS)
+        for h in islice(self.hashes, self.depth - len(self.pending)):
+            self.index += 1
+            self.pending.append(
+                (h, pool.apply_async(self.backend.get_block, (h,))))
+
+    def get_block(self, hash):
+        self._fill()
+        if not self.pending or self.pending[0][0] != hash:
+            # Out of sequence, stop reading ahead.
+            self.close()
+            return self.backend.get_block(hash)
+        h, result = self.pending.popleft()
+        block = result.get()
+        self._fill()
+        return block
+
+    def close(self):
+        """Stop reading ahead and wait for the blocks in flight, so that
+        the backend is no longer used by the pool when it is closed."""
+        self.hashes = iter(())
+        while self.pending:
+            h, result = self.pending.popleft()
+            result.wait()
+
+
 class ObjectWrapper(object):
     """Return the object's data block-per-block in each iteration.
 
@@ -822,9 +1172,29 @@ class ObjectWrapper(object):
         self.range_index = -1
         self.offset, self.length = self.ranges[0]
 
+        self.prefetcher = None
+        if PREFETCH_DEPTH > 0:
+            hashes = ranges_block_hashes(backend.block_size, ranges, sizes,
+                                         hashmaps)
+            first = list(islice(hashes, 2))
+            if len(first) > 1:
+                self.prefetcher = BlockPrefetcher(
+                    backend, chain(first, hashes), PREFETCH_DEPTH,
+                    PREFETCH_MAX_BYTES)
+
     def __iter__(self):
         return self
 
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        close_hashmaps(self.hashmaps)
+
+    def get_block(self, hash):
+        if self.prefetcher is not None:
+            return self.prefetcher.get_block(hash)
+        return self.backend.get_block(hash)
+
     def part_iterator(self):
         if self.length > 0:
             # Get the file for the current offset.
@@ -841,7 +1211,7 @@ class ObjectWrapper(object):
                 self.block_hash = self.hashmaps[
                     self.file_index][self.block_index]
                 try:
-                    self.block = self.backend.get_block(self.block_hash)
+                    self.block = self.get_block(self.block_hash)
                 except ItemNotExists:
                     raise faults.ItemNotFound('Block does not exist')
 
@@ -892,8 +1262,89 @@ class ObjectWrapper(object):
                 return '\r\n'.join(out)
 
 
+class ObjectFileWrapper(object):
+    """Return the data of a single range of the object.
+
+    The data is read directly from the block files of the backend, in
+    chunks of at most one block, without padding and slicing whole blocks.
+    Reads bypass the block cache of the backend and are not read ahead;
+    the page cache serves repeated reads of the same blocks.
+    """
+
+    def __init__(self, backend, offset, length, sizes, hashmaps):
+        self.backend = backend
+        self.parts = range_blocks(backend.block_size, offset, length, sizes,
+                                  hashmaps)
+        self.part = next(self.parts, None)
+        self.hashmaps = hashmaps
+        self.remaining = 0
+        self.file = None
+        self.data = None
+        self.data_offset = 0
+
+    def _next_part(self):
+        self._close_file()
+        hash, bo, bl = self.part
+        self.part = next(self.parts, None)
+        self.remaining = bl
+        path = self.backend.get_block_path(hash)
+        if path is not None:
+            self.file = open(path, 'rb')
+            self.file.seek(bo)
+            return
+        # Not stored in a plain file (e.g. the empty block).
+        try:
+            self.data = self.backend.get_block(hash)
+        except ItemNotExists:
+            raise faults.ItemNotFound('Block does not exist')
+        self.data_offset = bo
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.data = None
+
+    def read(self, size=-1):
+        while self.remaining == 0:
+            if self.part is None:
+                self._close_file()
+                return ''
+            self._next_part()
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if self.file is not None:
+            data = self.file.read(size)
+            if len(data) < size:
+                # Blocks are stored unpadded.
+                data += '\x00' * (size - len(data))
+        else:
+            data = self.data[self.data_offset:self.data_offset + size]
+            self.data_offset += size
+        self.remaining -= size
+        return data
+
+    def close(self):
+        self._close_file()
+        self.part = None
+        self.remaining = 0
+        close_hashmaps(self.hashmaps)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.read(self.backend.block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+
 def object_data_response(request, sizes, hashmaps, meta, public=False):
-    """Get the HttpResponse object for replying with the object's data."""
+    """Get the HttpResponse object for replying with the object's data.
+
+    The hashmaps are closed when the response is.
+    """
 
     # Range handling.
     size = sum(sizes)
@@ -907,6 +1358,7 @@ def object_data_response(request, sizes, hashmaps, meta, public=False):
                  offset < 0 or offset >= size or
                  offset + length > size]
         if len(check) > 0:
+            close_hashmaps(hashmaps)
             raise faults.RangeNotSatisfiable(
                 'Requested range exceeds object limits')
         ret = 206
@@ -927,7 +1379,13 @@ def object_data_response(request, sizes, hashmaps, meta, public=False):
         boundary = uuid.uuid4().hex
     else:
         boundary = ''
-    wrapper = ObjectWrapper(request.backend, ranges, sizes, hashmaps, boundary)
+    if DIRECT_BLOCK_READS and not RADOS_STORAGE and len(ranges) == 1:
+        offset, length = ranges[0]
+        wrapper = ObjectFileWrapper(request.backend, offset, length, sizes,
+                                    hashmaps)
+    else:
+        wrapper = ObjectWrapper(request.backend, ranges, sizes, hashmaps,
+                                boundary)
     response = HttpResponse(wrapper, status=ret)
     put_object_headers(
         response, meta, restricted=public,
@@ -960,20 +1418,112 @@ def put_object_block(request, hashmap, data, offset):
 
 
 def hashmap_md5(backend, hashmap, size):
-    """Produce the MD5 sum from the data in the hashmap."""
+    """Produce the MD5 sum from the data in the hashmap.
 
-    # TODO: Search backend for the MD5 of another object
-    #       with the same hashmap and size...
+    The sum of another object with the same hashmap and size is reused,
+    if the backend knows one, instead of reading the data back.
+    """
+
+    checksum = backend.get_hashmap_checksum(size, hashmap)
+    if checksum:
+        return checksum
     md5 = hashlib.md5()
     bs = backend.block_size
     for bi, hash in enumerate(hashmap):
         data = backend.get_block(hash)  # Blocks come in padded.
         if bi == len(hashmap) - 1:
-            data = data[:size % bs]
+            data = data[:size - bi * bs]
         md5.update(data)
     return md5.hexdigest().lower()
 
 
+def _update_object_md5(user, account, container, name, version, size,
+                       hashmap):
+    backend = get_backend()
+    path = '/'.join((account, container, name))
+    try:
+        meta = backend.get_object_meta(user, account, container, name,
+                                       'pithos', version)
+        if meta['checksum'] == '':
+            checksum = hashmap_md5(backend, hashmap, size)
+            backend.update_object_checksum(user, account, container, name,
+                                           version, checksum)
+    except Exception:
+        logger.exception('Can not update checksum for path "%s"', path)
+    finally:
+        backend.close()
+
+
+def update_object_md5(user, account, container, name, version, size,
+                      hashmap):
+    """Compute and store the MD5 sum of an object version in the background.
+
+    The checksum threads are shared by the process and use their own
+    backend instances, so the request does not wait for the data
+    to be read back.
+    """
+
+    pool = get_thread_pool('checksum', CHECKSUM_THREADS)
+    pool.apply_async(_update_object_md5, (user, account, container, name,
+                                          version, size, hashmap))
+
+
+def listing_pages(list_page, first, marker_of, limit, page_size):
+    """Yield the pages of a listing, up to limit entries in total.
+
+    The first page is given, the next ones are requested with the marker
+    of the last entry of the previous page, from a backend of their own,
+    as they are streamed after the request's backend has been closed.
+    A page may hold more entries than requested, so the last one is cut
+    at the limit.
+    """
+
+    page = first
+    backend = None
+    try:
+        while page:
+            if len(page) >= limit:
+                yield page[:limit]
+                break
+            marker = marker_of(page[-1])
+            yield page
+            limit -= len(page)
+            if len(page) < page_size:
+                break
+            if backend is None:
+                backend = get_backend()
+            page = list_page(backend, marker, min(page_size, limit))
+    finally:
+        if backend is not None:
+            backend.close()
+
+
+def json_object_list(pages, format_meta):
+    """Serialize the pages of an object listing as a JSON list."""
+
+    yield '['
+    sep = ''
+    for page in pages:
+        yield sep + ', '.join(json.dumps(format_meta(meta),
+                                         default=json_encode_decimal)
+                              for meta in page)
+        sep = ', '
+    yield ']'
+
+
+def xml_object_list(container, pages, format_meta):
+    """Serialize the pages of an object listing as XML."""
+
+    data = render_to_string('objects.xml', {'container': container,
+                                            'objects': ()})
+    end = data.rindex('</container>')
+    yield data[:end]
+    for page in pages:
+        yield render_to_string('object_items.xml',
+                               {'objects': [format_meta(m) for m in page]})
+    yield data[end:]
+
+
 def simple_list_response(request, l):
     if request.serialization == 'text':
         return '\n'.join(l) + '\n'
@@ -991,6 +1541,8 @@ if RADOS_STORAGE:
 else:
     BLOCK_PARAMS = {'mappool': None,
                     'blockpool': None, }
+BLOCK_PARAMS['block_cache_size'] = BACKEND_BLOCK_CACHE_SIZE
+BLOCK_PARAMS['ping_threads'] = BACKEND_BLOCK_PING_THREADS
 
 
 _pithos_backend_pool = PithosBackendPool(
@@ -1003,6 +1555,7 @@ _pithos_backend_pool = PithosBackendPool(
         queue_module=BACKEND_QUEUE_MODULE,
         queue_hosts=BACKEND_QUEUE_HOSTS,
         queue_exchange=BACKEND_QUEUE_EXCHANGE,
+        queue_backlog=BACKEND_QUEUE_BACKLOG,
         astakos_url=ASTAKOS_BASE_URL,
         service_token=SERVICE_TOKEN,
         astakosclient_poolsize=ASTAKOSCLIENT_POOLSIZE,
@@ -1012,7 +1565,10 @@ _pithos_backend_pool = PithosBackendPool(
         public_url_alphabet=PUBLIC_URL_ALPHABET,
         account_quota_policy=BACKEND_ACCOUNT_QUOTA,
         container_quota_policy=BACKEND_CONTAINER_QUOTA,
-        container_versioning_policy=BACKEND_VERSIONING)
+        container_versioning_policy=BACKEND_VERSIONING,
+        timeout=BACKEND_POOL_TIMEOUT,
+        warmup=BACKEND_POOL_WARMUP,
+        health_interval=BACKEND_POOL_HEALTH_INTERVAL)
 
 
 def get_backend():
@@ -1078,7 +1634,11 @@ def api_method(http_method=None, token_required=True, user_required=True, logger
 
             try:
                 # Add a PithosBackend as attribute of the request object
-                request.backend = get_backend()
+                try:
+                    request.backend = get_backend()
+                except PoolLimitError:
+                    raise faults.ServiceUnavailable(
+                        'Service busy, try again later')
                 # Many API method expect thet X-Auth-Token in request,token
                 request.token = request.x_auth_token
                 update_request_headers(request)
@@ -449,6 +449,25 @@ class BaseBackend(object):
         """
         return {}
 
+    def get_object_permissions_bulk(self, user, account, container, names):
+        """Return a dictionary mapping each of the object names given to
+        the tuple get_object_permissions would return for it.
+
+        Raises:
+            NotAllowedError: Operation not permitted
+
+            ItemNotExists: Container/object does not exist
+        """
+        return {}
+
+    def can_read_many(self, user, paths):
+        """Return the list of object paths given that the user can read.
+
+        Raises:
+            ValueError: Invalid object path
+        """
+        return []
+
     def update_object_permissions(self, user, account, container, name, permissions):
         """Update (set) the permissions associated with the object.
 
@@ -488,7 +507,7 @@ class BaseBackend(object):
         return
 
     def get_object_hashmap(self, user, account, container, name, version=None):
-        """Return the object's size and a list with partial hashes.
+        """Return the object's size and a sequence with partial hashes.
 
         Raises:
             NotAllowedError: Operation not permitted
@@ -526,6 +545,11 @@ class BaseBackend(object):
         """Update an object's checksum."""
         return
 
+    def get_hashmap_checksum(self, size, hashmap):
+        """Return the checksum of another object with the same size and
+           hashmap, or None if there is no such object with a checksum."""
+        return None
+
     def copy_object(self, user, src_account, src_container, src_name, dest_account, dest_container, dest_name, type, domain, meta=None, replace_meta=False, permissions=None, src_version=None, delimiter=None):
         """Copy an object's data and metadata and return the new version.
 
@@ -629,6 +653,14 @@ class BaseBackend(object):
         """
         return ''
 
+    def get_block_path(self, hash):
+        """Return the path of the file holding a block's data, if any.
+
+        The file contains the block's data unpadded. Return None if
+        the block is not stored in a plain file.
+        """
+        return None
+
     def put_block(self, data):
         """Store a block and return the hash."""
         return 0
@@ -0,0 +1,159 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from binascii import hexlify, unhexlify
+from itertools import imap
+
+
+class HashList(object):
+    """A compact sequence of block hashes.
+
+    The hashes are kept as a single string of concatenated binary digests,
+    instead of a list of strings. Any object that supports len() and
+    slicing into strings (e.g. a memory map) can stand for the string.
+    Items are the binary digests; hex() returns a view of the same hashes
+    as hex strings.
+    """
+
+    def __init__(self, digests='', hashlen=32):
+        if len(digests) % hashlen:
+            raise ValueError('Digests length is not a multiple of %d' % (
+                hashlen,))
+        self.digests = digests
+        self.hashlen = hashlen
+
+    @classmethod
+    def from_digests(cls, digests, hashlen=32):
+        return cls(''.join(digests), hashlen)
+
+    @classmethod
+    def from_hex(cls, hashes, hashlen=32):
+        if isinstance(hashes, HexHashList):
+            return hashes.hashlist
+        digests = []
+        append = digests.append
+        for h in hashes:
+            d = unhexlify(h)
+            if len(d) != hashlen:
+                raise ValueError('Invalid hash length')
+            append(d)
+        return cls(''.join(digests), hashlen)
+
+    def __len__(self):
+        return len(self.digests) / self.hashlen
+
+    def __getitem__(self, i):
+        l = self.hashlen
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self.from_digests(
+                    [self[x] for x in xrange(start, stop, step)], l)
+            return self.__class__(self.digests[start * l:max(start, stop) * l],
+                                  l)
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError('HashList index out of range')
+        return self.digests[i * l:(i + 1) * l]
+
+    def __iter__(self):
+        digests = self.digests
+        l = self.hashlen
+        for i in xrange(0, len(digests), l):
+            yield digests[i:i + l]
+
+    def __eq__(self, other):
+        if isinstance(other, HashList):
+            return (self.hashlen == other.hashlen and
+                    self.digests[:] == other.digests[:])
+        return NotImplemented
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
+
+    def __repr__(self):
+        return '<%s: %d hashes>' % (self.__class__.__name__, len(self))
+
+    def hex(self):
+        """Return a view of the hashes as hex strings."""
+        return HexHashList(self)
+
+    def close(self):
+        """Release the memory map holding the hashes, if any.
+        The hashes can not be accessed afterwards."""
+        close = getattr(self.digests, 'close', None)
+        if close is not None:
+            close()
+
+
+class HexHashList(object):
+    """A read-only view of a HashList as a sequence of hex strings.
+
+    Hex strings are only created when items are accessed.
+    """
+
+    def __init__(self, hashlist):
+        self.hashlist = hashlist
+
+    def __len__(self):
+        return len(self.hashlist)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return HexHashList(self.hashlist[i])
+        return hexlify(self.hashlist[i])
+
+    def __iter__(self):
+        return imap(hexlify, self.hashlist)
+
+    def __eq__(self, other):
+        if isinstance(other, HexHashList):
+            return self.hashlist == other.hashlist
+        return NotImplemented
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
+
+    def __repr__(self):
+        return '<HexHashList: %d hashes>' % len(self)
+
+    def close(self):
+        self.hashlist.close()
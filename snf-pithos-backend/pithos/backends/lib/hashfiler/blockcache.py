@@ -0,0 +1,108 @@
+# Copyright 2011-2012 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class BlockCache(object):
+    """A thread-safe LRU cache of blocks bounded by total size in bytes.
+
+       Blocks are content-addressed by their hash, so cached entries
+       never need to be invalidated.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, hash):
+        with self._lock:
+            block = self._blocks.pop(hash, None)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks[hash] = block
+            self.hits += 1
+            return block
+
+    def put(self, hash, block):
+        l = len(block)
+        if l > self.size:
+            return
+        with self._lock:
+            old = self._blocks.pop(hash, None)
+            if old is not None:
+                self.bytes -= len(old)
+            while self._blocks and self.bytes + l > self.size:
+                h, b = self._blocks.popitem(last=False)
+                self.bytes -= len(b)
+                self.evictions += 1
+            self._blocks[hash] = block
+            self.bytes += l
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return a dictionary with the cache counters."""
+        with self._lock:
+            return {'size': self.size,
+                    'bytes': self.bytes,
+                    'blocks': len(self._blocks),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def get_block_cache(path, size):
+    """Return the cache for the block store at path.
+
+       All stores of a process that use the same path share one cache.
+    """
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = BlockCache(size)
+        return cache
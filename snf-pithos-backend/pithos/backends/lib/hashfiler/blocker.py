@@ -82,6 +82,27 @@ class Blocker(object):
         """Retrieve blocks from storage by their hashes."""
         return self.fblocker.block_retr(hashes)
 
+    def block_path(self, blkhash):
+        """Return the path of the file holding a block, if any."""
+        return self.fblocker.block_path(blkhash)
+
+    def block_list(self):
+        """Yield (hash, path) for all the blocks in file storage,
+           in ascending order of hash.
+        """
+        return self.fblocker.block_list()
+
+    def block_delete(self, blkhash, older_than=None):
+        """Remove a block from storage.
+           If older_than is given, the block is only removed from file
+           storage if it was not modified after that time.
+           Return if it was removed from file storage.
+        """
+        removed = self.fblocker.block_delete(blkhash, older_than)
+        if self.rblocker and (removed or older_than is None):
+            self.rblocker.block_delete(blkhash)
+        return removed
+
     def block_stor(self, blocklist):
         """Store a bunch of blocks and return (hashes, missing).
            Hashes is a list of the hashes of the blocks,
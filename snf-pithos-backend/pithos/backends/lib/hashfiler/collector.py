@@ -0,0 +1,269 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from heapq import merge
+from os import stat
+from tempfile import TemporaryFile
+from time import time
+
+
+# Number of hashes kept in memory before a sorted run is written out.
+RUN_SIZE = 1000000
+
+# Number of unreferenced maps or blocks checked against the
+# recently created versions at a time, before being removed.
+SWEEP_BATCH = 10000
+
+# Files modified during the last GRACE seconds are never removed,
+# so that blocks uploaded for objects not yet created are spared.
+GRACE = 86400
+
+
+class SortedHashes(object):
+    """A set of fixed length hashes, iterated in ascending order,
+       that keeps a bounded number of them in memory.
+
+       Hashes are collected up to run_size at a time; full runs are
+       sorted and written out to temporary files, which are merged
+       back when iterating.
+    """
+
+    def __init__(self, hashlen, run_size=RUN_SIZE, tmpdir=None):
+        self.hashlen = hashlen
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self._hashes = set()
+        self._runs = []
+
+    def add(self, hash):
+        self._hashes.add(hash)
+        if len(self._hashes) >= self.run_size:
+            self._flush()
+
+    def update(self, hashes):
+        for h in hashes:
+            self.add(h)
+
+    def _flush(self):
+        f = TemporaryFile(dir=self.tmpdir)
+        f.write(''.join(sorted(self._hashes)))
+        self._runs.append(f)
+        self._hashes = set()
+
+    def _read_run(self, f):
+        hashlen = self.hashlen
+        chunksize = hashlen * 4096
+        f.seek(0)
+        while 1:
+            data = f.read(chunksize)
+            if not data:
+                return
+            for i in xrange(0, len(data), hashlen):
+                yield data[i:i + hashlen]
+
+    def __iter__(self):
+        runs = [self._read_run(f) for f in self._runs]
+        runs.append(iter(sorted(self._hashes)))
+        last = None
+        for h in merge(*runs):
+            if h != last:
+                yield h
+                last = h
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+        self._hashes = set()
+
+
+def unreferenced(stored, referenced):
+    """Yield the (hash, path) items of stored, whose hash is not
+       in referenced. Both must be in ascending order of hash.
+    """
+    referenced = iter(referenced)
+    r = next(referenced, None)
+    for h, path in stored:
+        while r is not None and r < h:
+            r = next(referenced, None)
+        if r != h:
+            yield h, path
+
+
+class BlockCollector(object):
+    """Mark and sweep garbage collector for the maps and blocks of a Store.
+
+       The maps of all the versions are read once, to collect the hashes
+       of the blocks they reference. Referenced hashes are kept as sorted
+       runs on disk and merged against the (sorted) listings of the store,
+       so that memory use does not grow with the number of blocks.
+
+       Versions may be created while collecting, by transactions that
+       commit after their maps were listed. Their maps and blocks are
+       spared in three ways: the store refreshes the modification time
+       of the maps and blocks that it is asked to store again, files
+       modified during the grace period are never removed, and just
+       before removing anything the maps of the versions modified
+       during the grace period are looked up again.
+    """
+
+    def __init__(self, store, hashlen, run_size=RUN_SIZE, tmpdir=None,
+                 grace=GRACE):
+        self.store = store
+        self.hashlen = hashlen
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.grace = grace
+
+    def collect(self, map_hashes, recent_map_hashes, map_referenced=None,
+                dry_run=True):
+        """Remove the maps and blocks not referenced by any version.
+
+           map_hashes iterates over the hashes of the maps of all versions.
+           recent_map_hashes is called with a time before removing
+           anything, to return the hashes of the maps of the versions
+           modified since then, whose maps and blocks are spared.
+           map_referenced, if given, is called with the hash of each map
+           just before removing it, to check if a version references it.
+           If dry_run is set, nothing is removed.
+           Return a dictionary with the counts and bytes of the maps
+           and blocks found, unreferenced and reclaimed (or reclaimable).
+        """
+        report = {'dry_run': dry_run}
+        for kind in ('maps', 'blocks'):
+            for k in ('referenced', 'stored', 'unreferenced', 'spared',
+                      'reclaimed', 'reclaimed_bytes'):
+                report['%s_%s' % (kind, k)] = 0
+        report['maps_missing'] = 0
+
+        self.limit = time() - self.grace
+        self.spared = set()
+        self.recent_map_hashes = recent_map_hashes
+        self.map_referenced = map_referenced
+        maps = SortedHashes(self.hashlen, self.run_size, self.tmpdir)
+        blocks = SortedHashes(self.hashlen, self.run_size, self.tmpdir)
+        try:
+            maps.update(map_hashes)
+            for h in maps:
+                try:
+                    hashes = self.store.map_get(h)
+                except IOError:
+                    hashes = None
+                if not hashes:
+                    report['maps_missing'] += 1
+                    continue
+                try:
+                    blocks.update(hashes)
+                finally:
+                    hashes.close()
+
+            self._sweep('maps', self.store.map_list(), maps,
+                        self.store.map_remove, report, dry_run)
+            self._sweep('blocks', self.store.block_list(), blocks,
+                        self.store.block_remove, report, dry_run)
+        finally:
+            maps.close()
+            blocks.close()
+        return report
+
+    def _spare_map(self, h):
+        """Spare a map and the blocks it references."""
+        if h in self.spared:
+            return
+        self.spared.add(h)
+        try:
+            hashes = self.store.map_get(h)
+        except IOError:
+            return
+        try:
+            self.spared.update(hashes)
+        finally:
+            hashes.close()
+
+    def _update_spared(self):
+        for h in self.recent_map_hashes(self.limit):
+            self._spare_map(h)
+
+    def _is_spared(self, kind, h, path):
+        if h in self.spared:
+            return True
+        if kind == 'maps' and self.map_referenced is not None:
+            if self.map_referenced(h):
+                return True
+        try:
+            return stat(path).st_mtime > self.limit
+        except OSError:
+            return True
+
+    def _sweep(self, kind, stored, referenced, remove, report, dry_run):
+        def counted(items, key):
+            for item in items:
+                report[key] += 1
+                yield item
+
+        referenced = counted(referenced, '%s_referenced' % kind)
+        stored = counted(stored, '%s_stored' % kind)
+        batch = []
+        for h, path in unreferenced(stored, referenced):
+            report['%s_unreferenced' % kind] += 1
+            try:
+                st = stat(path)
+            except OSError:
+                continue
+            if st.st_mtime > self.limit:
+                report['%s_spared' % kind] += 1
+                if kind == 'maps':
+                    self._spare_map(h)
+                continue
+            batch.append((h, path, st.st_size))
+            if len(batch) >= SWEEP_BATCH:
+                self._remove(kind, batch, remove, report, dry_run)
+                batch = []
+        if batch:
+            self._remove(kind, batch, remove, report, dry_run)
+        for h in referenced:
+            pass
+
+    def _remove(self, kind, batch, remove, report, dry_run):
+        self._update_spared()
+        for h, path, size in batch:
+            # The store checks the modification time once more,
+            # atomically with respect to refreshing it.
+            if (self._is_spared(kind, h, path) or
+                    (not dry_run and not remove(h, self.limit))):
+                report['%s_spared' % kind] += 1
+                if kind == 'maps':
+                    self._spare_map(h)
+                continue
+            report['%s_reclaimed' % kind] += 1
+            report['%s_reclaimed_bytes' % kind] += size
@@ -31,8 +31,11 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from os import SEEK_CUR, SEEK_SET, fsync
+from os import (SEEK_CUR, SEEK_SET, fsync, fstat, listdir, rename, stat,
+                unlink, utime)
+from os.path import join
 from errno import ENOENT, EROFS
+from mmap import mmap, ACCESS_READ
 
 
 _zeros = ''
@@ -130,6 +133,69 @@ def file_sync_read_chunks(openfile, chunksize, nr, offset=0):
         nr -= 1
 
 
+def file_tree_list(path, depth):
+    """Yield (name, path) for the files at the given depth
+       of a directory tree, in ascending order of name
+       (the directories of each level being prefixes of the names).
+    """
+    try:
+        names = sorted(listdir(path))
+    except OSError:
+        return
+    for name in names:
+        p = join(path, name)
+        if depth:
+            for item in file_tree_list(p, depth - 1):
+                yield item
+        else:
+            yield name, p
+
+
+def file_touch(path):
+    """Set the modification time of a file to the current time.
+       Return False if there is no such file.
+    """
+    try:
+        utime(path, None)
+    except OSError, e:
+        if e.errno != ENOENT:
+            raise
+        return False
+    return True
+
+
+def file_remove_older(path, older_than=None):
+    """Remove a file, unless it was modified after older_than.
+       Return if the file was removed.
+
+       The file is first renamed away, so that it can no longer be
+       touched, and is then checked. A file touched just before being
+       renamed is restored, while touching it afterwards fails as
+       if it did not exist.
+    """
+    if older_than is None:
+        try:
+            unlink(path)
+        except OSError, e:
+            if e.errno != ENOENT:
+                raise
+            return False
+        return True
+
+    removed = path + '.removed'
+    try:
+        rename(path, removed)
+    except OSError, e:
+        if e.errno != ENOENT:
+            raise
+        return False
+    if stat(removed).st_mtime > older_than:
+        rename(removed, path)
+        return False
+    unlink(removed)
+    return True
+
+
 class ContextFile(object):
     __slots__ = ("name", "fdesc", "create")
 
@@ -191,3 +257,14 @@ class ContextFile(object):
 
     def sync_read_chunks(self, chunksize, nr, offset=0):
         return file_sync_read_chunks(self.fdesc, chunksize, nr, offset)
+
+    def sync_mmap(self):
+        """Return a read-only memory map of the file.
+           The map stays valid after the file is closed,
+           until the caller closes it.
+           Empty files cannot be mapped, so return '' for them.
+        """
+        fileno = self.fdesc.fileno()
+        if fstat(fileno).st_size == 0:
+            return ''
+        return mmap(fileno, 0, access=ACCESS_READ)
@@ -31,17 +31,49 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from os import makedirs
+from os import makedirs, listdir
 from os.path import isdir, realpath, exists, join
 from hashlib import new as newhasher
-from binascii import hexlify
+from binascii import hexlify, unhexlify
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 
-from context_file import ContextFile, file_sync_read_chunks
+
+from context_file import (ContextFile, file_sync_read_chunks, file_tree_list,
+                          file_touch, file_remove_older)
+
+
+# Number of threads used to stat block files concurrently.
+PING_THREADS = 8
+# List a block directory instead of stat'ing its entries one by one
+# when at least this many of the checked hashes fall into it.
+PING_LISTDIR_THRESHOLD = 4
+
+_ping_pools = {}
+_ping_pools_lock = Lock()
+
+
+def _get_ping_pool(size):
+    """Return the thread pool of the given size shared by the FileBlockers
+       of the process.
+
+       The pools are created lazily, so that they are not inherited
+       across forks of the worker processes.
+    """
+    pool = _ping_pools.get(size)
+    if pool is None:
+        with _ping_pools_lock:
+            pool = _ping_pools.get(size)
+            if pool is None:
+                pool = _ping_pools[size] = ThreadPool(size)
+    return pool
 
 
 class FileBlocker(object):
     """Blocker.
        Required constructor parameters: blocksize, blockpath, hashtype.
+       Optional ping_threads, the number of threads checking blocks
+       for existence (PING_THREADS by default, 1 or less to disable).
     """
 
     blocksize = None
@@ -73,6 +105,10 @@ class FileBlocker(object):
         self.hashtype = hashtype
         self.hashlen = len(emptyhash)
         self.emptyhash = emptyhash
+        ping_threads = params.get('ping_threads')
+        if ping_threads is None:
+            ping_threads = PING_THREADS
+        self.ping_threads = ping_threads
 
     def _pad(self, block):
         return block + ('\x00' * (self.blocksize - len(block)))
@@ -91,6 +127,57 @@ class FileBlocker(object):
         name = join(dir, filename)
         return exists(name)
 
+    def _check_rear_dir(self, item, touch=False):
+        """Return the hashes of the entries found in the directory.
+
+           If touch is set, the modification time of the blocks found is
+           refreshed, so that the garbage collector spares blocks that
+           are being reused.
+        """
+        dir, entries = item
+        if len(entries) >= PING_LISTDIR_THRESHOLD:
+            try:
+                names = set(listdir(dir))
+            except OSError:
+                return []
+            entries = [(h, filename) for h, filename in entries
+                       if filename in names]
+            if not touch:
+                return [h for h, filename in entries]
+        check = file_touch if touch else exists
+        return [h for h, filename in entries
+                if check(join(dir, filename))]
+
+    def _touch_rear_dir(self, item):
+        return self._check_rear_dir(item, touch=True)
+
+    def _check_rear_blocks(self, hashes, touch=False):
+        """Return the set of the given hashes found in block storage.
+
+           Hashes are grouped by their block directory, so that each
+           directory is visited once, and directories are checked
+           concurrently on a bounded thread pool. If touch is set,
+           the blocks found are touched as well.
+        """
+        dirs = {}
+        for h in set(hashes):
+            filename = hexlify(h)
+            dir = join(self.blockpath,
+                       filename[0:2], filename[2:4], filename[4:6])
+            dirs.setdefault(dir, []).append((h, filename))
+        items = sorted(dirs.iteritems())
+        check = self._touch_rear_dir if touch else self._check_rear_dir
+
+        if len(items) > 1 and self.ping_threads > 1:
+            results = _get_ping_pool(self.ping_threads).map(check, items)
+        else:
+            results = map(check, items)
+
+        found = set()
+        for r in results:
+            found.update(r)
+        return found
+
     def block_hash(self, data):
         """Hash a block of data"""
         hasher = newhasher(self.hashtype)
@@ -100,12 +187,17 @@ class FileBlocker(object):
     def block_ping(self, hashes):
         """Check hashes for existence and
            return those missing from block storage.
+           Blocks found are not touched; the garbage collector spares
+           them once a recently modified version references them.
         """
+        found = self._check_rear_blocks(hashes)
         notfound = []
         append = notfound.append
+        seen = set()
 
         for h in hashes:
-            if h not in notfound and not self._check_rear_block(h):
+            if h not in found and h not in seen:
+                seen.add(h)
                 append(h)
 
         return notfound
@@ -132,6 +224,42 @@ class FileBlocker(object):
 
         return blocks
 
+    def block_path(self, blkhash):
+        """Return the path of the file holding a block, or None
+           if there is no such file. The file holds the block unpadded.
+        """
+        if blkhash == self.emptyhash:
+            return None
+        filename = hexlify(blkhash)
+        name = join(self.blockpath,
+                    filename[0:2], filename[2:4], filename[4:6], filename)
+        if not exists(name):
+            return None
+        return name
+
+    def block_list(self):
+        """Yield (hash, path) for all the blocks in storage,
+           in ascending order of hash.
+        """
+        hexlen = self.hashlen * 2
+        for filename, name in file_tree_list(self.blockpath, 3):
+            if len(filename) != hexlen:
+                continue
+            try:
+                yield unhexlify(filename), name
+            except TypeError:
+                continue
+
+    def block_delete(self, blkhash, older_than=None):
+        """Remove a block from storage, if it is there.
+           If older_than is given, the block is only removed if it
+           was last modified before that time. Return if it was removed.
+        """
+        filename = hexlify(blkhash)
+        name = join(self.blockpath,
+                    filename[0:2], filename[2:4], filename[4:6], filename)
+        return file_remove_older(name, older_than)
+
     def block_stor(self, blocklist):
         """Store a bunch of blocks and return (hashes, missing).
            Hashes is a list of the hashes of the blocks,
@@ -140,10 +268,15 @@ class FileBlocker(object):
         """
         block_hash = self.block_hash
         hashlist = [block_hash(b) for b in blocklist]
-        mf = None
-        missing = [i for i, h in enumerate(hashlist) if not self._check_rear_block(h)]
+        found = self._check_rear_blocks(hashlist, touch=True)
+        missing = [i for i, h in enumerate(hashlist) if h not in found]
+        stored = set()
         for i in missing:
-            with self._get_rear_block(hashlist[i], 1) as rbl:
+            h = hashlist[i]
+            if h in stored:
+                continue
+            stored.add(h)
+            with self._get_rear_block(h, 1) as rbl:
                  rbl.sync_write(blocklist[i]) #XXX: verify?
 
         return hashlist, missing
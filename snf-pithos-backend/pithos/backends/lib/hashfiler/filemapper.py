@@ -31,11 +31,13 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from os import makedirs, unlink
+from os import makedirs
 from os.path import isdir, realpath, exists, join
-from binascii import hexlify
+from binascii import hexlify, unhexlify
 
-from context_file import ContextFile
+from context_file import (ContextFile, file_tree_list, file_touch,
+                          file_remove_older)
+from pithos.backends.hashlist import HashList
 
 
 class FileMapper(object):
@@ -65,30 +67,72 @@ class FileMapper(object):
         name = join(dir, filename)
         return ContextFile(name, create)
 
-    def _check_rear_map(self, maphash):
+    def _get_rear_map_name(self, maphash):
         filename = hexlify(maphash)
-        dir = join(self.mappath, filename[0:2], filename[2:4], filename[4:6])
-        name = join(dir, filename)
-        return exists(name)
+        return join(self.mappath,
+                    filename[0:2], filename[2:4], filename[4:6], filename)
+
+    def _check_rear_map(self, maphash):
+        return exists(self._get_rear_map_name(maphash))
 
     def map_retr(self, maphash, blkoff=0, nr=100000000000000):
-        """Return as a list, part of the hashes map of an object
+        """Return as a HashList, part of the hashes map of an object
            at the given block offset.
-           By default, return the whole hashes map.
+           By default, return the whole hashes map. It is then backed
+           by a memory map of the map file, so that only the hashes
+           actually accessed are read from the disk, and the caller
+           should close it when done.
         """
         namelen = self.namelen
-        hashes = ()
+        digests = ''
 
         with self._get_rear_map(maphash, 0) as rmap:
             if rmap:
-                hashes = list(rmap.sync_read_chunks(namelen, nr, blkoff))
-        return hashes
+                digests = rmap.sync_mmap()
+        start = blkoff * namelen
+        end = start + nr * namelen
+        if start > 0 or end < len(digests):
+            m = digests
+            digests = m[start:end]
+            if m:
+                m.close()
+        try:
+            return HashList(digests, namelen)
+        except ValueError:
+            # A truncated map file.
+            if not isinstance(digests, str):
+                digests.close()
+            raise
 
     def map_stor(self, maphash, hashes=(), blkoff=0, create=1):
         """Store hashes in the given hashes map."""
         namelen = self.namelen
-        if self._check_rear_map(maphash):
+        # Refresh an existing map, so that the garbage collector spares it
+        if file_touch(self._get_rear_map_name(maphash)):
             return
         with self._get_rear_map(maphash, 1) as rmap:
-            rmap.sync_write_chunks(namelen, blkoff, hashes, None)
+            if isinstance(hashes, HashList) and blkoff == 0:
+                rmap.sync_write(hashes.digests)
+            else:
+                rmap.sync_write_chunks(namelen, blkoff, hashes, None)
+
+    def map_list(self):
+        """Yield (hash, path) for all the maps in storage,
+           in ascending order of hash.
+        """
+        hexlen = self.namelen * 2
+        for filename, name in file_tree_list(self.mappath, 3):
+            if len(filename) != hexlen:
+                continue
+            try:
+                yield unhexlify(filename), name
+            except TypeError:
+                continue
 
+    def map_delete(self, maphash, older_than=None):
+        """Remove a map from storage, if it is there.
+           If older_than is given, the map is only removed if it
+           was last modified before that time. Return if it was removed.
+        """
+        return file_remove_older(self._get_rear_map_name(maphash),
+                                 older_than)
@@ -53,7 +53,7 @@ class Mapper(object):
         self.fmap = FileMapper(**params)
 
     def map_retr(self, maphash, blkoff=0, nr=100000000000000):
-        """Return as a list, part of the hashes map of an object
+        """Return as a HashList, part of the hashes map of an object
            at the given block offset.
            By default, return the whole hashes map.
         """
@@ -64,3 +64,20 @@ class Mapper(object):
         if self.rmap:
             self.rmap.map_stor(maphash, hashes, blkoff, create)
         self.fmap.map_stor(maphash, hashes, blkoff, create)
+
+    def map_list(self):
+        """Yield (hash, path) for all the maps in file storage,
+           in ascending order of hash.
+        """
+        return self.fmap.map_list()
+
+    def map_delete(self, maphash, older_than=None):
+        """Remove a map from storage.
+           If older_than is given, the map is only removed from file
+           storage if it was not modified after that time.
+           Return if it was removed from file storage.
+        """
+        removed = self.fmap.map_delete(maphash, older_than)
+        if self.rmap and (removed or older_than is None):
+            self.rmap.map_delete(maphash)
+        return removed
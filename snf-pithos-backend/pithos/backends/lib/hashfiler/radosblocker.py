@@ -130,6 +130,13 @@ class RadosBlocker(object):
 
         return blocks
 
+    def block_delete(self, blkhash):
+        """Remove a block from storage, if it is there."""
+        try:
+            self.ioctx.remove_object(hexlify(blkhash))
+        except ObjectNotFound:
+            pass
+
     def block_stor(self, blocklist):
         """Store a bunch of blocks and return (hashes, missing).
            Hashes is a list of the hashes of the blocks,
@@ -92,3 +92,9 @@ class RadosMapper(object):
         with self._get_rear_map(maphash, 1) as rmap:
             rmap.sync_write_chunks(namelen, blkoff, hashes, None)
 
+    def map_delete(self, maphash):
+        """Remove a map from storage, if it is there."""
+        try:
+            self.ioctx.remove_object(hexlify(maphash))
+        except ObjectNotFound:
+            pass
@@ -35,12 +35,16 @@ import os
 
 from blocker import Blocker
 from mapper import Mapper
+from blockcache import get_block_cache
 
 
 class Store(object):
     """Store.
        Required constructor parameters: path, block_size, hash_algorithm,
        umask, blockpool, mappool.
+       Optional block_cache_size, the size in bytes of the in-memory
+       cache of recently read blocks (disabled by default), and
+       ping_threads, the number of threads checking blocks for existence.
     """
 
     def __init__(self, **params):
@@ -57,13 +61,20 @@ class Store(object):
         p = {'blocksize': params['block_size'],
              'blockpath': os.path.join(path + '/blocks'),
              'hashtype': params['hash_algorithm'],
-             'blockpool': params['blockpool']}
+             'blockpool': params['blockpool'],
+             'ping_threads': params.get('ping_threads')}
         self.blocker = Blocker(**p)
         p = {'mappath': os.path.join(path + '/maps'),
              'namelen': self.blocker.hashlen,
              'mappool': params['mappool']}
         self.mapper = Mapper(**p)
 
+        self.block_cache = None
+        cache_size = params.get('block_cache_size')
+        if cache_size:
+            self.block_cache = get_block_cache(os.path.realpath(path),
+                                               cache_size)
+
     def map_get(self, name):
         return self.mapper.map_retr(name)
 
@@ -71,21 +82,50 @@ class Store(object):
         self.mapper.map_stor(name, map)
 
     def map_delete(self, name):
+        # Maps are shared by all the versions with the same hash,
+        # so they are only removed by the garbage collector.
         pass
 
+    def map_remove(self, name, older_than=None):
+        return self.mapper.map_delete(name, older_than)
+
+    def map_list(self):
+        return self.mapper.map_list()
+
     def block_get(self, hash):
+        cache = self.block_cache
+        if cache is not None:
+            block = cache.get(hash)
+            if block is not None:
+                return block
         blocks = self.blocker.block_retr((hash,))
         if not blocks:
             return None
+        if cache is not None:
+            cache.put(hash, blocks[0])
         return blocks[0]
 
+    def block_path(self, hash):
+        return self.blocker.block_path(hash)
+
     def block_put(self, data):
         hashes, absent = self.blocker.block_stor((data,))
         return hashes[0]
 
+    def block_remove(self, hash, older_than=None):
+        return self.blocker.block_delete(hash, older_than)
+
+    def block_list(self):
+        return self.blocker.block_list()
+
     def block_update(self, hash, offset, data):
         h, e = self.blocker.block_delta(hash, offset, data)
         return h
 
     def block_search(self, map):
         return self.blocker.block_ping(map)
+
+    def block_cache_stats(self):
+        if self.block_cache is None:
+            return None
+        return self.block_cache.stats()
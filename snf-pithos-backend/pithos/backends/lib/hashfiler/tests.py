@@ -0,0 +1,500 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+"""Unit tests for the hashfiler store
+
+Run with:
+    python -m pithos.backends.lib.hashfiler.tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha256
+from time import time
+
+from mock import patch
+
+from pithos.backends.lib.hashfiler.store import Store
+from pithos.backends.lib.hashfiler.collector import (BlockCollector,
+                                                     SortedHashes,
+                                                     unreferenced)
+from pithos.backends.lib.hashfiler.context_file import file_remove_older
+from pithos.backends.lib.hashfiler import (blockcache, context_file,
+                                           fileblocker)
+
+
+BLOCK_SIZE = 16
+
+
+def make_store(path, **params):
+    p = {'path': path,
+         'block_size': BLOCK_SIZE,
+         'hash_algorithm': 'sha256',
+         'umask': None,
+         'blockpool': None,
+         'mappool': None}
+    p.update(params)
+    return Store(**p)
+
+
+def age(path, seconds):
+    """Move the modification time of a file that many seconds back."""
+    t = time() - seconds
+    os.utime(path, (t, t))
+
+
+def mtime(path):
+    return os.stat(path).st_mtime
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = make_store(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def put_map(self, blocks):
+        hashes = [self.store.block_put(b) for b in blocks]
+        maphash = sha256(''.join(hashes)).digest()
+        self.store.map_put(maphash, hashes)
+        return maphash, hashes
+
+    def map_path(self, maphash):
+        return dict(self.store.map_list())[maphash]
+
+
+class SortedHashesTest(unittest.TestCase):
+    def test_runs(self):
+        hashes = [os.urandom(4) for i in range(100)]
+        s = SortedHashes(4, run_size=7)
+        s.update(hashes + hashes[:10])
+        try:
+            self.assertEqual(list(s), sorted(set(hashes)))
+        finally:
+            s.close()
+
+    def test_unreferenced(self):
+        stored = [(h, 'path' + h) for h in 'abcdef']
+        self.assertEqual([h for h, p in unreferenced(stored, 'bdz')],
+                         list('acef'))
+        self.assertEqual(list(unreferenced([], 'abc')), [])
+
+
+class RemoveOlderTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.name = os.path.join(self.path, 'file')
+        open(self.name, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_remove_old(self):
+        age(self.name, 100)
+        self.assertTrue(file_remove_older(self.name, time() - 50))
+        self.assertFalse(os.path.exists(self.name))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_spare_recent(self):
+        self.assertFalse(file_remove_older(self.name, time() - 50))
+        self.assertTrue(os.path.exists(self.name))
+        self.assertEqual(os.listdir(self.path), ['file'])
+
+    def test_missing(self):
+        os.unlink(self.name)
+        self.assertFalse(file_remove_older(self.name, time()))
+        self.assertFalse(file_remove_older(self.name))
+
+
+class TouchTest(StoreTestCase):
+    def test_block_dedup_touches(self):
+        h = self.store.block_put('data')
+        path = self.store.block_path(h)
+        age(path, 1000)
+        self.store.block_put('data')
+        self.assertTrue(mtime(path) > time() - 100)
+
+    def test_block_ping_does_not_touch(self):
+        h = self.store.block_put('data')
+        path = self.store.block_path(h)
+        age(path, 1000)
+        missing = sha256('missing').digest()
+        self.assertEqual(self.store.block_search([h, missing]), [missing])
+        self.assertTrue(mtime(path) < time() - 900)
+
+    def test_map_dedup_touches(self):
+        maphash, hashes = self.put_map(['a', 'b'])
+        path = self.map_path(maphash)
+        age(path, 1000)
+        self.store.map_put(maphash, hashes)
+        self.assertTrue(mtime(path) > time() - 100)
+
+
+class CollectorTest(StoreTestCase):
+    def collect(self, referenced_maps, recent=(), live=(), dry_run=False,
+                grace=100):
+        collector = BlockCollector(self.store, 32, run_size=3, grace=grace)
+        report = collector.collect(iter(referenced_maps),
+                                   lambda since: list(recent),
+                                   lambda h: h in live, dry_run=dry_run)
+        return report
+
+    def age_all(self, seconds=1000):
+        for h, path in self.store.map_list():
+            age(path, seconds)
+        for h, path in self.store.block_list():
+            age(path, seconds)
+
+    def stored_blocks(self):
+        return set(h for h, p in self.store.block_list())
+
+    def stored_maps(self):
+        return set(h for h, p in self.store.map_list())
+
+    def test_collect(self):
+        live, live_blocks = self.put_map(['a', 'b', 'c'])
+        dead, dead_blocks = self.put_map(['c', 'd'])
+        self.age_all()
+        report = self.collect([live])
+        self.assertEqual(self.stored_maps(), set([live]))
+        self.assertEqual(self.stored_blocks(), set(live_blocks))
+        self.assertEqual(report['maps_reclaimed'], 1)
+        self.assertEqual(report['blocks_reclaimed'], 1)
+        self.assertEqual(report['blocks_reclaimed_bytes'], 1)
+        self.assertEqual(report['blocks_referenced'], 3)
+        self.assertEqual(report['blocks_stored'], 4)
+
+    def test_dry_run(self):
+        self.put_map(['a', 'b'])
+        self.age_all()
+        report = self.collect([], dry_run=True)
+        self.assertEqual(report['maps_reclaimed'], 1)
+        self.assertEqual(report['blocks_reclaimed'], 2)
+        self.assertEqual(len(self.stored_maps()), 1)
+        self.assertEqual(len(self.stored_blocks()), 2)
+
+    def test_grace(self):
+        self.put_map(['a', 'b'])
+        report = self.collect([])
+        self.assertEqual(report['maps_spared'], 1)
+        self.assertEqual(report['blocks_spared'], 2)
+        self.assertEqual(len(self.stored_blocks()), 2)
+
+    def test_reused_block_spared(self):
+        # An old unreferenced block reused by an upload is refreshed
+        maphash, hashes = self.put_map(['a', 'b'])
+        self.age_all()
+        self.store.block_put('a')
+        self.collect([])
+        self.assertEqual(self.stored_blocks(), set(hashes[:1]))
+
+    def test_recent_version_spared(self):
+        # A version committed after its map was listed
+        maphash, hashes = self.put_map(['a', 'b'])
+        self.age_all()
+        self.collect([], recent=[maphash])
+        self.assertEqual(self.stored_maps(), set([maphash]))
+        self.assertEqual(self.stored_blocks(), set(hashes))
+
+    def test_referenced_map_spared(self):
+        # A map referenced again just before being removed
+        maphash, hashes = self.put_map(['a', 'b'])
+        self.age_all()
+        report = self.collect([], live=[maphash])
+        self.assertEqual(report['maps_spared'], 1)
+        self.assertEqual(self.stored_maps(), set([maphash]))
+        self.assertEqual(self.stored_blocks(), set(hashes))
+
+    def test_missing_map(self):
+        live, live_blocks = self.put_map(['a'])
+        self.age_all()
+        report = self.collect([live, sha256('missing').digest()])
+        self.assertEqual(report['maps_missing'], 1)
+        self.assertEqual(self.stored_blocks(), set(live_blocks))
+
+
+class BlockPingTest(StoreTestCase):
+    def setUp(self):
+        super(BlockPingTest, self).setUp()
+        self.hashes = [self.store.block_put(str(i)) for i in range(50)]
+        self.missing = [sha256('missing%d' % i).digest() for i in range(50)]
+
+    def ping(self, store, hashes):
+        return store.blocker.fblocker.block_ping(hashes)
+
+    def test_ping(self):
+        hashes = self.hashes + self.missing
+        hashes = hashes[::3] + hashes[::2]
+        expected = []
+        for h in hashes:
+            if h in self.missing and h not in expected:
+                expected.append(h)
+        for threads in (0, 1, 2, 4):
+            store = make_store(self.path, ping_threads=threads)
+            self.assertEqual(self.ping(store, hashes), expected)
+            self.assertEqual(self.ping(store, []), [])
+            self.assertEqual(self.ping(store, self.hashes), [])
+
+    def test_listdir(self):
+        # Hashes sharing a directory are found by listing it.
+        hashes = self.hashes + self.missing
+        for threshold in (1, 4, 1000):
+            with patch.object(fileblocker, 'PING_LISTDIR_THRESHOLD',
+                              threshold):
+                self.assertEqual(self.ping(self.store, hashes), self.missing)
+
+    def test_touch(self):
+        # Pings only check for existence, storing touches the blocks found
+        path = self.store.block_path(self.hashes[0])
+        for threshold in (1, 1000):
+            age(path, 1000)
+            with patch.object(fileblocker, 'PING_LISTDIR_THRESHOLD',
+                              threshold):
+                self.ping(self.store, self.hashes[:1])
+                self.assertTrue(mtime(path) < time() - 900)
+                self.store.blocker.fblocker.block_stor(['0'])
+                self.assertTrue(mtime(path) > time() - 100)
+
+    def test_ping_threads(self):
+        self.assertEqual(self.store.blocker.fblocker.ping_threads,
+                         fileblocker.PING_THREADS)
+        store = make_store(self.path, ping_threads=3)
+        self.assertEqual(store.blocker.fblocker.ping_threads, 3)
+
+    def test_pools(self):
+        # Each size gets its own pool, whichever blocker asks first.
+        stores = [make_store(self.path, ping_threads=n) for n in (2, 3, 2)]
+        with patch.object(fileblocker, '_ping_pools', {}) as pools:
+            for store in stores:
+                self.ping(store, self.hashes)
+            self.assertEqual(sorted(pools), [2, 3])
+            for size, pool in pools.items():
+                self.assertEqual(len(pool._pool), size)
+            self.assertTrue(fileblocker._get_ping_pool(2) is pools[2])
+            with patch.object(fileblocker, 'ThreadPool') as pool:
+                store = make_store(self.path, ping_threads=1)
+                self.ping(store, self.hashes)
+                self.assertEqual(pool.call_count, 0)
+            for pool in pools.values():
+                pool.terminate()
+
+
+class BlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = blockcache.BlockCache(10)
+
+    def blocks(self):
+        return list(self.cache._blocks)
+
+    def test_get(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('a', 'xxx')
+        self.assertEqual(self.cache.get('a'), 'xxx')
+        self.assertEqual(self.cache.bytes, 3)
+
+    def test_evict(self):
+        for h in 'abc':
+            self.cache.put(h, h * 3)
+        self.assertEqual(self.cache.bytes, 9)
+        self.cache.put('d', 'ddd')
+        self.assertEqual(self.blocks(), list('bcd'))
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('e', 'e' * 7)
+        self.assertEqual(self.blocks(), list('de'))
+        self.assertEqual(self.cache.bytes, 10)
+
+    def test_recent(self):
+        for h in 'abc':
+            self.cache.put(h, h * 3)
+        self.cache.get('a')
+        self.cache.put('d', 'ddd')
+        self.assertEqual(self.blocks(), list('cad'))
+        self.cache.put('c', 'ccc')
+        self.cache.put('e', 'eee')
+        self.assertEqual(self.blocks(), list('dce'))
+        self.assertEqual(self.cache.bytes, 9)
+
+    def test_size(self):
+        self.cache.put('a', 'a' * 10)
+        self.assertEqual(self.blocks(), ['a'])
+        self.cache.put('b', 'b' * 11)
+        self.assertEqual(self.blocks(), ['a'])
+        self.assertEqual(self.cache.get('b'), None)
+        self.cache.put('a', 'a' * 4)
+        self.assertEqual(self.cache.bytes, 4)
+        self.cache.put('c', '')
+        self.assertEqual(self.blocks(), ['a', 'c'])
+        self.assertEqual(self.cache.bytes, 4)
+
+    def test_stats(self):
+        self.assertEqual(self.cache.stats(),
+                         {'size': 10, 'bytes': 0, 'blocks': 0, 'hits': 0,
+                          'misses': 0, 'evictions': 0})
+        self.cache.get('a')
+        for h in 'abc':
+            self.cache.put(h, h * 3)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.put('d', 'ddd')
+        self.cache.get('c')
+        self.cache.put('e', 'e' * 10)
+        self.cache.get('x')
+        self.assertEqual(self.cache.stats(),
+                         {'size': 10, 'bytes': 10, 'blocks': 1, 'hits': 2,
+                          'misses': 3, 'evictions': 4})
+
+    def test_clear(self):
+        for h in 'abc':
+            self.cache.put(h, h * 3)
+        self.cache.get('a')
+        self.cache.clear()
+        self.assertEqual(self.blocks(), [])
+        self.assertEqual(self.cache.bytes, 0)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_shared(self):
+        with patch.object(blockcache, '_caches', {}):
+            cache = blockcache.get_block_cache('/path', 10)
+            self.assertTrue(blockcache.get_block_cache('/path', 20) is cache)
+            self.assertEqual(cache.size, 10)
+            self.assertFalse(blockcache.get_block_cache('/other', 10)
+                             is cache)
+
+
+class StoreBlockCacheTest(StoreTestCase):
+    def test_disabled(self):
+        self.assertEqual(self.store.block_cache, None)
+        self.assertEqual(self.store.block_cache_stats(), None)
+        h = self.store.block_put('data')
+        self.assertEqual(self.store.block_get(h),
+                         'data' + '\x00' * (BLOCK_SIZE - 4))
+
+    def test_cached(self):
+        with patch.object(blockcache, '_caches', {}):
+            store = make_store(self.path, block_cache_size=2 * BLOCK_SIZE)
+            hashes = [store.block_put(b) for b in 'abc']
+            retr = store.blocker.block_retr
+            with patch.object(store.blocker, 'block_retr',
+                              wraps=retr) as block_retr:
+                for h in hashes + hashes[1:]:
+                    block = store.block_get(h)
+                    self.assertEqual(len(block), BLOCK_SIZE)
+                self.assertEqual(block_retr.call_count, 3)
+                self.assertEqual(store.block_get(hashes[0]),
+                                 retr([hashes[0]])[0])
+                self.assertEqual(block_retr.call_count, 4)
+            other = make_store(self.path, block_cache_size=2 * BLOCK_SIZE)
+            self.assertTrue(other.block_cache is store.block_cache)
+            self.assertEqual(store.block_cache.bytes, 2 * BLOCK_SIZE)
+            # a, b and c missed, b and c hit, a missed again.
+            self.assertEqual(other.block_cache_stats(),
+                             {'size': 2 * BLOCK_SIZE,
+                              'bytes': 2 * BLOCK_SIZE, 'blocks': 2,
+                              'hits': 2, 'misses': 4, 'evictions': 2})
+
+
+class MapRetrTest(StoreTestCase):
+    def setUp(self):
+        super(MapRetrTest, self).setUp()
+        self.maps = []
+        mmap = context_file.mmap
+
+        def record(*args, **kw):
+            m = mmap(*args, **kw)
+            self.maps.append(m)
+            return m
+
+        patcher = patch.object(context_file, 'mmap', record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_closed(self):
+        for m in self.maps:
+            self.assertRaises(ValueError, len, m)
+
+    def test_whole(self):
+        maphash, hashes = self.put_map(['a', 'b', 'c'])
+        hashlist = self.store.map_get(maphash)
+        self.assertEqual(list(hashlist), hashes)
+        self.assertEqual(len(self.maps), 1)
+        self.assertTrue(hashlist.digests is self.maps[0])
+        hashlist.close()
+        self.assert_closed()
+
+    def test_part(self):
+        maphash, hashes = self.put_map(['a', 'b', 'c'])
+        mapper = self.store.mapper
+        for blkoff, nr in ((0, 1), (1, 1), (1, 2), (2, 5), (3, 1)):
+            hashlist = mapper.map_retr(maphash, blkoff, nr)
+            self.assertEqual(list(hashlist), hashes[blkoff:blkoff + nr])
+            self.assertTrue(isinstance(hashlist.digests, str))
+        self.assertEqual(len(self.maps), 5)
+        self.assert_closed()
+
+    def test_empty(self):
+        maphash = sha256('').digest()
+        self.store.map_put(maphash, [])
+        hashlist = self.store.map_get(maphash)
+        self.assertEqual(len(hashlist), 0)
+        self.assertEqual(list(hashlist), [])
+        hashlist.close()
+        self.assertEqual(self.maps, [])
+        hashlist = self.store.mapper.map_retr(maphash, 1, 1)
+        self.assertEqual(list(hashlist), [])
+
+    def test_truncated(self):
+        maphash, hashes = self.put_map(['a', 'b'])
+        with open(self.map_path(maphash), 'ab') as f:
+            f.write('x')
+        self.assertRaises(ValueError, self.store.map_get, maphash)
+        self.assert_closed()
+
+    def test_collector(self):
+        live, live_blocks = self.put_map(['a', 'b'])
+        recent, recent_blocks = self.put_map(['c'])
+        for h, path in self.store.map_list():
+            age(path, 1000)
+        collector = BlockCollector(self.store, 32, run_size=3, grace=100)
+        collector.collect(iter([live]), lambda since: [recent],
+                          lambda h: False)
+        self.assertEqual(len(self.maps), 2)
+        self.assert_closed()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,12 +32,44 @@
 # or implied, of GRNET S.A.
 
 import json
-from hashlib import sha1
-from random import random
+import logging
+import os
+from itertools import count, groupby
+from threading import Thread, Lock
+from Queue import Queue as SendQueue
 from time import time
+from uuid import uuid4
 
 from synnefo.lib.amqp import AMQPClient
 
+logger = logging.getLogger(__name__)
+
+# Times to reconnect and publish again before giving up on a batch
+PUBLISH_RETRIES = 3
+
+_id_lock = Lock()
+_id_pid = None
+_id_prefix = None
+_id_counter = None
+
+
+def _message_id():
+    """Return a unique message id.
+
+    Ids are a random prefix, drawn once per process, followed by a
+    counter; this is far cheaper than hashing every message.
+    """
+
+    global _id_pid, _id_prefix, _id_counter
+    pid = os.getpid()
+    if pid != _id_pid:
+        with _id_lock:
+            if pid != _id_pid:
+                _id_prefix = uuid4().hex
+                _id_counter = count()
+                _id_pid = pid
+    return '%s%08x' % (_id_prefix, next(_id_counter))
+
 
 class Message(object):
     def __init__(self, client, user, instance, resource, value, details={}):
@@ -50,21 +82,32 @@ class Message(object):
         self.resource = resource
         self.value = value
         self.details = details
-        hash = sha1()
-        hash.update(json.dumps(
-            [client, user, resource, value, details, random()]))
-        self.id = hash.hexdigest()
+        self.id = _message_id()
 
 
 class Queue(object):
     """Queue.
        Required constructor parameters: hosts, exchange, client_id.
+       Optional constructor parameters: backlog.
+
+       If backlog is positive, messages are published by a background
+       thread and send()/send_many() return as soon as the messages are
+       queued. At most backlog batches wait to be published; further
+       sends block until the sender catches up.
+
+       Delivery is at least once: when publishing fails, the client
+       reconnects and publishes the rest of the batch again, up to
+       PUBLISH_RETRIES times, so consumers may see a message twice and
+       should discard duplicates by id. If it still fails, send_many()
+       raises the error when publishing synchronously, while the
+       background sender logs it and drops the batch.
     """
 
     def __init__(self, **params):
         hosts = params['hosts']
         self.exchange = params['exchange']
         self.client_id = params['client_id']
+        backlog = params.get('backlog') or 0
 
         self.client = AMQPClient(hosts=hosts)
         self.client.connect()
@@ -72,12 +115,78 @@ class Queue(object):
         self.client.exchange_declare(exchange=self.exchange,
                                      type='topic')
 
+        self.backlog = None
+        if backlog > 0:
+            self.backlog = SendQueue(backlog)
+            self.sender = Thread(target=self._sender)
+            self.sender.daemon = True
+            self.sender.start()
+
+    def _body(self, user, instance, resource, value, details):
+        return json.dumps(Message(
+            self.client_id, user, instance, resource, value, details).__dict__)
+
     def send(self, message_key, user, instance, resource, value, details):
-        body = Message(
-            self.client_id, user, instance, resource, value, details)
-        self.client.basic_publish(exchange=self.exchange,
-                                  routing_key=message_key,
-                                  body=json.dumps(body.__dict__))
+        self.send_many([(message_key, user, instance, resource, value,
+                         details)])
+
+    def send_many(self, messages):
+        """Publish a list of (message_key, user, instance, resource,
+           value, details) tuples, in order.
+        """
+
+        if not messages:
+            return
+        batch = [(m[0], self._body(*m[1:])) for m in messages]
+        if self.backlog is not None:
+            self.backlog.put(batch)
+        else:
+            self._publish(batch)
+
+    def _publish(self, batch):
+        # Consecutive messages with the same key are published together
+        # and their confirms are awaited once.
+        groups = [(key, [body for k, body in group])
+                  for key, group in groupby(batch, lambda m: m[0])]
+        retries = 0
+        while groups:
+            key, bodies = groups[0]
+            try:
+                self.client.basic_publish_multi(exchange=self.exchange,
+                                                routing_key=key,
+                                                bodies=bodies)
+            except Exception:
+                if retries >= PUBLISH_RETRIES:
+                    raise
+                retries += 1
+                logger.warning('Failed to publish %d messages, retrying',
+                               sum(len(g[1]) for g in groups), exc_info=True)
+                self._reconnect()
+                continue
+            groups.pop(0)
+
+    def _reconnect(self):
+        # Closing would wait for the confirms of the broken connection.
+        try:
+            self.client.connect()
+        except Exception:
+            logger.exception('Failed to reconnect')
+
+    def _sender(self):
+        while True:
+            batch = self.backlog.get()
+            try:
+                if batch is None:
+                    return
+                self._publish(batch)
+            except Exception:
+                logger.exception('Failed to publish %d messages, dropping'
+                                 ' them', len(batch))
+            finally:
+                self.backlog.task_done()
 
     def close(self):
+        if self.backlog is not None:
+            self.backlog.put(None)
+            self.sender.join()
         self.client.close()
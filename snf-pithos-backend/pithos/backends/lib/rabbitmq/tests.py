@@ -0,0 +1,125 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+import json
+import unittest
+
+from mock import patch, call
+
+from pithos.backends.lib.rabbitmq import queue
+from pithos.backends.lib.rabbitmq.queue import Queue
+
+
+def message(key, value):
+    return (key, 'user', 'instance', 'resource', value, {})
+
+
+@patch('pithos.backends.lib.rabbitmq.queue.AMQPClient')
+class QueueTest(unittest.TestCase):
+    def create_queue(self, backlog=0):
+        return Queue(hosts=['amqp://host'], exchange='exchange',
+                     client_id='client', backlog=backlog)
+
+    def published(self, client):
+        return [(c[1]['routing_key'],
+                 [json.loads(b)['value'] for b in c[1]['bodies']])
+                for c in client.basic_publish_multi.call_args_list]
+
+    def test_send_many(self, amqp):
+        client = amqp.return_value
+        q = self.create_queue()
+        q.send_many([message('a', 1), message('a', 2), message('b', 3),
+                     message('a', 4)])
+        self.assertEqual(self.published(client),
+                         [('a', [1, 2]), ('b', [3]), ('a', [4])])
+        q.send_many([])
+        self.assertEqual(client.basic_publish_multi.call_count, 3)
+        q.close()
+
+    def test_message(self, amqp):
+        client = amqp.return_value
+        q = self.create_queue()
+        q.send('key', 'user', 'instance', 'resource', 42, {'path': 'p'})
+        q.send('key', 'user', 'instance', 'resource', 43, {})
+        bodies = [json.loads(c[1]['bodies'][0])
+                  for c in client.basic_publish_multi.call_args_list]
+        self.assertEqual(bodies[0]['clientID'], 'client')
+        self.assertEqual(bodies[0]['userID'], 'user')
+        self.assertEqual(bodies[0]['value'], 42)
+        self.assertEqual(bodies[0]['details'], {'path': 'p'})
+        self.assertNotEqual(bodies[0]['id'], bodies[1]['id'])
+        q.close()
+
+    def test_retry(self, amqp):
+        client = amqp.return_value
+        client.basic_publish_multi.side_effect = [None, Exception(), None]
+        q = self.create_queue()
+        q.send_many([message('a', 1), message('b', 2)])
+        # The published group is not sent again
+        self.assertEqual(self.published(client),
+                         [('a', [1]), ('b', [2]), ('b', [2])])
+        self.assertEqual(client.connect.call_count, 2)
+        q.close()
+
+    def test_failure(self, amqp):
+        client = amqp.return_value
+        client.basic_publish_multi.side_effect = Exception()
+        q = self.create_queue()
+        self.assertRaises(Exception, q.send_many, [message('a', 1)])
+        self.assertEqual(client.basic_publish_multi.call_count,
+                         queue.PUBLISH_RETRIES + 1)
+
+    def test_backlog(self, amqp):
+        client = amqp.return_value
+        q = self.create_queue(backlog=2)
+        for i in range(10):
+            q.send_many([message('a', i)])
+        q.close()
+        self.assertEqual(self.published(client),
+                         [('a', [i]) for i in range(10)])
+        self.assertEqual(client.close.call_args_list, [call()])
+
+    def test_backlog_failure(self, amqp):
+        client = amqp.return_value
+        client.basic_publish_multi.side_effect = \
+            [Exception()] * (queue.PUBLISH_RETRIES + 1) + [None]
+        q = self.create_queue(backlog=2)
+        q.send_many([message('a', 1)])
+        q.send_many([message('a', 2)])
+        q.close()
+        # The first batch is dropped and the sender goes on
+        self.assertEqual(self.published(client)[-1], ('a', [2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
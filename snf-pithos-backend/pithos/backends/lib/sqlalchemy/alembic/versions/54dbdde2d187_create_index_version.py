@@ -0,0 +1,21 @@
+"""create index versions.hash
+
+Revision ID: 54dbdde2d187
+Revises: 3b62b3f1bf6c
+Create Date: 2026-10-18 19:41:26.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '54dbdde2d187'
+down_revision = '3b62b3f1bf6c'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('idx_versions_hash', 'versions', ['hash'])
+
+
+def downgrade():
+    op.drop_index('idx_versions_hash', tablename='versions')
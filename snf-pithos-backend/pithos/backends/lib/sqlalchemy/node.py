@@ -39,7 +39,8 @@ from sqlalchemy import (Table, Integer, BigInteger, DECIMAL, Boolean,
                         Column, String, MetaData, ForeignKey)
 from sqlalchemy.types import Text
 from sqlalchemy.schema import Index, Sequence
-from sqlalchemy.sql import func, and_, or_, not_, null, select, bindparam, text, exists
+from sqlalchemy.sql import (func, and_, or_, not_, null, select, bindparam,
+                            text, exists, case)
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.exc import NoSuchTableError
@@ -58,6 +59,15 @@ ROOTNODE = 0
 
 inf = float('inf')
 
+# Functions returning the position of a substring in a string, used to
+# group paths into virtual directories in the database. Dialects not
+# listed here skip over virtual directories while listing instead.
+_position_functions = {'postgresql': func.strpos,
+                       'mysql': func.instr}
+
+# Rows of a virtual directory skipped, before seeking past it.
+SKIP_SCAN_ROWS = 100
+
 
 def strnextling(prefix):
     """Return the first unicode string
@@ -170,6 +180,7 @@ def create_tables(engine):
     versions = Table('versions', metadata, *columns, mysql_engine='InnoDB')
     Index('idx_versions_node_mtime', versions.c.node, versions.c.mtime)
     Index('idx_versions_node_uuid', versions.c.uuid)
+    Index('idx_versions_hash', versions.c.hash)
 
     #create attributes table
     columns = []
@@ -227,6 +238,15 @@ class Node(DBWorker):
         finally:
             wrapper.commit()
 
+        # Use a native upsert for statistics where available.
+        self._upsert_statistics = None
+        dialect = self.engine.dialect
+        if dialect.name == 'postgresql':
+            if (dialect.server_version_info or ()) >= (9, 5):
+                self._upsert_statistics = self._upsert_statistics_postgresql
+        elif dialect.name == 'mysql':
+            self._upsert_statistics = self._upsert_statistics_mysql
+
     def node_create(self, parent, path):
         """Create a new node from the given properties.
            Return the node identifier of the new node.
@@ -550,32 +570,121 @@ class Node(DBWorker):
            size of objects and mtime in the node's namespace.
            May be zero or positive or negative numbers.
         """
-        s = select([self.statistics.c.population, self.statistics.c.size],
-                   and_(self.statistics.c.node == node,
-                        self.statistics.c.cluster == cluster))
+        self.statistics_update_nodes([node], population, size, mtime, cluster)
+
+    def statistics_update_nodes(self, nodes, population, size, mtime,
+                                cluster=0):
+        """Update the statistics of the given nodes at once.
+           Population is only added to the first node and never
+           drops below zero. Size is added to all nodes.
+        """
+        if not nodes:
+            return
+        if self._upsert_statistics is not None:
+            self._upsert_statistics(nodes, population, size, mtime, cluster)
+            return
+
+        st = self.statistics
+        u = st.update().where(and_(st.c.node.in_(nodes),
+                                   st.c.cluster == cluster))
+        values = {'size': st.c.size + size, 'mtime': mtime}
+        if population:
+            prepopulation = st.c.population + population
+            prepopulation = case([(prepopulation < 0, 0)],
+                                 else_=prepopulation)
+            values['population'] = case([(st.c.node == nodes[0],
+                                          prepopulation)],
+                                        else_=st.c.population)
+        rp = self.conn.execute(u.values(**values))
+        rp.close()
+        if rp.rowcount == len(nodes):
+            return
+
+        s = select([st.c.node], and_(st.c.node.in_(nodes),
+                                     st.c.cluster == cluster))
         rp = self.conn.execute(s)
-        r = rp.fetchone()
+        existing = set(r[0] for r in rp.fetchall())
         rp.close()
-        if not r:
-            prepopulation, presize = (0, 0)
+        rows = [{'node': n, 'population': 0, 'size': size, 'mtime': mtime,
+                 'cluster': cluster} for n in nodes if n not in existing]
+        if rows and rows[0]['node'] == nodes[0]:
+            rows[0]['population'] = max(population, 0)
+        if rows:
+            self.conn.execute(st.insert(), rows).close()
+
+    def _upsert_statistics_sql(self, nodes, population, size, mtime,
+                               cluster, on_conflict):
+        params = {'first': nodes[0], 'population': population,
+                  'size': size, 'mtime': mtime, 'cluster': cluster,
+                  'prepopulation': max(population, 0)}
+        rows = []
+        for i, n in enumerate(nodes):
+            params['node%d' % i] = n
+            rows.append('(:node%d, %s, :size, :mtime, :cluster)' % (
+                        i, ':prepopulation' if i == 0 else '0'))
+        q = ('insert into statistics (node, population, size, mtime, cluster) '
+             'values %s %s' % (', '.join(rows), on_conflict))
+        self.conn.execute(text(q), **params).close()
+
+    def _upsert_statistics_postgresql(self, nodes, population, size, mtime,
+                                      cluster=0):
+        self._upsert_statistics_sql(
+            nodes, population, size, mtime, cluster,
+            'on conflict (node, cluster) do update set '
+            'population = greatest(statistics.population + '
+            'case when statistics.node = :first then :population else 0 end, '
+            '0), '
+            'size = statistics.size + excluded.size, '
+            'mtime = excluded.mtime')
+
+    def _upsert_statistics_mysql(self, nodes, population, size, mtime,
+                                 cluster=0):
+        self._upsert_statistics_sql(
+            nodes, population, size, mtime, cluster,
+            'on duplicate key update '
+            'population = greatest(population + '
+            'case when node = :first then :population else 0 end, 0), '
+            'size = size + values(size), '
+            'mtime = values(mtime)')
+
+    def node_ancestors(self, node, recursion_depth=None):
+        """Return the parents of the given node, from the nearest up to
+           the root or up to ``recursion_depth`` of them (if not None).
+        """
+        if node == ROOTNODE:
+            return []
+        if recursion_depth and recursion_depth <= 0:
+            return []
+        if recursion_depth == 1 or self.engine.name != 'postgresql':
+            ancestors = []
+            while True:
+                if node == ROOTNODE:
+                    break
+                if recursion_depth and recursion_depth <= len(ancestors):
+                    break
+                props = self.node_get_properties(node)
+                if props is None:
+                    break
+                node = props[0]
+                ancestors.append(node)
+            return ancestors
+
+        q = ('with recursive a (node, parent, depth) as ('
+             'select node, parent, 1 from nodes where node = :node '
+             'union all '
+             'select n.node, n.parent, a.depth + 1 '
+             'from nodes n, a where n.node = a.parent and a.parent != :root'
+             '%s) select parent from a order by depth')
+        params = {'node': node, 'root': ROOTNODE}
+        if recursion_depth:
+            q = q % ' and a.depth < :depth'
+            params['depth'] = recursion_depth
         else:
-            prepopulation, presize = r
-        population += prepopulation
-        population = max(population, 0)
-        size += presize
-
-        #insert or replace
-        #TODO better upsert
-        u = self.statistics.update().where(and_(self.statistics.c.node == node,
-                                           self.statistics.c.cluster == cluster))
-        u = u.values(population=population, size=size, mtime=mtime)
-        rp = self.conn.execute(u)
+            q = q % ''
+        rp = self.conn.execute(text(q), **params)
+        rows = rp.fetchall()
         rp.close()
-        if rp.rowcount == 0:
-            ins = self.statistics.insert()
-            ins = ins.values(node=node, population=population, size=size,
-                             mtime=mtime, cluster=cluster)
-            self.conn.execute(ins).close()
+        return [r[0] for r in rows]
 
     def statistics_update_ancestors(self, node, population, size, mtime,
                                     cluster=0, recursion_depth=None):
@@ -585,20 +694,9 @@ class Node(DBWorker):
            Population is not recursive.
         """
 
-        i = 0
-        while True:
-            if node == ROOTNODE:
-                break
-            if recursion_depth and recursion_depth <= i:
-                break
-            props = self.node_get_properties(node)
-            if props is None:
-                break
-            parent, path = props
-            self.statistics_update(parent, population, size, mtime, cluster)
-            node = parent
-            population = 0  # Population isn't recursive
-            i += 1
+        ancestors = self.node_ancestors(node, recursion_depth)
+        self.statistics_update_nodes(ancestors, population, size, mtime,
+                                     cluster)
 
     def statistics_latest(self, node, before=inf, except_cluster=0):
         """Return population, total size and last mtime
@@ -648,7 +746,7 @@ class Node(DBWorker):
         if before != inf:
             c1 = select([func.max(self.versions.c.serial)])
             c1 = c1.where(self.versions.c.mtime < before)
-            c1.where(self.versions.c.node == v.c.node)
+            c1 = c1.where(self.versions.c.node == v.c.node)
         else:
             c1 = select([self.nodes.c.latest_version])
             c1 = c1.where(self.nodes.c.node == v.c.node)
@@ -692,6 +790,61 @@ class Node(DBWorker):
         mtime = max(mtime, r[2])
         return (count, size, mtime)
 
+    def statistics_tree(self, node, cluster=0):
+        """Return population, total size and last mtime
+           for all latest versions under node that belong to the cluster.
+           Unlike statistics_latest, the versions of the grandchildren are
+           not scanned, but taken from the statistics of the children,
+           which must be kept up to date (depth of at least 1). The last
+           mtime also accounts for deletions under the children, which
+           update their statistics.
+        """
+
+        # The latest version.
+        s = select([self.versions.c.mtime])
+        filtered = select([self.nodes.c.latest_version],
+                          self.nodes.c.node == node)
+        s = s.where(and_(self.versions.c.cluster == cluster,
+                         self.versions.c.serial == filtered))
+        r = self.conn.execute(s)
+        props = r.fetchone()
+        r.close()
+        if not props:
+            return None
+        mtime = props[0]
+
+        # First level, just under node (get population).
+        v = self.versions.alias('v')
+        s = select([func.count(v.c.serial),
+                    func.sum(v.c.size),
+                    func.max(v.c.mtime)])
+        c1 = select([self.nodes.c.latest_version])
+        c1 = c1.where(self.nodes.c.node == v.c.node)
+        c2 = select([self.nodes.c.node], self.nodes.c.parent == node)
+        s = s.where(and_(v.c.serial == c1,
+                         v.c.cluster == cluster,
+                         v.c.node.in_(c2)))
+        rp = self.conn.execute(s)
+        r = rp.fetchone()
+        rp.close()
+        count = r[0]
+        if count == 0:
+            return (0, 0, mtime)
+        size = r[1] or 0
+        mtime = max(mtime, r[2])
+
+        # Everything under the first level (get size and mtime).
+        st = self.statistics
+        s = select([func.sum(st.c.size), func.max(st.c.mtime)])
+        s = s.where(and_(st.c.cluster == cluster,
+                         st.c.node.in_(c2)))
+        rp = self.conn.execute(s)
+        r = rp.fetchone()
+        rp.close()
+        size += r[0] or 0
+        mtime = max(mtime, r[1])
+        return (count, size, mtime)
+
     def nodes_set_latest_version(self, node, serial):
         s = self.nodes.update().where(self.nodes.c.node == node)
         s = s.values(latest_version=serial)
@@ -804,6 +957,61 @@ class Node(DBWorker):
             return r
         return [r[propnames[k]] for k in keys if k in propnames]
 
+    def version_lookup_checksum(self, hash, size):
+        """Return a checksum already computed for a version
+           with the given hash and size, or None.
+        """
+
+        v = self.versions
+        s = select([v.c.checksum], and_(v.c.hash == hash,
+                                        v.c.size == size,
+                                        v.c.checksum != ''))
+        s = s.limit(1)
+        r = self.conn.execute(s)
+        row = r.fetchone()
+        r.close()
+        if row:
+            return row[0]
+        return None
+
+    def version_list_hashes(self, after='', limit=10000):
+        """Return up to limit distinct hashes of all versions,
+           greater than after, in ascending order.
+        """
+
+        v = self.versions
+        s = select([v.c.hash], v.c.hash > after).distinct()
+        s = s.order_by(v.c.hash).limit(limit)
+        r = self.conn.execute(s)
+        rows = r.fetchall()
+        r.close()
+        return [row[0] for row in rows]
+
+    def version_list_hashes_since(self, mtime):
+        """Return the distinct hashes of the versions
+           modified at or after the given time.
+        """
+
+        v = self.versions
+        s = select([v.c.hash], and_(v.c.mtime >= mtime,
+                                    v.c.hash > '')).distinct()
+        r = self.conn.execute(s)
+        rows = r.fetchall()
+        r.close()
+        return [row[0] for row in rows]
+
+    def version_lookup_hash(self, hash):
+        """Return the serial of a version with the given hash, or None."""
+
+        v = self.versions
+        s = select([v.c.serial], v.c.hash == hash).limit(1)
+        r = self.conn.execute(s)
+        row = r.fetchone()
+        r.close()
+        if row:
+            return row[0]
+        return None
+
     def version_put_property(self, serial, key, value):
         """Set value for the property of version specified by key."""
 
@@ -1136,6 +1344,13 @@ class Node(DBWorker):
             rp.close()
             return r, ()
 
+        position = _position_functions.get(self.engine.name)
+        if position is not None:
+            return self._latest_version_list_grouped(
+                s, n, prefix, delimiter, start, limit, position)
+
+        # Emulate a skip scan: rows inside a virtual directory are skipped
+        # in the result set, up to SKIP_SCAN_ROWS before seeking past it.
         pfz = len(prefix)
         dz = len(delimiter)
         count = 0
@@ -1143,6 +1358,8 @@ class Node(DBWorker):
         pappend = prefixes.append
         matches = []
         mappend = matches.append
+        pf = None
+        skipped = 0
 
         rp = self.conn.execute(s, start=start)
         while True:
@@ -1150,7 +1367,15 @@ class Node(DBWorker):
             if props is None:
                 break
             path = props[0]
-            serial = props[1]
+            if pf is not None:
+                if path.startswith(pf):
+                    skipped += 1
+                    if skipped >= SKIP_SCAN_ROWS:
+                        rp.close()
+                        rp = self.conn.execute(s, start=strnextling(pf))
+                        pf = None
+                    continue
+                pf = None
             idx = path.find(delimiter, pfz)
 
             if idx < 0:
@@ -1168,10 +1393,48 @@ class Node(DBWorker):
             pappend(pf)
             if count >= limit:
                 break
+            skipped = 0
+        rp.close()
+
+        return matches, prefixes
+
+    def _latest_version_list_grouped(self, s, n, prefix, delimiter, start,
+                                     limit, position):
+        """Return the (matches, prefixes) of a delimited listing
+           with two queries, grouping the common prefixes in the database.
+        """
 
-            rp = self.conn.execute(s, start=strnextling(pf))  # New start.
+        # Paths with the delimiter after the prefix and more after it
+        # are in virtual directories, the rest are listed as matches.
+        pattern = (self.escape_like(prefix) + '%' +
+                   self.escape_like(delimiter) + '%_')
+        in_prefix = n.c.path.like(pattern, escape=ESCAPE_CHAR)
+
+        m = s.where(not_(in_prefix)).limit(limit)
+        rp = self.conn.execute(m, start=start)
+        matches = rp.fetchall()
+        rp.close()
+
+        # Only the prefixes before the last match fit in the listing.
+        p = s.where(in_prefix)
+        if len(matches) >= limit:
+            p = p.where(n.c.path < matches[-1][0])
+        p = p.order_by(None).alias('p')
+        pfz = len(prefix)
+        dz = len(delimiter)
+        idx = position(func.substr(p.c.path, pfz + 1), delimiter)
+        pf = func.substr(p.c.path, 1, pfz + idx + dz - 1)
+        p = select([pf]).distinct().order_by(pf).limit(limit)
+        rp = self.conn.execute(p, start=start)
+        prefixes = [r[0] for r in rp.fetchall()]
         rp.close()
 
+        # Likewise, only the matches up to the last prefix fit, if there
+        # may be more prefixes.
+        if len(prefixes) >= limit:
+            last = prefixes[-1]
+            matches = [m for m in matches if m[0] <= last]
+
         return matches, prefixes
 
     def latest_uuid(self, uuid, cluster):
@@ -125,6 +125,17 @@ class Public(DBWorker):
             return row[0]
         return None
 
+    def public_get_bulk(self, paths):
+        if not paths:
+            return {}
+        s = select([self.public.c.path, self.public.c.url])
+        s = s.where(and_(self.public.c.path.in_(paths),
+                         self.public.c.active == True))
+        r = self.conn.execute(s)
+        rows = r.fetchall()
+        r.close()
+        return dict(rows)
+
     def public_list(self, prefix):
         s = select([self.public.c.path, self.public.c.url])
         s = s.where(self.public.c.path.like(
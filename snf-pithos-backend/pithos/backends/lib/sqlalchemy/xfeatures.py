@@ -147,6 +147,26 @@ class XFeatures(DBWorker):
         r.close()
         return d
 
+    def xfeature_dict_bulk(self, paths):
+        """Return a dict mapping each of the paths that has a feature
+           to a dict mapping keys to list of values for the feature.
+        """
+
+        if not paths:
+            return {}
+        j = self.xfeatures.outerjoin(self.xfeaturevals)
+        s = select([self.xfeatures.c.path, self.xfeaturevals.c.key,
+                    self.xfeaturevals.c.value], from_obj=[j])
+        s = s.where(self.xfeatures.c.path.in_(paths))
+        r = self.conn.execute(s)
+        d = {}
+        for path, key, value in r.fetchall():
+            features = d.setdefault(path, defaultdict(list))
+            if key is not None:
+                features[key].append(value)
+        r.close()
+        return d
+
     def feature_set(self, feature, key, value):
         """Associate a key, value pair with a feature."""
 
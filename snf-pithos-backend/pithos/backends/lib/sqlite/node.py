@@ -171,6 +171,8 @@ class Node(DBWorker):
                     on versions(node, mtime) """)
         execute(""" create index if not exists idx_versions_node_uuid
                     on versions(uuid) """)
+        execute(""" create index if not exists idx_versions_hash
+                    on versions(hash) """)
 
         execute(""" create table if not exists attributes
                           ( serial integer,
@@ -553,6 +555,61 @@ class Node(DBWorker):
         mtime = max(mtime, r[2])
         return (count, size, mtime)
 
+    def statistics_tree(self, node, cluster=0):
+        """Return population, total size and last mtime
+           for all latest versions under node that belong to the cluster.
+           Unlike statistics_latest, the versions of the grandchildren are
+           not scanned, but taken from the statistics of the children,
+           which must be kept up to date (depth of at least 1). The last
+           mtime also accounts for deletions under the children, which
+           update their statistics.
+        """
+
+        execute = self.execute
+        fetchone = self.fetchone
+
+        # The latest version.
+        q = ("select mtime "
+             "from versions v "
+             "where serial = %s "
+             "and cluster = ?")
+        subq, args = self._construct_latest_version_subquery(node=node)
+        execute(q % subq, args + [cluster])
+        props = fetchone()
+        if props is None:
+            return None
+        mtime = props[0]
+
+        # First level, just under node (get population).
+        q = ("select count(serial), sum(size), max(mtime) "
+             "from versions v "
+             "where serial = %s "
+             "and cluster = ? "
+             "and node in (select node "
+             "from nodes "
+             "where parent = ?)")
+        subq, args = self._construct_latest_version_subquery(node=None)
+        execute(q % subq, args + [cluster, node])
+        r = fetchone()
+        count = r[0]
+        if count == 0:
+            return (0, 0, mtime)
+        size = r[1] or 0
+        mtime = max(mtime, r[2])
+
+        # Everything under the first level (get size and mtime).
+        q = ("select sum(size), max(mtime) "
+             "from statistics "
+             "where cluster = ? "
+             "and node in (select node "
+             "from nodes "
+             "where parent = ?)")
+        execute(q, (cluster, node))
+        r = fetchone()
+        size += r[0] or 0
+        mtime = max(mtime, r[1])
+        return (count, size, mtime)
+
     def nodes_set_latest_version(self, node, serial):
         q = ("update nodes set latest_version = ? where node = ?")
         props = (serial, node)
@@ -647,6 +704,49 @@ class Node(DBWorker):
             return r
         return [r[propnames[k]] for k in keys if k in propnames]
 
+    def version_lookup_checksum(self, hash, size):
+        """Return a checksum already computed for a version
+           with the given hash and size, or None.
+        """
+
+        q = ("select checksum from versions "
+             "where hash = ? and size = ? and checksum != '' limit 1")
+        self.execute(q, (hash, size))
+        r = self.fetchone()
+        if r:
+            return r[0]
+        return None
+
+    def version_list_hashes(self, after='', limit=10000):
+        """Return up to limit distinct hashes of all versions,
+           greater than after, in ascending order.
+        """
+
+        q = ("select distinct hash from versions "
+             "where hash > ? order by hash limit ?")
+        self.execute(q, (after, limit))
+        return [r[0] for r in self.fetchall()]
+
+    def version_list_hashes_since(self, mtime):
+        """Return the distinct hashes of the versions
+           modified at or after the given time.
+        """
+
+        q = ("select distinct hash from versions "
+             "where mtime >= ? and hash > ''")
+        self.execute(q, (mtime,))
+        return [r[0] for r in self.fetchall()]
+
+    def version_lookup_hash(self, hash):
+        """Return the serial of a version with the given hash, or None."""
+
+        q = "select serial from versions where hash = ? limit 1"
+        self.execute(q, (hash,))
+        r = self.fetchone()
+        if r:
+            return r[0]
+        return None
+
     def version_put_property(self, serial, key, value):
         """Set value for the property of version specified by key."""
 
@@ -143,6 +143,12 @@ class Permissions(XFeatures, Groups, Public, Node):
 #         # Compute valid.
 #         return [x[0] for x in r if x[0] in valid]
 
+        return [x for x in self.access_candidates(path)
+                if self.xfeature_get(x)]
+
+    def access_candidates(self, path):
+        """Return the paths that may influence the access for path."""
+
         # Only keep path components.
         parts = path.rstrip('/').split('/')
         valid = []
@@ -151,7 +157,7 @@ class Permissions(XFeatures, Groups, Public, Node):
             valid.append(subp)
             if subp != path:
                 valid.append(subp + '/')
-        return [x for x in valid if self.xfeature_get(x)]
+        return valid
 
     def access_list_paths(self, member, prefix=None, include_owned=False,
                           include_containers=True):
@@ -116,6 +116,26 @@ class XFeatures(DBWorker):
             d[key].append(value)
         return d
 
+    def xfeature_dict_bulk(self, paths):
+        """Return a dict mapping each of the paths that has a feature
+           to a dict mapping keys to list of values for the feature.
+        """
+
+        if not paths:
+            return {}
+        placeholders = ','.join('?' for path in paths)
+        q = ("select f.path, v.key, v.value "
+             "from xfeatures f left join xfeaturevals v "
+             "on f.feature_id = v.feature_id "
+             "where f.path in (%s)") % placeholders
+        self.execute(q, paths)
+        d = {}
+        for path, key, value in self.fetchall():
+            features = d.setdefault(path, defaultdict(list))
+            if key is not None:
+                features[key].append(value)
+        return d
+
     def feature_set(self, feature, key, value):
         """Associate a key, value pair with a feature."""
 
@@ -42,6 +42,9 @@ try:
 except ImportError:
     AstakosClient = None
 
+from synnefo.lib.merkle import merkle_root
+
+from hashlist import HashList
 from base import (DEFAULT_ACCOUNT_QUOTA, DEFAULT_CONTAINER_QUOTA,
                   DEFAULT_CONTAINER_VERSIONING, NotAllowedError, QuotaError,
                   BaseBackend, AccountExists, ContainerExists, AccountNotEmpty,
@@ -61,32 +64,22 @@ class DisabledAstakosClient(object):
 
 # Stripped-down version of the HashMap class found in tools.
 
-class HashMap(list):
+class HashMap(HashList):
 
-    def __init__(self, blocksize, blockhash):
-        super(HashMap, self).__init__()
+    def __init__(self, blocksize, blockhash, digests=''):
+        hashlen = hashlib.new(blockhash).digest_size
+        super(HashMap, self).__init__(digests, hashlen)
         self.blocksize = blocksize
         self.blockhash = blockhash
 
-    def _hash_raw(self, v):
-        h = hashlib.new(self.blockhash)
-        h.update(v)
-        return h.digest()
+    @classmethod
+    def from_hex(cls, blocksize, blockhash, hashes):
+        hashlen = hashlib.new(blockhash).digest_size
+        return cls(blocksize, blockhash,
+                   HashList.from_hex(hashes, hashlen).digests)
 
     def hash(self):
-        if len(self) == 0:
-            return self._hash_raw('')
-        if len(self) == 1:
-            return self.__getitem__(0)
-
-        h = list(self)
-        s = 2
-        while s < len(h):
-            s = s * 2
-        h += [('\x00' * len(h[0]))] * (s - len(h))
-        while len(h) > 1:
-            h = [self._hash_raw(h[x] + h[x + 1]) for x in range(0, len(h), 2)]
-        return h[0]
+        return merkle_root(self.digests, self.blockhash, self.hashlen)
 
 # Default modules and settings.
 DEFAULT_DB_MODULE = 'pithos.backends.lib.sqlalchemy'
@@ -129,14 +122,16 @@ def backend_method(func=None, autocommit=1):
 
     def fn(self, *args, **kw):
         self.wrapper.execute()
+        self._reset_permission_cache()
         serials = []
         self.serials = serials
         self.messages = []
+        self._reset_provisions()
 
         try:
             ret = func(self, *args, **kw)
-            for m in self.messages:
-                self.queue.send(*m)
+            self._issue_provisions()
+            self.queue.send_many(self.messages)
             if self.serials:
                 self.commission_serials.insert_many(self.serials)
 
@@ -161,6 +156,8 @@ def backend_method(func=None, autocommit=1):
                     reject_serials=self.serials)
             self.wrapper.rollback()
             raise
+        finally:
+            self._reset_permission_cache()
     return fn
 
 
@@ -173,7 +170,7 @@ class ModularBackend(BaseBackend):
     def __init__(self, db_module=None, db_connection=None,
                  block_module=None, block_path=None, block_umask=None,
                  queue_module=None, queue_hosts=None, queue_exchange=None,
-                 astakos_url=None, service_token=None,
+                 queue_backlog=None, astakos_url=None, service_token=None,
                  astakosclient_poolsize=None,
                  free_versioning=True, block_params=None,
                  public_url_security=None,
@@ -222,6 +219,7 @@ class ModularBackend(BaseBackend):
         for x in ['READ', 'WRITE']:
             setattr(self, x, getattr(self.db_module, x))
         self.node = self.db_module.Node(**params)
+        self._reset_permission_cache()
         for x in ['ROOTNODE', 'SERIAL', 'HASH', 'SIZE', 'TYPE', 'MTIME', 'MUSER', 'UUID', 'CHECKSUM', 'CLUSTER', 'MATCH_PREFIX', 'MATCH_EXACT']:
             setattr(self, x, getattr(self.db_module, x))
 
@@ -238,13 +236,17 @@ class ModularBackend(BaseBackend):
             self.queue_module = load_module(queue_module)
             params = {'hosts': queue_hosts,
                       'exchange': queue_exchange,
-                      'client_id': QUEUE_CLIENT_ID}
+                      'client_id': QUEUE_CLIENT_ID,
+                      'backlog': queue_backlog}
             self.queue = self.queue_module.Queue(**params)
         else:
             class NoQueue:
                 def send(self, *args):
                     pass
 
+                def send_many(self, messages):
+                    pass
+
                 def close(self):
                     pass
 
@@ -266,6 +268,7 @@ class ModularBackend(BaseBackend):
 
         self.serials = []
         self.messages = []
+        self._reset_provisions()
 
     def close(self):
         self.wrapper.close()
@@ -649,6 +652,7 @@ class ModularBackend(BaseBackend):
                     user, account, path, details={'action': 'object delete'})
                 paths.append(path)
             self.permissions.access_clear_bulk(paths)
+            self._reset_permission_cache()
 
     def _list_objects(self, user, account, container, prefix, delimiter, marker, limit, virtual, domain, keys, shared, until, size_range, all_props, public):
         if user != account and until:
@@ -845,17 +849,48 @@ class ModularBackend(BaseBackend):
 
         logger.debug("get_object_permissions: %s %s %s %s", user,
                      account, container, name)
+        return self._get_object_permissions(user, account, container, name)
+
+    @backend_method
+    def get_object_permissions_bulk(self, user, account, container, names):
+        """Return a dict mapping each of the object names given to the
+        tuple get_object_permissions would return for it."""
+
+        logger.debug("get_object_permissions_bulk: %s %s %s %s", user,
+                     account, container, names)
+        paths = set('/'.join((account, container, name)) for name in names)
+        if len(self.node.node_lookup_bulk(list(paths))) < len(paths):
+            raise ItemNotExists('Object does not exist')
+        self._prefetch_permissions(paths)
+        permissions = {}
+        for name in names:
+            permissions[name] = self._get_object_permissions(
+                user, account, container, name, lookup=False)
+        return permissions
+
+    def _get_object_permissions(self, user, account, container, name,
+                                lookup=True):
         allowed = 'write'
         permissions_path = self._get_permissions_path(account, container, name)
         if user != account:
-            if self.permissions.access_check(permissions_path, self.WRITE, user):
+            if self._access_check(permissions_path, self.WRITE, user):
                 allowed = 'write'
-            elif self.permissions.access_check(permissions_path, self.READ, user):
+            elif self._access_check(permissions_path, self.READ, user):
                 allowed = 'read'
             else:
                 raise NotAllowedError
-        self._lookup_object(account, container, name)
-        return (allowed, permissions_path, self.permissions.access_get(permissions_path))
+        if lookup:
+            self._lookup_object(account, container, name)
+        return (allowed, permissions_path, self._access_get(permissions_path))
+
+    @backend_method
+    def can_read_many(self, user, paths):
+        """Return the object paths given that the user can read."""
+
+        logger.debug("can_read_many: %s %s", user, paths)
+        self._prefetch_permissions(
+            [p for p in paths if p.split('/', 1)[0] != user], public=True)
+        return [p for p in paths if self._has_read_access(user, p)]
 
     @backend_method
     def update_object_permissions(self, user, account, container, name, permissions):
@@ -869,6 +904,7 @@ class ModularBackend(BaseBackend):
                                    lock_container=True)[0]
         self._check_permissions(path, permissions)
         self.permissions.access_set(path, permissions)
+        self._reset_permission_cache()
         self._report_sharing_change(user, account, path, {'members':
                                     self.permissions.access_members(path)})
 
@@ -898,6 +934,7 @@ class ModularBackend(BaseBackend):
             self.permissions.public_set(
                 path, self.public_url_security, self.public_url_alphabet
             )
+        self._reset_permission_cache()
 
     @backend_method
     def get_object_hashmap(self, user, account, container, name, version=None):
@@ -909,7 +946,7 @@ class ModularBackend(BaseBackend):
         path, node = self._lookup_object(account, container, name)
         props = self._get_version(node, version)
         hashmap = self.store.map_get(binascii.unhexlify(props[self.HASH]))
-        return props[self.SIZE], [binascii.hexlify(x) for x in hashmap]
+        return props[self.SIZE], hashmap.hex()
 
     def _update_object_hash(self, user, account, container, name, size, type, hash, checksum, domain, meta, replace_meta, permissions, src_node=None, src_version_id=None, is_copy=False):
         if permissions is not None and user != account:
@@ -974,6 +1011,7 @@ class ModularBackend(BaseBackend):
                                   'versions': ','.join([str(dest_version_id)])})
         if permissions is not None:
             self.permissions.access_set(path, permissions)
+            self._reset_permission_cache()
             self._report_sharing_change(user, account, path, {'members': self.permissions.access_members(path)})
 
         self._report_object_change(user, account, path, details={'version': dest_version_id, 'action': 'object update'})
@@ -988,8 +1026,7 @@ class ModularBackend(BaseBackend):
         meta = meta or {}
         if size == 0:  # No such thing as an empty hashmap.
             hashmap = [self.put_block('')]
-        map = HashMap(self.block_size, self.hash_algorithm)
-        map.extend([binascii.unhexlify(x) for x in hashmap])
+        map = HashMap.from_hex(self.block_size, self.hash_algorithm, hashmap)
         missing = self.store.block_search(map)
         if missing:
             ie = IndexError()
@@ -1019,6 +1056,17 @@ class ModularBackend(BaseBackend):
                 self.node.version_put_property(
                     x[self.SERIAL], 'checksum', checksum)
 
+    @backend_method
+    def get_hashmap_checksum(self, size, hashmap):
+        """Return a known checksum for the data of the hashmap, if any."""
+
+        logger.debug("get_hashmap_checksum: %s %s", size, hashmap)
+        if size == 0:  # The hashmap of the empty block.
+            hashmap = [hashlib.new(self.hash_algorithm).hexdigest()]
+        map = HashMap.from_hex(self.block_size, self.hash_algorithm, hashmap)
+        return self.node.version_lookup_checksum(
+            binascii.hexlify(map.hash()), size)
+
     def _copy_object(self, user, src_account, src_container, src_name, dest_account, dest_container, dest_name, type, dest_domain=None, dest_meta=None, replace_meta=False, permissions=None, src_version=None, is_move=False, delimiter=None):
         dest_meta = dest_meta or {}
         dest_version_ids = []
@@ -1126,6 +1174,7 @@ class ModularBackend(BaseBackend):
                 props = self._get_version(node)
             except NameError:
                 self.permissions.access_clear(path)
+                self._reset_permission_cache()
             self._report_size_change(
                 user, account, -size, {
                     'action': 'object purge',
@@ -1146,6 +1195,7 @@ class ModularBackend(BaseBackend):
         self._report_object_change(
             user, account, path, details={'action': 'object delete'})
         self.permissions.access_clear(path)
+        self._reset_permission_cache()
 
         if delimiter:
             prefix = name + delimiter if not name.endswith(delimiter) else name
@@ -1169,6 +1219,7 @@ class ModularBackend(BaseBackend):
                     user, account, path, details={'action': 'object delete'})
                 paths.append(path)
             self.permissions.access_clear_bulk(paths)
+            self._reset_permission_cache()
 
     @backend_method
     def delete_object(self, user, account, container, name, until=None, prefix='', delimiter=None):
@@ -1224,6 +1275,13 @@ class ModularBackend(BaseBackend):
             raise ItemNotExists('Block does not exist')
         return block
 
+    @backend_method(autocommit=0)
+    def get_block_path(self, hash):
+        """Return the path of the file holding a block's data, if any."""
+
+        logger.debug("get_block_path: %s", hash)
+        return self.store.block_path(binascii.unhexlify(hash))
+
     @backend_method(autocommit=0)
     def put_block(self, data):
         """Store a block and return the hash."""
@@ -1307,7 +1365,7 @@ class ModularBackend(BaseBackend):
         if until is not None:
             stats = self.node.statistics_latest(node, until, CLUSTER_DELETED)
         elif compute:
-            stats = self.node.statistics_latest(node, except_cluster=CLUSTER_DELETED)
+            stats = self.node.statistics_tree(node, CLUSTER_NORMAL)
         else:
             stats = self.node.statistics_get(node, CLUSTER_NORMAL)
         if stats is None:
@@ -1453,15 +1511,42 @@ class ModularBackend(BaseBackend):
         if not self.using_external_quotaholder:
             return
 
+        # Provisions are issued as one commission when the transaction ends.
+        self.provisions[account] = self.provisions.get(account, 0) + size
+        if not self.provisions_count:
+            self.provisions_name = details['path'] if 'path' in details else ''
+        self.provisions_count += 1
+
+    def _reset_provisions(self):
+        self.provisions = {}
+        self.provisions_name = ''
+        self.provisions_count = 0
+
+    def _issue_provisions(self):
+        """Issue a single commission with the diskspace changes of each
+           holder reported during the transaction."""
+
+        provisions = sorted((holder, size) for holder, size in
+                            self.provisions.iteritems() if size != 0)
+        name = self.provisions_name
+        if self.provisions_count > 1:
+            name = '%s (and %d more)' % (name, self.provisions_count - 1)
+        self._reset_provisions()
+        if not provisions:
+            return
+
+        request = {
+            'force': False,
+            'auto_accept': False,
+            'name': name,
+            'provisions': [{'holder': holder,
+                            'source': DEFAULT_SOURCE,
+                            'resource': 'pithos.diskspace',
+                            'quantity': size}
+                           for holder, size in provisions]}
         try:
-            name = details['path'] if 'path' in details else ''
-            serial = self.astakosclient.issue_one_commission(
-                token=self.service_token,
-                holder=account,
-                source=DEFAULT_SOURCE,
-                provisions={'pithos.diskspace': size},
-                name=name
-                )
+            serial = self.astakosclient.issue_commission(
+                token=self.service_token, request=request)
         except BaseException, e:
             raise QuotaError(e)
         else:
@@ -1562,9 +1647,106 @@ class ModularBackend(BaseBackend):
                 formatted.append((p, self.MATCH_EXACT))
         return formatted
 
+    # Permission cache.
+    #
+    # Permission checks consult the features of every ancestor of a path,
+    # the public state of the path, the groups of the user and the type
+    # of the ancestor directories. All of these are loaded at most once
+    # per transaction (and in bulk where the caller knows the paths in
+    # advance), so that checking the objects of a shared listing does not
+    # cost several queries per object. The cache is reset at transaction
+    # boundaries and whenever permissions are modified.
+
+    def _reset_permission_cache(self):
+        self._permission_features = {}
+        self._permission_public = {}
+        self._permission_members = {}
+        self._permission_directories = {}
+
+    def _prefetch_permissions(self, paths, public=False):
+        """Load the features influencing the access for paths and,
+           optionally, their public state, for the paths not cached yet."""
+
+        candidates = set()
+        for path in paths:
+            candidates.update(self.permissions.access_candidates(path))
+            candidates.add(path)
+        missing = [p for p in candidates
+                   if p not in self._permission_features]
+        if missing:
+            features = self.permissions.xfeature_dict_bulk(missing)
+            for p in missing:
+                self._permission_features[p] = features.get(p)
+        if not public:
+            return
+        missing = [p for p in set(paths) if p not in self._permission_public]
+        if missing:
+            urls = self.permissions.public_get_bulk(missing)
+            for p in missing:
+                self._permission_public[p] = urls.get(p)
+
+    def _permission_groups(self, user):
+        """Return the member values that match user in a feature."""
+
+        members = self._permission_members.get(user)
+        if members is None:
+            members = set([user, '*'])
+            members.update(owner + ':' + group for owner, group in
+                           self.permissions.group_parents(user))
+            self._permission_members[user] = members
+        return members
+
+    def _is_directory(self, path):
+        is_directory = self._permission_directories.get(path)
+        if is_directory is None:
+            node = self.node.node_lookup(path)
+            props = None
+            if node is not None:
+                props = self.node.version_lookup(node, inf, CLUSTER_NORMAL)
+            is_directory = props is not None and props[self.TYPE].split(
+                ';', 1)[0].strip() in ('application/directory',
+                                       'application/folder')
+            self._permission_directories[path] = is_directory
+        return is_directory
+
+    def _access_check(self, path, access, user):
+        """Return true if the user has this access to the path."""
+
+        if path is None:
+            return False
+        if path not in self._permission_features:
+            self._prefetch_permissions([path])
+        features = self._permission_features[path]
+        if not features:
+            return False
+        members = features.get(access)
+        if not members:
+            return False
+        return not self._permission_groups(user).isdisjoint(members)
+
+    def _access_get(self, path):
+        """Return the permissions dict for path."""
+
+        if path is None:
+            return {}
+        if path not in self._permission_features:
+            self._prefetch_permissions([path])
+        features = self._permission_features[path]
+        if not features:
+            return {}
+        permissions = {}
+        if self.READ in features:
+            permissions['read'] = list(features[self.READ])
+        if self.WRITE in features:
+            permissions['write'] = list(features[self.WRITE])
+        return permissions
+
     def _get_permissions_path(self, account, container, name):
         path = '/'.join((account, container, name))
-        permission_paths = self.permissions.access_inherit(path)
+        self._prefetch_permissions([path])
+        permission_paths = [p for p in
+                            self.permissions.access_candidates(path)
+                            if self._permission_features.get(p) is not None]
         permission_paths.sort()
         permission_paths.reverse()
         for p in permission_paths:
@@ -1573,25 +1755,22 @@ class ModularBackend(BaseBackend):
             else:
                 if p.count('/') < 2:
                     continue
-                node = self.node.node_lookup(p)
-                props = None
-                if node is not None:
-                    props = self.node.version_lookup(node, inf, CLUSTER_NORMAL)
-                if props is not None:
-                    if props[self.TYPE].split(';', 1)[0].strip() in ('application/directory', 'application/folder'):
-                        return p
+                if self._is_directory(p):
+                    return p
         return None
 
     def _can_read(self, user, account, container, name):
         if user == account:
             return True
         path = '/'.join((account, container, name))
-        if self.permissions.public_get(path) is not None:
+        self._prefetch_permissions([path], public=True)
+        if self._permission_public[path] is not None:
             return True
         path = self._get_permissions_path(account, container, name)
         if not path:
             raise NotAllowedError
-        if not self.permissions.access_check(path, self.READ, user) and not self.permissions.access_check(path, self.WRITE, user):
+        if (not self._access_check(path, self.READ, user) and
+                not self._access_check(path, self.WRITE, user)):
             raise NotAllowedError
 
     def _can_write(self, user, account, container, name):
@@ -1601,7 +1780,7 @@ class ModularBackend(BaseBackend):
         path = self._get_permissions_path(account, container, name)
         if not path:
             raise NotAllowedError
-        if not self.permissions.access_check(path, self.WRITE, user):
+        if not self._access_check(path, self.WRITE, user):
             raise NotAllowedError
 
     def _allowed_accounts(self, user):
@@ -1626,9 +1805,10 @@ class ModularBackend(BaseBackend):
             return []
         obj_list = self.node.domain_object_list(
             domain, allowed_paths, CLUSTER_NORMAL)
+        self._prefetch_permissions([path for path, _, _ in obj_list])
         return [(path,
                  self._build_metadata(props, user_defined_meta),
-                 self.permissions.access_get(path)) for
+                 self._access_get(path)) for
                 path, props, user_defined_meta in obj_list]
 
     # util functions
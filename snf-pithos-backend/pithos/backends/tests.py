@@ -0,0 +1,952 @@
+# Copyright 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+import hashlib
+import mmap
+import random
+import shutil
+import tempfile
+import unittest
+
+from threading import Timer
+from time import sleep, time
+
+from mock import patch, Mock
+from objpool import PoolLimitError
+from sqlalchemy.sql import and_, func, select
+
+from pithos.backends.base import ItemNotExists, NotAllowedError, QuotaError
+from pithos.backends.hashlist import HashList, HexHashList
+from pithos.backends.lib import sqlalchemy as sqlalchemy_db, sqlite as sqlite_db
+from pithos.backends.modular import ModularBackend, HashMap
+from pithos.backends.util import PithosBackendPool
+
+
+class BackendTestCase(unittest.TestCase):
+    """Run against a private backend on a temporary directory."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = ModularBackend(
+            db_connection='sqlite:///%s/db.sqlite' % self.path,
+            block_path='%s/blocks' % self.path)
+        self.backend.put_account('account', 'account')
+        self.backend.put_container('account', 'account', 'container')
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.path)
+
+    def put_object(self, name, size=0, hashmap=None, account='account',
+                   container='container', type='application/octet'):
+        if hashmap is None:
+            hashmap = []
+        return self.backend.update_object_hashmap(
+            account, account, container, name, size, type, hashmap, '',
+            'pithos')
+
+
+class TestDelimitedListing(BackendTestCase):
+    """The grouped listing must return what the skip scan returns."""
+
+    def setUp(self):
+        super(TestDelimitedListing, self).setUp()
+        self.random = random.Random(1234)
+        names = set()
+        while len(names) < 80:
+            size = self.random.randint(1, 6)
+            names.add(''.join(self.random.choice('ab/')
+                              for i in xrange(size)))
+        for name in names:
+            self.put_object(name)
+        self.names = sorted(names)
+        self.parent = self.backend._lookup_container(
+            'account', 'container')[1]
+
+    def listing(self, prefix, start, limit):
+        prefix = 'account/container/' + prefix
+        start = 'account/container/' + start if start else ''
+        matches, prefixes = self.backend.node.latest_version_list(
+            self.parent, prefix, '/', start, limit)
+        listing = [m[0] for m in matches] + list(prefixes)
+        return sorted(listing)[:limit]
+
+    def grouped_listing(self, prefix, start, limit):
+        functions = {'sqlite': func.instr}
+        with patch.dict('pithos.backends.lib.sqlalchemy.node.'
+                        '_position_functions', functions):
+            return self.listing(prefix, start, limit)
+
+    def assert_same(self, prefix, start, limit):
+        self.assertEqual(self.grouped_listing(prefix, start, limit),
+                         self.listing(prefix, start, limit),
+                         (prefix, start, limit))
+
+    def test_random(self):
+        prefixes = ['', 'a', 'a/', 'b', 'b/', '/', 'ab/']
+        for i in xrange(200):
+            prefix = self.random.choice(prefixes)
+            start = self.random.choice(self.names + [None])
+            limit = self.random.randint(1, 30)
+            self.assert_same(prefix, start, limit)
+
+    def test_start_at_prefix(self):
+        for start in ('a/', 'b/', '/', 'a/b/'):
+            for limit in (1, 2, 5, 100):
+                self.assert_same('', start, limit)
+
+    def test_pages(self):
+        for limit in (1, 2, 3, 7):
+            pages = []
+            start = None
+            while True:
+                page = self.grouped_listing('', start, limit)
+                if not page:
+                    break
+                self.assertTrue(len(page) <= limit)
+                pages.extend(page)
+                start = page[-1][len('account/container/'):]
+                if start.endswith('/'):
+                    # Skip the contents of the virtual directory.
+                    start = start[:-1] + chr(ord('/') + 1)
+            self.assertEqual(pages, self.listing('', None, 10000))
+
+    def test_many_rows_in_prefix(self):
+        with patch('pithos.backends.lib.sqlalchemy.node.SKIP_SCAN_ROWS', 2):
+            for limit in (1, 4, 100):
+                self.assert_same('', None, limit)
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.healthy = True
+        self.closed = False
+
+    def _real_close(self):
+        self.closed = True
+
+
+class FakeBackendPool(PithosBackendPool):
+    """A backend pool that does not connect to any database."""
+
+    def _pool_create(self):
+        self._count(creations=1)
+        return FakeBackend()
+
+    def _pool_verify_connection(self, backend):
+        return backend.healthy
+
+    def _pool_cleanup(self, backend):
+        return False
+
+
+class TestBackendPool(unittest.TestCase):
+    def test_warmup(self):
+        pool = FakeBackendPool(size=4)
+        pool.pool_warmup(3)
+        stats = pool.pool_stats()
+        self.assertEqual(stats['idle'], 3)
+        self.assertEqual(stats['creations'], 3)
+        self.assertEqual(stats['in_use'], 0)
+        pool.pool_warmup(2)
+        self.assertEqual(pool.pool_stats()['creations'], 3)
+
+    def test_warmup_thread(self):
+        with patch.object(FakeBackendPool, 'pool_warmup') as warmup:
+            pool = FakeBackendPool(size=2, warmup=5)
+            sleep(0.05)
+            self.assertEqual(warmup.call_count, 0)
+            pool.pool_put(pool.pool_get())
+            for i in xrange(100):
+                if warmup.call_count:
+                    break
+                sleep(0.01)
+        warmup.assert_called_with(2)
+
+    def test_start_per_process(self):
+        pool = FakeBackendPool(size=2, warmup=1)
+        with patch('pithos.backends.util.Thread') as thread:
+            with patch('pithos.backends.util.getpid', return_value=1):
+                pool.pool_put(pool.pool_get())
+                pool.pool_put(pool.pool_get())
+            self.assertEqual(thread.call_count, 1)
+            # A forked process starts its own thread
+            with patch('pithos.backends.util.getpid', return_value=2):
+                pool.pool_put(pool.pool_get())
+            self.assertEqual(thread.call_count, 2)
+        thread.return_value.start.assert_called_with()
+
+    def test_no_maintenance(self):
+        pool = FakeBackendPool(size=2)
+        with patch('pithos.backends.util.Thread') as thread:
+            pool.pool_put(pool.pool_get())
+        self.assertEqual(thread.call_count, 0)
+
+    def test_check(self):
+        pool = FakeBackendPool(size=4)
+        pool.pool_warmup(3)
+        backends = list(pool._set)
+        backends[0].healthy = False
+        self.assertEqual(pool.pool_check(), 1)
+        self.assertTrue(backends[0].closed)
+        self.assertEqual(pool._set, set(backends[1:]))
+        stats = pool.pool_stats()
+        self.assertEqual(stats['recycles'], 1)
+        self.assertEqual(stats['idle'], 2)
+
+    def test_check_exhausted(self):
+        pool = FakeBackendPool(size=1)
+        pool.pool_warmup(2)
+        backend = pool.pool_get()
+        idle, = pool._set
+        idle.healthy = False
+        # The check cannot take an allocation, so it leaves the idle
+        # backends to the gets, which verify them anyway.
+        self.assertEqual(pool.pool_check(), 0)
+        self.assertEqual(pool._set, set([idle]))
+        pool.pool_put(backend)
+        self.assertEqual(pool.pool_check(), 1)
+        self.assertEqual(pool._set, set([backend]))
+
+    def test_check_concurrent_get(self):
+        pool = FakeBackendPool(size=4)
+        pool.pool_warmup(2)
+        backends = list(pool._set)
+        backends[0].healthy = False
+        got = []
+
+        def verify(backend):
+            # Another thread gets the other backend during the check.
+            if backend is backends[0]:
+                got.append(pool.pool_get())
+            return backend.healthy
+
+        with patch.object(pool, '_pool_verify_connection', verify):
+            self.assertEqual(pool.pool_check(), 1)
+        self.assertEqual(got, [backends[1]])
+        stats = pool.pool_stats()
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 0)
+
+    def test_timeout(self):
+        pool = FakeBackendPool(size=1, timeout=0.05)
+        backend = pool.pool_get()
+        start = time()
+        self.assertRaises(PoolLimitError, pool.pool_get)
+        self.assertTrue(time() - start >= 0.05)
+        self.assertRaises(PoolLimitError, pool.pool_get, blocking=False)
+        pool.pool_put(backend)
+        self.assertEqual(pool.pool_get(), backend)
+        stats = pool.pool_stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['waits'], 1)
+        self.assertTrue(stats['max_wait_time'] >= 0.05)
+        self.assertEqual(stats['wait_time'], stats['max_wait_time'])
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['creations'], 1)
+
+    def test_wait(self):
+        pool = FakeBackendPool(size=1, timeout=5)
+        backend = pool.pool_get()
+        timer = Timer(0.05, pool.pool_put, (backend,))
+        timer.start()
+        self.assertEqual(pool.pool_get(), backend)
+        timer.join()
+        stats = pool.pool_stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertTrue(0.04 <= stats['max_wait_time'] < 5)
+
+    def test_report(self):
+        pool = FakeBackendPool(size=1, timeout=0)
+        pool.pool_get()
+        self.assertRaises(PoolLimitError, pool.pool_get)
+        with patch('pithos.backends.util.logger') as logger:
+            pool._pool_report()
+            pool._pool_report()
+        self.assertEqual(logger.warning.call_count, 1)
+
+
+class TestHashList(unittest.TestCase):
+    def setUp(self):
+        self.digests = [hashlib.sha256(str(i)).digest() for i in xrange(10)]
+        self.hashes = [d.encode('hex') for d in self.digests]
+        self.hashlist = HashList.from_digests(self.digests)
+
+    def test_sequence(self):
+        self.assertEqual(len(self.hashlist), 10)
+        self.assertEqual(list(self.hashlist), self.digests)
+        self.assertEqual(self.hashlist[0], self.digests[0])
+        self.assertEqual(self.hashlist[-1], self.digests[-1])
+        self.assertRaises(IndexError, lambda: self.hashlist[10])
+        self.assertRaises(IndexError, lambda: self.hashlist[-11])
+        self.assertEqual(len(HashList()), 0)
+        self.assertEqual(list(HashList()), [])
+
+    def test_slices(self):
+        for start in xrange(-12, 12):
+            for stop in xrange(-12, 12):
+                for step in (None, 1, 2, 3, -1):
+                    s = slice(start, stop, step)
+                    self.assertEqual(list(self.hashlist[s]), self.digests[s])
+        self.assertTrue(isinstance(self.hashlist[1:3], HashList))
+
+    def test_equality(self):
+        self.assertEqual(self.hashlist, HashList.from_digests(self.digests))
+        self.assertNotEqual(self.hashlist, self.hashlist[1:])
+        self.assertNotEqual(self.hashlist, HashList(self.hashlist.digests,
+                                                    hashlen=16))
+        self.assertFalse(self.hashlist == self.digests)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, HashList, 'x' * 33)
+        self.assertRaises(ValueError, HashList.from_hex, ['ab'])
+        self.assertRaises(TypeError, HashList.from_hex, ['x' * 64])
+
+    def test_hex(self):
+        hexlist = self.hashlist.hex()
+        self.assertEqual(len(hexlist), 10)
+        self.assertEqual(list(hexlist), self.hashes)
+        self.assertEqual(hexlist[3], self.hashes[3])
+        self.assertEqual(hexlist[-2], self.hashes[-2])
+        self.assertTrue(isinstance(hexlist[2:5], HexHashList))
+        self.assertEqual(list(hexlist[2:5]), self.hashes[2:5])
+        self.assertEqual(hexlist, self.hashlist.hex())
+        self.assertNotEqual(hexlist, hexlist[1:])
+        self.assertEqual(HashList.from_hex(self.hashes), self.hashlist)
+        self.assertTrue(HashList.from_hex(hexlist) is self.hashlist)
+
+    def test_mmap(self):
+        f = tempfile.TemporaryFile()
+        f.write(self.hashlist.digests)
+        f.flush()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            hashlist = HashList(m)
+            self.assertEqual(hashlist, self.hashlist)
+            self.assertEqual(list(hashlist[3:6].hex()), self.hashes[3:6])
+        finally:
+            m.close()
+            f.close()
+
+    def test_close(self):
+        f = tempfile.TemporaryFile()
+        f.write(self.hashlist.digests)
+        f.flush()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            hashlist = HashList(m)
+            part = hashlist[2:4]
+            hashlist.hex().close()
+            self.assertRaises(ValueError, len, m)
+            self.assertRaises(ValueError, list, hashlist)
+            hashlist.close()
+            # Slices are copies.
+            self.assertEqual(list(part), self.digests[2:4])
+        finally:
+            f.close()
+        self.hashlist.close()
+        self.assertEqual(list(self.hashlist), self.digests)
+
+
+class TestHashMap(unittest.TestCase):
+    def test_from_hex(self):
+        hashes = [hashlib.sha256(str(i)).hexdigest() for i in xrange(3)]
+        map = HashMap.from_hex(16, 'sha256', hashes)
+        self.assertEqual(list(map.hex()), hashes)
+        self.assertEqual(map.blocksize, 16)
+        self.assertEqual(map.hashlen, 32)
+        self.assertEqual(map, HashMap(16, 'sha256', HashList.from_hex(
+            hashes).digests))
+        self.assertRaises(ValueError, HashMap.from_hex, 16, 'sha1', hashes)
+
+    def test_hash(self):
+        h = lambda data: hashlib.sha256(data).digest()
+        hashes = [h(str(i)) for i in xrange(3)]
+        map = HashMap(16, 'sha256', ''.join(hashes))
+        self.assertEqual(map.hash(), h(h(hashes[0] + hashes[1]) +
+                                       h(hashes[2] + '\x00' * 32)))
+        map = HashMap(16, 'sha256', hashes[0])
+        self.assertEqual(map.hash(), hashes[0])
+
+
+inf = float('inf')
+
+(CLUSTER_NORMAL, CLUSTER_HISTORY, CLUSTER_DELETED) = range(3)
+
+
+class NodeTestCase(unittest.TestCase):
+    """Run against the nodes of a database module on a temporary file.
+
+    Paths are split on '/' into a tree of nodes, every node having
+    versions, and are updated and deleted the way the backend does.
+    """
+
+    db_module = sqlalchemy_db
+    db_connection = 'sqlite:///%s/db.sqlite'
+    versioning = False
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.wrapper = self.db_module.DBWrapper(
+            self.db_connection % self.path)
+        self.node = self.db_module.Node(wrapper=self.wrapper)
+        self.random = random.Random(4321)
+
+    def tearDown(self):
+        self.wrapper.close()
+        shutil.rmtree(self.path)
+
+    def lookup(self, path):
+        """Return the node of the path, creating it and its parents."""
+        node = self.node.node_lookup(path)
+        if node is not None:
+            return node
+        if '/' in path:
+            parent = self.lookup(path.rsplit('/', 1)[0])
+        else:
+            parent = self.db_module.ROOTNODE
+        node = self.node.node_create(parent, path)
+        self.node.version_create(node, None, 0, '', None, 'user', path, '',
+                                 CLUSTER_NORMAL)
+        return node
+
+    def put_version(self, path, size, cluster=CLUSTER_NORMAL):
+        node = self.lookup(path)
+        props = self.node.version_lookup(node, inf, CLUSTER_NORMAL)
+        if props is not None:
+            serial = props[self.db_module.SERIAL]
+            self.node.version_recluster(serial, CLUSTER_HISTORY)
+            if not self.versioning and self.random.random() < 0.5:
+                # No versioning.
+                self.node.version_remove(serial)
+        self.node.version_create(node, None, size, '', None, 'user', path,
+                                 '', cluster)
+        return node
+
+    def put(self, path, size):
+        return self.put_version(path, size)
+
+    def delete(self, path):
+        return self.put_version(path, 0, CLUSTER_DELETED)
+
+    def populate(self, count=60):
+        """Put and delete random paths, at most five levels deep."""
+        paths = []
+        for i in xrange(count):
+            if paths and self.random.random() < 0.3:
+                path = self.random.choice(paths)
+            else:
+                depth = self.random.randint(1, 5)
+                path = '/'.join(self.random.choice('abc')
+                                for j in xrange(depth))
+                paths.append(path)
+            if self.random.random() < 0.2:
+                self.delete(path)
+            else:
+                self.put(path, self.random.randint(0, 1000))
+        return paths
+
+    def tree_nodes(self):
+        nodes = []
+        for path in ('a', 'b', 'c', 'a/b', 'b/a', 'c/c', 'a/b/c'):
+            node = self.node.node_lookup(path)
+            if node is not None:
+                nodes.append(node)
+        return nodes
+
+
+class TestStatisticsTree(NodeTestCase):
+    def assert_tree(self, node, deleted=False):
+        tree = self.node.statistics_tree(node, CLUSTER_NORMAL)
+        latest = self.node.statistics_latest(node, inf, CLUSTER_DELETED)
+        self.assertEqual(tree is None, latest is None)
+        if tree is None:
+            return
+        self.assertEqual(tree[:2], latest[:2])
+        if deleted:
+            # Deletions update the modification time of the statistics,
+            # while the deleted versions are not taken into account.
+            self.assertTrue(tree[2] >= latest[2])
+        else:
+            self.assertEqual(tree[2], latest[2])
+
+    def test_tree(self):
+        for i in xrange(60):
+            path = '/'.join(self.random.choice('abc')
+                            for j in xrange(self.random.randint(1, 5)))
+            self.put(path, self.random.randint(0, 1000))
+        for node in self.tree_nodes():
+            self.assert_tree(node)
+
+    def test_deleted(self):
+        self.populate()
+        for node in self.tree_nodes():
+            self.assert_tree(node, deleted=True)
+
+    def test_deleted_node(self):
+        self.put('a/b/c', 10)
+        self.put('a/b/d', 20)
+        node = self.delete('a/b')
+        self.assertEqual(self.node.statistics_tree(node, CLUSTER_NORMAL),
+                         None)
+        self.assertEqual(self.node.statistics_latest(node, inf,
+                                                     CLUSTER_DELETED),
+                         None)
+        self.assert_tree(self.lookup('a'), deleted=True)
+
+    def test_empty(self):
+        node = self.lookup('a')
+        self.assert_tree(node)
+        stats = self.node.statistics_tree(node, CLUSTER_NORMAL)
+        self.assertEqual(stats[:2], (0, 0))
+
+    def test_until(self):
+        # The statistics of the tree at some point in time are those
+        # computed from the versions before it, later on, as long as the
+        # versions are kept.
+        self.versioning = True
+        snapshots = []
+        for i in xrange(5):
+            self.populate(20)
+            snapshots.append([(node, self.node.statistics_tree(
+                node, CLUSTER_NORMAL)) for node in self.tree_nodes()])
+            sleep(0.01)
+            snapshots[-1] = (time(), snapshots[-1])
+            sleep(0.01)
+        for until, stats in snapshots:
+            for node, tree in stats:
+                latest = self.node.statistics_latest(node, until,
+                                                     CLUSTER_DELETED)
+                self.assertEqual(tree is None, latest is None)
+                if tree is not None:
+                    self.assertEqual(tree[:2], latest[:2])
+                    self.assertTrue(tree[2] >= latest[2])
+
+
+class TestStatisticsTreeSqlite(TestStatisticsTree):
+    db_module = sqlite_db
+    db_connection = '%s/db.sqlite'
+
+
+class TestStatisticsAncestors(NodeTestCase):
+    """Updating the statistics of the ancestors at once must have the
+    effect of the previous loop, which updated one parent at a time."""
+
+    def setUp(self):
+        super(TestStatisticsAncestors, self).setUp()
+        self.old_wrapper = self.db_module.DBWrapper(
+            'sqlite:///%s/old.sqlite' % self.path)
+        self.old_node = self.db_module.Node(wrapper=self.old_wrapper)
+        self.nodes = {}
+        for i in xrange(40):
+            path = '/'.join(self.random.choice('abc')
+                            for j in xrange(self.random.randint(1, 6)))
+            self.create(path)
+
+    def tearDown(self):
+        self.old_wrapper.close()
+        super(TestStatisticsAncestors, self).tearDown()
+
+    def create(self, path):
+        if path in self.nodes:
+            return self.nodes[path]
+        if '/' in path:
+            parent = self.create(path.rsplit('/', 1)[0])
+        else:
+            parent = self.db_module.ROOTNODE
+        node = self.node.node_create(parent, path)
+        self.assertEqual(self.old_node.node_create(parent, path), node)
+        self.nodes[path] = node
+        return node
+
+    def old_statistics_update(self, node, population, size, mtime, cluster):
+        st = self.old_node.statistics
+        conn = self.old_node.conn
+        r = conn.execute(select([st.c.population, st.c.size],
+                                and_(st.c.node == node,
+                                     st.c.cluster == cluster))).fetchone()
+        prepopulation, presize = r if r else (0, 0)
+        population = max(population + prepopulation, 0)
+        size += presize
+        u = st.update().where(and_(st.c.node == node,
+                                   st.c.cluster == cluster))
+        rp = conn.execute(u.values(population=population, size=size,
+                                   mtime=mtime))
+        if rp.rowcount == 0:
+            conn.execute(st.insert().values(node=node, population=population,
+                                            size=size, mtime=mtime,
+                                            cluster=cluster))
+
+    def old_statistics_update_ancestors(self, node, population, size, mtime,
+                                        cluster=0, recursion_depth=None):
+        i = 0
+        while True:
+            if node == self.db_module.ROOTNODE:
+                break
+            if recursion_depth and recursion_depth <= i:
+                break
+            props = self.old_node.node_get_properties(node)
+            if props is None:
+                break
+            parent, path = props
+            self.old_statistics_update(parent, population, size, mtime,
+                                       cluster)
+            node = parent
+            population = 0
+            i += 1
+
+    def old_ancestors(self, node, recursion_depth):
+        ancestors = []
+        update = self.old_statistics_update
+        try:
+            self.old_statistics_update = (
+                lambda node, *args: ancestors.append(node))
+            self.old_statistics_update_ancestors(node, 0, 0, 0, 0,
+                                                 recursion_depth)
+        finally:
+            self.old_statistics_update = update
+        return ancestors
+
+    def statistics(self, node):
+        st = node.statistics
+        s = select([st.c.node, st.c.population, st.c.size, st.c.mtime,
+                    st.c.cluster]).order_by(st.c.node, st.c.cluster)
+        return node.conn.execute(s).fetchall()
+
+    def test_ancestors(self):
+        nodes = self.nodes.values() + [self.db_module.ROOTNODE]
+        for node in nodes:
+            for depth in (None, -2, -1, 0, 1, 2, 3, 10):
+                self.assertEqual(self.node.node_ancestors(node, depth),
+                                 self.old_ancestors(node, depth),
+                                 (node, depth))
+
+    def test_depths(self):
+        self.assertEqual(self.node.node_ancestors(self.nodes['a/b/c'], -1),
+                         [])
+        self.assertEqual(self.node.node_ancestors(self.nodes['a/b/c'], 1),
+                         [self.nodes['a/b']])
+        self.assertEqual(self.node.node_ancestors(self.nodes['a/b/c'], 0),
+                         [self.nodes['a/b'], self.nodes['a'],
+                          self.db_module.ROOTNODE])
+        self.assertEqual(self.node.node_ancestors(self.nodes['a/b/c']),
+                         self.node.node_ancestors(self.nodes['a/b/c'], 0))
+
+    def test_update(self):
+        nodes = self.nodes.values()
+        for i in xrange(300):
+            node = self.random.choice(nodes)
+            args = (self.random.choice((-2, -1, 0, 1, 1, 2)),
+                    self.random.randint(-100, 1000),
+                    i,
+                    self.random.choice((CLUSTER_NORMAL, CLUSTER_HISTORY)),
+                    self.random.choice((None, -1, 0, 1, 1, 1, 2, 5)))
+            self.node.statistics_update_ancestors(node, *args)
+            self.old_statistics_update_ancestors(node, *args)
+        self.assertEqual(self.statistics(self.node),
+                         self.statistics(self.old_node))
+
+
+class TestObjectPermissions(BackendTestCase):
+    def setUp(self):
+        super(TestObjectPermissions, self).setUp()
+        self.put_object('file')
+        self.put_object('dir', type='application/directory')
+        self.put_object('dir/file')
+        self.put_object('dir/sub/file')
+        self.put_object('plain')
+        self.put_object('plain/file')
+
+    def share(self, name, permissions):
+        self.backend.update_object_permissions(
+            'account', 'account', 'container', name, permissions)
+
+    def permissions(self, user, name):
+        return self.backend.get_object_permissions(
+            user, 'account', 'container', name)
+
+    def bulk(self, user, names):
+        return self.backend.get_object_permissions_bulk(
+            user, 'account', 'container', names)
+
+    def can_read(self, user, name):
+        return self.backend._has_read_access(
+            user, 'account/container/' + name)
+
+    def test_direct(self):
+        self.share('file', {'read': ['bob']})
+        self.assertEqual(self.permissions('bob', 'file'),
+                         ('read', 'account/container/file',
+                          {'read': ['bob']}))
+        self.assertEqual(self.permissions('account', 'file'),
+                         ('write', 'account/container/file',
+                          {'read': ['bob']}))
+        self.assertRaises(NotAllowedError, self.permissions, 'eve', 'file')
+        self.assertTrue(self.can_read('bob', 'file'))
+        self.assertFalse(self.can_read('eve', 'file'))
+
+    def test_inherited(self):
+        self.share('dir', {'write': ['bob']})
+        for name in ('dir/file', 'dir/sub/file'):
+            self.assertEqual(self.permissions('bob', name),
+                             ('write', 'account/container/dir',
+                              {'write': ['bob']}))
+        self.assertTrue(self.can_read('bob', 'dir/sub/file'))
+
+    def test_direct_over_inherited(self):
+        self.share('dir', {'write': ['bob']})
+        self.share('dir/file', {'read': ['eve']})
+        self.assertEqual(self.permissions('eve', 'dir/file'),
+                         ('read', 'account/container/dir/file',
+                          {'read': ['eve']}))
+        self.assertRaises(NotAllowedError, self.permissions, 'bob',
+                          'dir/file')
+        self.assertEqual(self.permissions('bob', 'dir/sub/file')[0], 'write')
+        self.assertFalse(self.can_read('eve', 'dir/sub/file'))
+
+    def test_not_directory(self):
+        self.share('plain', {'read': ['bob']})
+        self.assertEqual(self.permissions('bob', 'plain')[0], 'read')
+        self.assertRaises(NotAllowedError, self.permissions, 'bob',
+                          'plain/file')
+        self.assertFalse(self.can_read('bob', 'plain/file'))
+
+    def test_groups(self):
+        self.backend.update_account_groups('account', 'account',
+                                           {'friends': ['bob', 'eve']})
+        self.share('dir', {'read': ['account:friends'], 'write': ['*']})
+        self.assertEqual(self.permissions('eve', 'dir/file')[0], 'write')
+        self.share('dir', {'read': ['account:friends']})
+        self.assertEqual(self.permissions('eve', 'dir/file')[0], 'read')
+        self.assertRaises(NotAllowedError, self.permissions, 'joe',
+                          'dir/file')
+
+    def test_public(self):
+        self.backend.update_object_public('account', 'account', 'container',
+                                          'plain/file', True)
+        self.assertTrue(self.can_read('eve', 'plain/file'))
+        self.assertRaises(NotAllowedError, self.permissions, 'eve',
+                          'plain/file')
+
+    def test_bulk(self):
+        self.share('file', {'read': ['bob']})
+        self.share('dir', {'write': ['bob']})
+        names = ['file', 'dir/file', 'dir/sub/file']
+        permissions = self.bulk('bob', names)
+        self.assertEqual(permissions, dict(
+            (name, self.permissions('bob', name)) for name in names))
+        self.assertRaises(NotAllowedError, self.bulk, 'bob',
+                          names + ['plain'])
+        self.assertRaises(ItemNotExists, self.bulk, 'bob',
+                          names + ['missing'])
+
+    def test_bulk_queries(self):
+        self.share('dir', {'write': ['bob']})
+        names = ['dir/file%d' % i for i in xrange(20)]
+        for name in names:
+            self.put_object(name)
+        with patch.object(self.backend.node, 'node_lookup',
+                          wraps=self.backend.node.node_lookup) as lookup:
+            with patch.object(self.backend.permissions, 'xfeature_dict_bulk',
+                              wraps=self.backend.permissions.
+                              xfeature_dict_bulk) as features:
+                self.bulk('bob', names)
+        # Only the directory is looked up, to check its type.
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(features.call_count, 1)
+
+    def test_can_read_many(self):
+        self.share('file', {'read': ['bob']})
+        self.share('dir', {'write': ['bob']})
+        self.share('plain', {'read': ['bob']})
+        self.backend.update_object_public('account', 'account', 'container',
+                                          'plain/file', True)
+        names = ['file', 'dir', 'dir/file', 'dir/sub/file', 'plain',
+                 'plain/file', 'missing']
+        paths = ['account/container/' + name for name in names]
+        readable = [p for p in paths if self.can_read('bob', p[18:])]
+        self.assertEqual(readable, paths[:-1])
+        self.assertEqual(self.backend.can_read_many('bob', paths), readable)
+        self.assertEqual(self.backend.can_read_many('eve', paths),
+                         ['account/container/plain/file'])
+        self.assertEqual(self.backend.can_read_many('account', paths), paths)
+        self.assertEqual(self.backend.can_read_many('bob', []), [])
+        self.assertRaises(ValueError, self.backend.can_read_many, 'bob',
+                          ['account/container'])
+
+    def test_can_read_many_queries(self):
+        self.share('dir', {'read': ['bob']})
+        paths = ['account/container/dir/file%d' % i for i in xrange(20)]
+        permissions = self.backend.permissions
+        with patch.object(permissions, 'xfeature_dict_bulk',
+                          wraps=permissions.xfeature_dict_bulk) as features:
+            with patch.object(permissions, 'public_get_bulk',
+                              wraps=permissions.public_get_bulk) as public:
+                self.assertEqual(self.backend.can_read_many('bob', paths),
+                                 paths)
+        self.assertEqual(features.call_count, 1)
+        self.assertEqual(public.call_count, 1)
+        self.share('dir', {})
+        self.assertEqual(self.backend.can_read_many('bob', paths), [])
+
+    def test_stale_permissions(self):
+        self.share('file', {'read': ['bob']})
+        self.assertEqual(self.permissions('bob', 'file')[0], 'read')
+        self.share('file', {'read': ['eve']})
+        self.assertRaises(NotAllowedError, self.permissions, 'bob', 'file')
+        self.assertEqual(self.bulk('eve', ['file'])['file'][0], 'read')
+        self.share('file', {})
+        self.assertRaises(NotAllowedError, self.bulk, 'eve', ['file'])
+
+    def test_stale_directory(self):
+        self.share('dir', {'read': ['bob']})
+        self.assertTrue(self.can_read('bob', 'dir/file'))
+        self.put_object('dir', type='text/plain')
+        self.assertFalse(self.can_read('bob', 'dir/file'))
+        self.put_object('dir', type='application/folder')
+        self.assertTrue(self.can_read('bob', 'dir/file'))
+
+    def test_stale_deleted(self):
+        self.share('dir', {'read': ['bob']})
+        self.assertEqual(self.bulk('bob', ['dir/file'])['dir/file'][0],
+                         'read')
+        self.backend.delete_object('account', 'account', 'container', 'dir')
+        self.assertRaises(NotAllowedError, self.bulk, 'bob', ['dir/file'])
+        self.assertRaises(NotAllowedError, self.permissions, 'bob',
+                          'dir/sub/file')
+        self.assertFalse(self.can_read('bob', 'dir/file'))
+
+
+class TestProvisions(BackendTestCase):
+    """Diskspace changes are issued as one commission per transaction."""
+
+    def setUp(self):
+        super(TestProvisions, self).setUp()
+        self.backend.put_account('other', 'other')
+        self.serial = 0
+        client = Mock()
+        client.issue_commission.side_effect = self.issue_commission
+        client.resolve_commissions.side_effect = \
+            lambda token, accept_serials, reject_serials: \
+            {'accepted': accept_serials}
+        self.backend.astakosclient = client
+
+    def issue_commission(self, token, request):
+        self.serial += 1
+        return self.serial
+
+    def commissions(self):
+        client = self.backend.astakosclient
+        commissions = [kw['request'] for args, kw in
+                       client.issue_commission.call_args_list]
+        client.issue_commission.reset_mock()
+        return [(c['name'], [(p['holder'], p['quantity'])
+                             for p in c['provisions']])
+                for c in commissions]
+
+    def report(self, changes):
+        backend = self.backend
+        backend.wrapper.execute()
+        try:
+            backend.serials = []
+            for account, size, path in changes:
+                backend._report_size_change(account, account, size,
+                                            {'path': path})
+            backend._issue_provisions()
+            return backend.serials
+        finally:
+            backend.wrapper.rollback()
+
+    def test_update(self):
+        self.put_object('object', 10)
+        self.assertEqual(self.commissions(),
+                         [('account/container/object', [('account', 10)])])
+        self.put_object('object', 4)
+        self.assertEqual(self.commissions(),
+                         [('account/container/object', [('account', -6)])])
+        self.put_object('object', 4)
+        self.assertEqual(self.commissions(), [])
+
+    def test_delete_many(self):
+        for name, size in (('dir/a', 3), ('dir/b', 5), ('dir/c/d', 7)):
+            self.put_object(name, size)
+        self.put_object('dir', 1, type='application/directory')
+        self.commissions()
+        self.backend.delete_object('account', 'account', 'container', 'dir',
+                                   delimiter='/')
+        self.assertEqual(self.commissions(),
+                         [('account/container/dir (and 3 more)',
+                           [('account', -16)])])
+
+    def test_net_zero(self):
+        self.put_object('object', 10)
+        self.commissions()
+        self.backend.move_object('account', 'account', 'container', 'object',
+                                 'account', 'container', 'moved',
+                                 'application/octet', 'pithos')
+        self.assertEqual(self.commissions(), [])
+        self.assertEqual(self.report([('account', 10, 'a'),
+                                      ('account', -10, 'b')]), [])
+        self.assertEqual(self.commissions(), [])
+
+    def test_mixed_holders(self):
+        self.assertEqual(self.report([('other', 10, 'a'),
+                                      ('account', 5, 'b'),
+                                      ('other', -10, 'c'),
+                                      ('account', 2, 'd')]), [1])
+        self.assertEqual(self.commissions(),
+                         [('a (and 3 more)', [('account', 7)])])
+        self.report([('other', 1, 'a'), ('account', -2, 'b')])
+        self.assertEqual(self.commissions(),
+                         [('a (and 1 more)', [('account', -2), ('other', 1)])])
+
+    def test_unchanged(self):
+        self.assertEqual(self.report([('account', 0, 'a')]), [])
+        self.report([('account', 0, 'a'), ('account', 3, 'b')])
+        self.assertEqual(self.commissions(), [('b', [('account', 3)])])
+
+    def test_failure(self):
+        client = self.backend.astakosclient
+        client.issue_commission.side_effect = Exception('quota')
+        self.assertRaises(QuotaError, self.put_object, 'object', 10)
+        self.assertRaises(ItemNotExists, self.backend.get_object_meta,
+                          'account', 'account', 'container', 'object',
+                          'pithos')
+        self.assertEqual(client.resolve_commissions.call_count, 0)
+        self.assertEqual(self.backend.provisions, {})
+        self.assertEqual(self.backend.provisions_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,20 +31,32 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from objpool import ObjectPool
+import logging
+
+from objpool import ObjectPool, PoolLimitError
 from new import instancemethod
+from os import getpid
 from select import select
+from threading import Lock, Thread
+from time import time, sleep
 from traceback import print_exc
 from pithos.backends import connect_backend
 
 USAGE_LIMIT = 500
 
+# Bounds of the delay between attempts to get a backend within a timeout.
+WAIT_MIN_DELAY = 0.001
+WAIT_MAX_DELAY = 0.05
+
+logger = logging.getLogger(__name__)
+
 
 class PithosBackendPool(ObjectPool):
     def __init__(self, size=None, db_module=None, db_connection=None,
                  block_module=None, block_path=None, block_umask=None,
                  queue_module=None, queue_hosts=None,
-                 queue_exchange=None, free_versioning=True,
+                 queue_exchange=None, queue_backlog=None,
+                 free_versioning=True,
                  astakos_url=None, service_token=None,
                  astakosclient_poolsize=None,
                  block_params=None,
@@ -52,7 +64,8 @@ class PithosBackendPool(ObjectPool):
                  public_url_alphabet=None,
                  account_quota_policy=None,
                  container_quota_policy=None,
-                 container_versioning_policy=None
+                 container_versioning_policy=None,
+                 timeout=None, warmup=0, health_interval=0
         ):
         super(PithosBackendPool, self).__init__(size=size)
         self.db_module = db_module
@@ -64,6 +77,7 @@ class PithosBackendPool(ObjectPool):
         self.block_params = block_params
         self.queue_hosts = queue_hosts
         self.queue_exchange = queue_exchange
+        self.queue_backlog = queue_backlog
         self.astakos_url = astakos_url
         self.service_token = service_token
         self.astakosclient_poolsize = astakosclient_poolsize
@@ -73,6 +87,186 @@ class PithosBackendPool(ObjectPool):
         self.account_quota_policy = account_quota_policy
         self.container_quota_policy = container_quota_policy
         self.container_versioning_policy = container_versioning_policy
+        self.timeout = timeout
+        self.warmup = min(warmup, self.size)
+        self.health_interval = health_interval
+        self._maintainer_pid = None
+
+        self._stats_lock = Lock()
+        self._stats = {'gets': 0,
+                       'puts': 0,
+                       'creations': 0,
+                       'recycles': 0,
+                       'waits': 0,
+                       'wait_time': 0.0,
+                       'max_wait_time': 0.0,
+                       'timeouts': 0}
+        self._reported_waits = 0
+        self._reported_timeouts = 0
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for k, v in counts.iteritems():
+                self._stats[k] += v
+
+    def pool_stats(self):
+        """Return a dict with the pool gauges and counters.
+
+        in_use and idle are the backends currently handed out and waiting
+        in the pool. The counters hold the backends created and recycled,
+        the gets that had to wait for an allocation, the total and maximum
+        time they waited, in seconds, and the gets that timed out.
+        """
+
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['size'] = self.size
+        stats['in_use'] = stats.pop('gets') - stats.pop('puts')
+        stats['idle'] = len(self._set)
+        return stats
+
+    def pool_get(self, blocking=True, timeout=None, create=True, verify=True):
+        """Get a backend from the pool.
+
+        If the pool is exhausted, wait at most timeout seconds (the pool
+        timeout, if not given) for a backend to be put back, then raise
+        PoolLimitError. Without any timeout, wait as long as it takes.
+        """
+
+        self._pool_start()
+        if timeout is None:
+            timeout = self.timeout
+        get = super(PithosBackendPool, self).pool_get
+        try:
+            backend = get(blocking=False, create=create, verify=verify)
+        except PoolLimitError:
+            if not blocking:
+                raise
+        else:
+            self._count(gets=1)
+            return backend
+
+        start = time()
+        try:
+            if timeout is None:
+                backend = get(create=create, verify=verify)
+            else:
+                backend = self._pool_get_wait(start + timeout, create,
+                                              verify)
+        except PoolLimitError:
+            self._count(timeouts=1)
+            raise
+        finally:
+            waited = time() - start
+            with self._stats_lock:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += waited
+                if waited > self._stats['max_wait_time']:
+                    self._stats['max_wait_time'] = waited
+        self._count(gets=1)
+        return backend
+
+    def _pool_get_wait(self, deadline, create, verify):
+        # Semaphores do not support timeouts in Python 2, so poll.
+        get = super(PithosBackendPool, self).pool_get
+        delay = WAIT_MIN_DELAY
+        while True:
+            try:
+                return get(blocking=False, create=create, verify=verify)
+            except PoolLimitError:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise
+                sleep(min(delay, remaining))
+                delay = min(delay * 2, WAIT_MAX_DELAY)
+
+    def pool_put(self, backend):
+        super(PithosBackendPool, self).pool_put(backend)
+        self._count(puts=1)
+
+    def pool_warmup(self, count):
+        """Create idle backends until there are count in the pool."""
+
+        for i in xrange(count):
+            if len(self._set) >= count:
+                break
+            backend = self._pool_create()
+            with self._mutex:
+                self._set.add(backend)
+
+    def pool_check(self):
+        """Verify the idle backends and recycle the ones that fail."""
+
+        with self._mutex:
+            idle = list(self._set)
+        recycled = 0
+        for backend in idle:
+            # Take an allocation, like pool_get() does, so that a backend
+            # being checked is counted against the pool size, and stop
+            # when the pool is exhausted: gets verify backends anyway.
+            if not self._semaphore.acquire(False):
+                break
+            try:
+                with self._mutex:
+                    if backend not in self._set:
+                        continue
+                    self._set.remove(backend)
+                if self._pool_verify(backend):
+                    with self._mutex:
+                        self._set.add(backend)
+                else:
+                    recycled += 1
+            finally:
+                self._semaphore.release()
+        return recycled
+
+    def _pool_start(self):
+        # Warm up and check the pool in a thread of the process that uses
+        # it, started lazily, so that neither the thread nor the backends
+        # it creates are inherited across forks of the worker processes.
+        pid = getpid()
+        if self._maintainer_pid == pid:
+            return
+        with self._stats_lock:
+            if self._maintainer_pid == pid:
+                return
+            self._maintainer_pid = pid
+        if self.warmup > 0 or self.health_interval > 0:
+            t = Thread(target=self._pool_maintain,
+                       args=(self.warmup, self.health_interval))
+            t.daemon = True
+            t.start()
+
+    def _pool_maintain(self, warmup, health_interval):
+        try:
+            self.pool_warmup(warmup)
+        except:
+            logger.exception('Failed to warm up backend pool')
+        while health_interval > 0:
+            sleep(health_interval)
+            try:
+                self.pool_check()
+                self._pool_report()
+            except:
+                logger.exception('Failed to check backend pool')
+
+    def _pool_report(self):
+        # Log the pool gauges whenever it was found exhausted.
+        stats = self.pool_stats()
+        if (stats['waits'] == self._reported_waits and
+                stats['timeouts'] == self._reported_timeouts):
+            return
+        self._reported_waits = stats['waits']
+        self._reported_timeouts = stats['timeouts']
+        logger.warning('Backend pool exhausted: %s',
+                       ', '.join('%s=%s' % x for x in sorted(stats.items())))
+
+    def _pool_recycle(self, backend):
+        self._count(recycles=1)
+        try:
+            backend._real_close()
+        except:
+            print_exc()
 
     def _pool_create(self):
         backend = connect_backend(
@@ -85,6 +279,7 @@ class PithosBackendPool(ObjectPool):
                 block_params=self.block_params,
                 queue_hosts=self.queue_hosts,
                 queue_exchange=self.queue_exchange,
+                queue_backlog=self.queue_backlog,
                 astakos_url=self.astakos_url,
                 service_token=self.service_token,
                 astakosclient_poolsize=self.astakosclient_poolsize,
@@ -101,9 +296,16 @@ class PithosBackendPool(ObjectPool):
         backend._pool = self
         backend._use_count = USAGE_LIMIT
         backend.messages = []
+        self._count(creations=1)
         return backend
 
     def _pool_verify(self, backend):
+        if self._pool_verify_connection(backend):
+            return True
+        self._pool_recycle(backend)
+        return False
+
+    def _pool_verify_connection(self, backend):
         wrapper = backend.wrapper
         conn = wrapper.conn
         if conn.closed:
@@ -128,7 +330,7 @@ class PithosBackendPool(ObjectPool):
     def _pool_cleanup(self, backend):
         c = backend._use_count - 1
         if c < 0:
-            backend._real_close()
+            self._pool_recycle(backend)
             return True
 
         backend._use_count = c